@@ -12,12 +12,28 @@ import re
 import datetime
 import sys
 import collections
-import threading
+import argparse
+import multiprocessing
+import pickle
+import json
+import gzip
+
+import instrumentation
 
 rosetta_output_file_name = 'rosetta.out'
+compressed_rosetta_output_file_name = rosetta_output_file_name + '.gz'
+completion_marker_file_name = 'rosetta.done' # Written by the run_example launchers after Rosetta exits successfully
+rosetta_output_tail_bytes = 64 * 1024 # The JobDistributor lines checked for success are printed at the very end of the Rosetta output
 output_database_name = 'ddG.db3'
-trajectory_stride = 5
+default_trajectory_stride = 5 # Backrub steps between the checkpoints of ddG-backrub.xml runs, as set by the run_example launchers
+trajectory_stride = default_trajectory_stride # Used to renumber structs to backrub steps; see set_trajectory_stride
+trajectory_stride_file_name = 'trajectory_stride.txt' # Written into an output folder by launchers whose checkpoints are a different number of steps apart
 script_output_folder = 'analysis_output'
+analysis_cache_file_name = 'analysis_cache.db3'
+bootstrap_samples = 1000 # Resamplings of a case's structs used to estimate the standard error and confidence interval of its mean scores
+bootstrap_ci_percentiles = (2.5, 97.5) # Percentile bootstrap 95% confidence interval
+cases_in_flight_per_job = 2 # With --jobs, cases submitted to the pool per process ahead of the case being written, which bounds the analyzed cases held in the parent
+bootstrap_columns = ['total_score_se', 'total_score_ci_low', 'total_score_ci_high']
 
 zemu_gam_params = {
     'fa_sol' :      (6.940, -6.722),
@@ -32,38 +48,183 @@ zemu_gam_params = {
 def gam_function(x, score_term = None ):
     return -1.0 * np.exp( zemu_gam_params[score_term][0] ) + 2.0 * np.exp( zemu_gam_params[score_term][0] ) / ( 1.0 + np.exp( -1.0 * x * np.exp( zemu_gam_params[score_term][1] ) ) )
 
+def load_gam_param_sets( gam_params_path ):
+    # Reads alternative GAM parameter sets from a JSON file of the form
+    # { "set_name" : { "score_term" : [ log scale, log slope ], ... }, ... }
+    # Reweighted scores of each set are reported with a "-set_name" suffix on the score function name.
+    with open( gam_params_path, 'r' ) as f:
+        gam_param_sets = json.load( f, object_pairs_hook = collections.OrderedDict )
+    return collections.OrderedDict( [
+        ( set_name, collections.OrderedDict( [ (score_term, tuple(params)) for score_term, params in gam_params.items() ] ) )
+        for set_name, gam_params in gam_param_sets.items()
+    ] )
+
+def apply_gam_reweightings( scores, gam_param_sets ):
+    # Applies each GAM parameter set in gam_param_sets (set name -> {score term : params}, as zemu_gam_params) to scores.
+    # The score terms used by any set are pulled out once into an (n_rows x n_terms) matrix, and all sets are then
+    # evaluated in a single broadcast over an (n_sets x n_rows x n_terms) array with precomputed coefficients.
+    score_terms = []
+    for gam_params in gam_param_sets.values():
+        for score_term in gam_params:
+            assert( score_term in scores.columns )
+            if score_term not in score_terms:
+                score_terms.append( score_term )
+
+    in_set = np.zeros( (len(gam_param_sets), len(score_terms)), dtype = bool )
+    log_scales = np.zeros( in_set.shape )
+    log_slopes = np.zeros( in_set.shape )
+    for i, gam_params in enumerate( gam_param_sets.values() ):
+        for score_term, (log_scale, log_slope) in gam_params.items():
+            j = score_terms.index( score_term )
+            in_set[i, j] = True
+            log_scales[i, j] = log_scale
+            log_slopes[i, j] = log_slope
+    scales = np.exp( log_scales )[:, np.newaxis, :]
+    slopes = np.exp( log_slopes )[:, np.newaxis, :]
+
+    values = scores[ score_terms ].to_numpy( dtype = np.float64 )
+    gam_values = -1.0 * scales + 2.0 * scales / ( 1.0 + np.exp( -1.0 * values[np.newaxis, :, :] * slopes ) )
+    # Score terms that are not part of a set are left as they are, and are not counted in its total_score
+    gam_values = np.where( in_set[:, np.newaxis, :], gam_values, values[np.newaxis, :, :] )
+
+    other_columns = [ column for column in scores.columns if column != 'total_score' ]
+    reweighted_scores_dfs = []
+    for i, set_name in enumerate( gam_param_sets ):
+        reweighted_scores = scores[ other_columns ].copy()
+        reweighted_scores[ score_terms ] = gam_values[i]
+        set_terms = list( gam_param_sets[set_name].keys() )
+        reweighted_scores[ 'total_score' ] = reweighted_scores[ set_terms ].sum( axis = 1 )
+        reweighted_scores[ 'score_function_name' ] = scores[ 'score_function_name' ] + '-' + set_name
+        reweighted_scores_dfs.append( reweighted_scores )
+    return reweighted_scores_dfs
+
+def get_gam_param_sets( extra_gam_param_sets = None ):
+    # The Zemu GAM, reported as "-gam", followed by any extra sets read with load_gam_param_sets
+    gam_param_sets = collections.OrderedDict( [ ('gam', zemu_gam_params) ] )
+    if extra_gam_param_sets != None:
+        gam_param_sets.update( extra_gam_param_sets )
+    return gam_param_sets
+
 def apply_zemu_gam(scores):
-    new_columns = list(scores.columns)
-    new_columns.remove('total_score')
-    scores = scores.copy()[ new_columns ]
-    for score_term in zemu_gam_params:
-        assert( score_term in scores.columns )
-        scores[score_term] = scores[score_term].apply( gam_function, score_term = score_term )
-    scores[ 'total_score' ] = scores[ list(zemu_gam_params.keys()) ].sum( axis = 1 )
-    scores[ 'score_function_name' ] = scores[ 'score_function_name' ] + '-gam'
-    return scores
+    return apply_gam_reweightings( scores, collections.OrderedDict( [ ('gam', zemu_gam_params) ] ) )[0]
+
+def read_file_tail_lines( path, tail_bytes ):
+    # Returns the complete lines within the last tail_bytes of a file, without reading the rest of it
+    with open( path, 'rb' ) as f:
+        f.seek( 0, os.SEEK_END )
+        file_size = f.tell()
+        # Start one byte early, so that a line starting exactly at the tail boundary is kept
+        start = max( 0, file_size - tail_bytes - 1 )
+        f.seek( start )
+        tail = f.read()
+    if start > 0:
+        tail = tail[ tail.find( b'\n' ) + 1 : ]
+    return tail.decode( 'utf-8', errors = 'replace' ).splitlines()
+
+def read_gzip_file_tail_lines( path, tail_bytes ):
+    # As read_file_tail_lines, for a gzip compressed file. The file has to be decompressed from the start, but only its last tail_bytes are kept.
+    tail = b''
+    with gzip.open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( 1024 * 1024 ), b'' ):
+            tail = ( tail + chunk )[ -(tail_bytes + 1) : ]
+    if len(tail) > tail_bytes:
+        tail = tail[ tail.find( b'\n' ) + 1 : ]
+    return tail.decode( 'utf-8', errors = 'replace' ).splitlines()
 
 def rosetta_output_succeeded( potential_struct_dir ):
-    path_to_rosetta_output = os.path.join( potential_struct_dir, rosetta_output_file_name )
-    if not os.path.isfile(path_to_rosetta_output):
-        return False
-
+    # The ddG.db3 is required with a completion marker as well, as it is missing if it could not be copied back from scratch
     db3_file = os.path.join( potential_struct_dir, output_database_name )
     if not os.path.isfile( db3_file ):
         return False
 
+    if os.path.isfile( os.path.join( potential_struct_dir, completion_marker_file_name ) ):
+        return True
+
+    # Runs in a scratch directory (see job_scheduler.start_rosetta_process) leave their Rosetta output gzip compressed
+    path_to_rosetta_output = os.path.join( potential_struct_dir, rosetta_output_file_name )
+    path_to_compressed_rosetta_output = os.path.join( potential_struct_dir, compressed_rosetta_output_file_name )
+    if os.path.isfile(path_to_rosetta_output):
+        read_tail_lines = read_file_tail_lines
+    elif os.path.isfile(path_to_compressed_rosetta_output):
+        path_to_rosetta_output = path_to_compressed_rosetta_output
+        read_tail_lines = read_gzip_file_tail_lines
+    else:
+        return False
+
     success_line_found = False
     no_more_batches_line_found = False
-    with open( path_to_rosetta_output, 'r' ) as f:
-        for line in f:
-            if line.startswith( 'protocols.jd2.JobDistributor' ) and 'reported success in' in line:
-                success_line_found = True
-            if line.startswith( 'protocols.jd2.JobDistributor' ) and 'no more batches to process' in line:
-                no_more_batches_line_found = True
+    for line in read_tail_lines( path_to_rosetta_output, rosetta_output_tail_bytes ):
+        if line.startswith( 'protocols.jd2.JobDistributor' ) and 'reported success in' in line:
+            success_line_found = True
+        if line.startswith( 'protocols.jd2.JobDistributor' ) and 'no more batches to process' in line:
+            no_more_batches_line_found = True
 
     return no_more_batches_line_found and success_line_found
 
+class AnalysisCache:
+    # Persistent cache of each struct's pivoted score rows, stored in a SQLite side table in the analysis output folder.
+    # Entries are keyed on the ddG.db3 path and are only used while the file's mtime and size, and the
+    # trajectory_stride used to renumber its structs, are unchanged.
+    def __init__( self, cache_path ):
+        self.conn = sqlite3.connect( cache_path, timeout = 60 )
+        self.conn.execute( '''
+        CREATE TABLE IF NOT EXISTS struct_scores (
+            db3_path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER,
+            trajectory_stride INTEGER,
+            scores BLOB
+        )''' )
+        self.conn.commit()
+
+    def fingerprint( self, db3_file ):
+        stat = os.stat( db3_file )
+        return ( stat.st_mtime_ns, stat.st_size, trajectory_stride )
+
+    def get_scores( self, db3_file ):
+        row = self.conn.execute( 'SELECT mtime_ns, size, trajectory_stride, scores FROM struct_scores WHERE db3_path=?', (os.path.abspath(db3_file),) ).fetchone()
+        if row is None or tuple(row[:3]) != self.fingerprint( db3_file ):
+            return None
+        try:
+            return pickle.loads( row[3] )
+        except Exception:
+            # Entries written by an incompatible pandas version are treated as missing
+            return None
+
+    def put_scores( self, db3_file, scores, fingerprint = None ):
+        # fingerprint is that of db3_file when scores were read from it (by default, its current fingerprint)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO struct_scores VALUES (?, ?, ?, ?, ?)',
+            (os.path.abspath(db3_file),) + ( fingerprint or self.fingerprint( db3_file ) ) + (pickle.dumps( scores, protocol = pickle.HIGHEST_PROTOCOL ),),
+        )
+
+    def evict_stale( self ):
+        # Removes entries whose ddG.db3 file no longer exists, has changed, or was read with a different trajectory_stride
+        stale_paths = []
+        for db3_path, mtime_ns, size, stride in self.conn.execute( 'SELECT db3_path, mtime_ns, size, trajectory_stride FROM struct_scores' ).fetchall():
+            if not os.path.isfile( db3_path ) or (mtime_ns, size, stride) != self.fingerprint( db3_path ):
+                stale_paths.append( (db3_path,) )
+        self.conn.executemany( 'DELETE FROM struct_scores WHERE db3_path=?', stale_paths )
+        self.conn.commit()
+        self.conn.execute( 'VACUUM' )
+        return len(stale_paths)
+
+    def commit( self ):
+        self.conn.commit()
+
+    def close( self ):
+        self.conn.commit()
+        self.conn.close()
+
+def get_analysis_cache_path():
+    if not os.path.isdir(script_output_folder):
+        os.makedirs(script_output_folder)
+    return os.path.join( script_output_folder, analysis_cache_file_name )
+
 def find_finished_jobs( output_folder ):
+    # Each struct directory is checked with rosetta_output_succeeded, even if its ddG.db3 is in the analysis cache: a
+    # relaunch into the same directory removes the completion marker and log, but can leave the old ddG.db3 unchanged
+    # while it runs (or after it fails). The cache only saves re-reading the scores of the structs found here.
     return_dict = {}
     job_dirs = [ os.path.abspath(os.path.join(output_folder, d)) for d in os.listdir(output_folder) if os.path.isdir( os.path.join(output_folder, d) )]
     for job_dir in job_dirs:
@@ -75,141 +236,460 @@ def find_finished_jobs( output_folder ):
 
     return return_dict
 
-def get_scores_from_db3_file(db3_file, struct_number, case_name):
-    conn = sqlite3.connect(db3_file)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-
-    num_batches = c.execute('SELECT max(batch_id) from batches').fetchone()[0]
-
-    scores = pd.read_sql_query('''
-    SELECT batches.name, structure_scores.struct_id, score_types.score_type_name, structure_scores.score_value, score_function_method_options.score_function_name from structure_scores
+# SQL expressions shared by the ddG.db3 queries below. Batch names have their _dbreport suffix stripped to give the state,
+# and struct_ids are renumbered to the number of backrub steps (each checkpoint writes one struct per batch).
+db3_state_sql = "CASE WHEN substr(batches.name, -9)='_dbreport' THEN substr(batches.name, 1, length(batches.name)-9) ELSE batches.name END"
+db3_backrub_steps_sql = ":trajectory_stride * (1 + (structure_scores.struct_id - 1) / :num_batches)"
+db3_scores_joins_sql = '''
     INNER JOIN batches ON batches.batch_id=structure_scores.batch_id
     INNER JOIN score_function_method_options ON score_function_method_options.batch_id=batches.batch_id
     INNER JOIN score_types ON score_types.batch_id=structure_scores.batch_id AND score_types.score_type_id=structure_scores.score_type_id
-    ''', conn)
+'''
+
+def read_trajectory_stride( output_folder ):
+    # The checkpoint stride recorded in output_folder by its launcher, or default_trajectory_stride
+    stride_path = os.path.join( output_folder, trajectory_stride_file_name )
+    if not os.path.isfile( stride_path ):
+        return default_trajectory_stride
+    with open( stride_path, 'r' ) as f:
+        return int( f.read().strip() )
+
+def set_trajectory_stride( stride ):
+    # Also used as the initializer of analysis pool workers, which may not inherit the parent's module globals
+    global trajectory_stride
+    trajectory_stride = stride
+
+def get_db3_query_params(conn):
+    num_batches = conn.execute('SELECT max(batch_id) from batches').fetchone()[0]
+    return { 'trajectory_stride' : trajectory_stride, 'num_batches' : num_batches }
+
+def get_unpivoted_scores_from_db3_file(db3_file):
+    # One row per (struct, score type), with struct_id renumbered to backrub steps and the _dbreport suffix stripped from batch names
+    conn = sqlite3.connect(db3_file)
 
-    def renumber_struct_id( struct_id ):
-        return trajectory_stride * ( 1 + (int(struct_id-1) // num_batches) )
+    scores = pd.read_sql_query('''
+    SELECT %s AS name, %s AS struct_id, score_types.score_type_name, structure_scores.score_value, score_function_method_options.score_function_name from structure_scores
+    %s
+    ''' % (db3_state_sql, db3_backrub_steps_sql, db3_scores_joins_sql), conn, params = get_db3_query_params(conn))
 
-    scores['struct_id'] = scores['struct_id'].apply( renumber_struct_id )
-    scores['name'] = scores['name'].apply( lambda x: x[:-9] if x.endswith('_dbreport') else x )
-    scores = scores.pivot_table( index = ['name', 'struct_id', 'score_function_name'], columns = 'score_type_name', values = 'score_value' ).reset_index()
-    scores.rename( columns = {
-        'name' : 'state',
-        'struct_id' : 'backrub_steps',
-    }, inplace=True)
-    scores['struct_num'] = struct_number
-    scores['case_name'] = case_name
+    conn.close()
+
+    return scores
+
+def get_scores_from_db3_file(db3_file, struct_number, case_name):
+    # Score types are pivoted into columns in SQL, with one conditional aggregate per score type, so that the
+    # wide frame is read straight from the cursor without any per-row Python work
+    conn = sqlite3.connect(db3_file)
+
+    params = get_db3_query_params(conn)
+    score_type_names = sorted( [ row[0] for row in conn.execute('SELECT DISTINCT score_type_name FROM score_types').fetchall() ] )
+    score_type_columns = []
+    for i, score_type_name in enumerate(score_type_names):
+        params['score_type_%d' % i] = score_type_name
+        score_type_columns.append( 'AVG(CASE WHEN score_types.score_type_name=:score_type_%d THEN structure_scores.score_value END) AS "%s"' % (i, score_type_name.replace('"', '""')) )
+    params['struct_num'] = struct_number
+    params['case_name'] = case_name
+
+    scores = pd.read_sql_query('''
+    SELECT %s AS state, %s AS backrub_steps, score_function_method_options.score_function_name, %s, :struct_num AS struct_num, :case_name AS case_name from structure_scores
+    %s
+    GROUP BY state, backrub_steps, score_function_method_options.score_function_name
+    ORDER BY state, backrub_steps, score_function_method_options.score_function_name
+    ''' % (db3_state_sql, db3_backrub_steps_sql, ', '.join(score_type_columns), db3_scores_joins_sql), conn, params = params)
 
     conn.close()
 
     return scores
 
-def process_finished_struct( output_path, case_name ):
+def process_finished_struct( output_path, case_name, cache = None, new_cache_entries = None ):
+    # Scores missing from the cache are appended to new_cache_entries as (db3_file, scores, fingerprint), if it is given,
+    # for the caller to put into the cache; otherwise they are put into the cache here
     db3_file = os.path.join( output_path, output_database_name )
     assert( os.path.isfile( db3_file ) )
     struct_number = int( os.path.basename(output_path) )
+    if cache != None:
+        scores_df = cache.get_scores( db3_file )
+        if scores_df is not None:
+            return scores_df
+        fingerprint = cache.fingerprint( db3_file )
     scores_df = get_scores_from_db3_file( db3_file, struct_number, case_name )
+    if cache != None and new_cache_entries != None:
+        new_cache_entries.append( (db3_file, scores_df, fingerprint) )
+    elif cache != None:
+        cache.put_scores( db3_file, scores_df )
 
     return scores_df
 
-def calc_ddg( scores ):
-    total_structs = np.max( scores['struct_num'] )
-
-    nstructs_to_analyze = set([total_structs])
-    for x in range(10, total_structs):
-        if x % 10 == 0:
-            nstructs_to_analyze.add(x)
-    nstructs_to_analyze = sorted(nstructs_to_analyze)
-
-    all_ddg_scores = []
-    for nstructs in nstructs_to_analyze:
-        ddg_scores = scores.loc[ ((scores['state'] == 'unbound_mut') | (scores['state'] == 'bound_wt')) & (scores['struct_num'] <= nstructs) ].copy()
-        for column in ddg_scores.columns:
-            if column not in ['state', 'case_name', 'backrub_steps', 'struct_num', 'score_function_name']:
-                ddg_scores.loc[:,column] *= -1.0
-        ddg_scores = ddg_scores.append( scores.loc[ ((scores['state'] == 'unbound_wt') | (scores['state'] == 'bound_mut')) & (scores['struct_num'] <= nstructs) ].copy() )
-        ddg_scores = ddg_scores.groupby( ['case_name', 'backrub_steps', 'struct_num', 'score_function_name'] ).sum().reset_index()
-
-        if nstructs == total_structs:
-            struct_scores = ddg_scores.copy()
-
-        ddg_scores = ddg_scores.groupby( ['case_name', 'backrub_steps', 'score_function_name'] ).mean().round(decimals=5).reset_index()
-        new_columns = list(ddg_scores.columns.values)
-        new_columns.remove( 'struct_num' )
-        ddg_scores = ddg_scores[new_columns]
-        ddg_scores[ 'scored_state' ] = 'ddG'
-        ddg_scores[ 'nstruct' ] = nstructs
-        all_ddg_scores.append(ddg_scores)
-
-    return (pd.concat(all_ddg_scores), struct_scores)
-
-def calc_dgs( scores ):
-    l = []
+# Sign applied to each state's scores when summing a struct's states into a ddG or dG
+scored_state_signs = {
+    'ddG' : {
+        'bound_mut' : 1.0,
+        'unbound_wt' : 1.0,
+        'bound_wt' : -1.0,
+        'unbound_mut' : -1.0,
+    },
+    'mut_dG' : {
+        'bound_mut' : 1.0,
+        'unbound_mut' : -1.0,
+    },
+    'wt_dG' : {
+        'bound_wt' : 1.0,
+        'unbound_wt' : -1.0,
+    },
+}
 
-    total_structs = np.max( scores['struct_num'] )
+id_columns = ['state', 'case_name', 'backrub_steps', 'struct_num', 'score_function_name']
+struct_group_columns = ['case_name', 'backrub_steps', 'struct_num', 'score_function_name']
+mean_group_columns = ['case_name', 'backrub_steps', 'score_function_name']
 
+def get_nstructs_to_analyze( total_structs ):
     nstructs_to_analyze = set([total_structs])
     for x in range(10, total_structs):
         if x % 10 == 0:
             nstructs_to_analyze.add(x)
-    nstructs_to_analyze = sorted(nstructs_to_analyze)
+    return sorted(nstructs_to_analyze)
+
+def get_score_columns( scores ):
+    return [ column for column in scores.columns if column not in id_columns ]
+
+def calc_signed_struct_sums( scores, state_signs ):
+    # Sums each struct's states, weighted by +/-1 per state, in a single groupby
+    score_columns = get_score_columns( scores )
+    signs = scores['state'].map( state_signs )
+    in_sum = signs.notna()
+    signed_scores = scores.loc[ in_sum, score_columns ].mul( signs[in_sum], axis = 0 )
+    for column in struct_group_columns:
+        signed_scores[column] = scores.loc[ in_sum, column ]
+    # Negated states are summed first, matching the floating point summation order of the original per-nstruct loop
+    signed_scores = signed_scores.iloc[ np.argsort( signs[in_sum].values, kind = 'stable' ) ]
+    return signed_scores.groupby( struct_group_columns )[score_columns].sum().reset_index()
+
+def calc_prefix_means( struct_sums, nstructs_to_analyze, scored_state ):
+    # Mean over all structs with struct_num <= nstruct, for every nstruct checkpoint at once.
+    # Cumulative sums are taken over struct_num, and each checkpoint picks up the last cumulative
+    # row at or below it, so structs missing from a case are handled the same as a filtered mean.
+    score_columns = get_score_columns( struct_sums )
+    struct_sums = struct_sums.sort_values( mean_group_columns + ['struct_num'] ).reset_index( drop = True )
+    grouped = struct_sums.groupby( mean_group_columns, sort = False )
+    cumulative_sums = grouped[score_columns].cumsum()
+    cumulative_sums['struct_count'] = grouped.cumcount() + 1
+    for column in mean_group_columns + ['struct_num']:
+        cumulative_sums[column] = struct_sums[column]
+
+    checkpoints = struct_sums[mean_group_columns].drop_duplicates().merge(
+        pd.DataFrame( { 'nstruct' : np.array( nstructs_to_analyze, dtype = np.int64 ) } ), how = 'cross'
+    )
+    prefix_means = pd.merge_asof(
+        checkpoints.sort_values( 'nstruct' ),
+        cumulative_sums.astype( { 'struct_num' : np.int64 } ).sort_values( 'struct_num' ),
+        left_on = 'nstruct', right_on = 'struct_num', by = mean_group_columns, direction = 'backward',
+    ).dropna( subset = ['struct_count'] )
+    prefix_means[score_columns] = prefix_means[score_columns].div( prefix_means['struct_count'], axis = 0 ).round(decimals=5)
+    prefix_means = prefix_means.sort_values( ['nstruct'] + mean_group_columns )
+    prefix_means = prefix_means[ mean_group_columns + score_columns + ['nstruct'] ]
+    prefix_means.insert( len(prefix_means.columns) - 1, 'scored_state', scored_state )
+    # Index each nstruct block from zero, as a per-checkpoint groupby/reset_index would
+    prefix_means.index = prefix_means.groupby( 'nstruct' ).cumcount().values
+    return prefix_means
+
+def get_bootstrap_counts( n_values, n_samples = bootstrap_samples, seed = 0 ):
+    # (n_samples x n_values) matrix of how many times each value is drawn in each resampling with replacement, so that
+    # the means of all resamplings of any number of value vectors of this length are a single matrix product.
+    # The draws only depend on seed and n_values, so results do not depend on the order cases are analyzed in.
+    rng = np.random.default_rng( [seed, n_values] )
+    return rng.multinomial( n_values, np.full( n_values, 1.0 / n_values ), size = n_samples ).astype( np.float64 )
+
+def bootstrap_standard_error( values, n_samples = bootstrap_samples, seed = 0 ):
+    # Standard error of the mean of values, estimated as the spread of the means of n_samples resamplings with replacement
+    values = np.asarray( values, dtype = np.float64 )
+    resampled_means = get_bootstrap_counts( len(values), n_samples = n_samples, seed = seed ).dot( values ) / len(values)
+    return resampled_means.std( ddof = 1 )
+
+def calc_bootstrap_means( struct_sums, prefix_means, n_samples = bootstrap_samples, seed = 0 ):
+    # Resampled means of every row of prefix_means (from calc_prefix_means of struct_sums): for each row, the means of
+    # n_samples resamplings of its group's structs with struct_num <= nstruct. Rows with the same number of structs are
+    # resampled together, as one batched matrix product with shared draws (a paired bootstrap over structs).
+    # Returns an (n_rows x n_samples x n_score_columns) array, with the score columns of struct_sums.
+    score_columns = get_score_columns( struct_sums )
+    struct_sums = struct_sums.sort_values( mean_group_columns + ['struct_num'] )
+    group_scores = {
+        group_key : ( group['struct_num'].to_numpy(), group[score_columns].to_numpy( dtype = np.float64 ) )
+        for group_key, group in struct_sums.groupby( mean_group_columns, sort = False )
+    }
+    row_scores = []
+    for row in zip( *( [ prefix_means[column].tolist() for column in mean_group_columns ] + [ prefix_means['nstruct'].tolist() ] ) ):
+        struct_nums, scores = group_scores[ row[:-1] ]
+        row_scores.append( scores[ : np.searchsorted( struct_nums, row[-1], side = 'right' ) ] )
+
+    rows_by_struct_count = collections.defaultdict( list )
+    for i, scores in enumerate( row_scores ):
+        rows_by_struct_count[ len(scores) ].append( i )
+    resampled_means = np.empty( (len(row_scores), n_samples, len(score_columns)) )
+    for struct_count, rows in rows_by_struct_count.items():
+        counts = get_bootstrap_counts( struct_count, n_samples = n_samples, seed = seed )
+        resampled_means[rows] = np.einsum( 'bs,rsc->rbc', counts, np.stack( [ row_scores[i] for i in rows ] ) ) / struct_count
+    return resampled_means
+
+def add_bootstrap_columns( scores, resampled_total_scores ):
+    # Adds the standard error and percentile confidence interval of total_score, from its (n_rows x n_samples) resampled means
+    ci_low, ci_high = np.percentile( resampled_total_scores, bootstrap_ci_percentiles, axis = 1 )
+    scores['total_score_se'] = resampled_total_scores.std( axis = 1, ddof = 1 ).round(decimals=5)
+    scores['total_score_ci_low'] = ci_low.round(decimals=5)
+    scores['total_score_ci_high'] = ci_high.round(decimals=5)
+
+def calc_gam_bootstrap_total_scores( scores, resampled_means, score_columns, gam_param_sets ):
+    # Applies each GAM parameter set to every resampled mean of scores (see calc_bootstrap_means), and returns the
+    # (n_rows x n_samples) resampled total scores of each set, in the order of apply_gam_reweightings
+    n_rows, n_samples = resampled_means.shape[:2]
+    resampled_scores = pd.DataFrame( resampled_means.reshape( n_rows * n_samples, len(score_columns) ), columns = score_columns )
+    resampled_scores['score_function_name'] = np.repeat( scores['score_function_name'].to_numpy(), n_samples )
+    return [
+        reweighted_scores['total_score'].to_numpy().reshape( n_rows, n_samples )
+        for reweighted_scores in apply_gam_reweightings( resampled_scores, gam_param_sets )
+    ]
 
+def calc_ddg( scores ):
+    nstructs_to_analyze = get_nstructs_to_analyze( np.max( scores['struct_num'] ) )
+    struct_scores = calc_signed_struct_sums( scores, scored_state_signs['ddG'] )
+    ddg_scores = calc_prefix_means( struct_scores, nstructs_to_analyze, 'ddG' )
+    return (ddg_scores, struct_scores)
+
+def calc_dgs( scores, n_bootstrap_samples = 0 ):
+    # With n_bootstrap_samples, the bootstrap_columns of total_score are added
+    l = []
+    nstructs_to_analyze = get_nstructs_to_analyze( np.max( scores['struct_num'] ) )
     for state in ['mut', 'wt']:
-        for nstructs in nstructs_to_analyze:
-            dg_scores = scores.loc[ (scores['state'].str.endswith(state)) & (scores['state'].str.startswith('unbound')) & (scores['struct_num'] <= nstructs) ].copy()
-            for column in dg_scores.columns:
-                if column not in ['state', 'case_name', 'backrub_steps', 'struct_num', 'score_function_name']:
-                    dg_scores.loc[:,column] *= -1.0
-            dg_scores = dg_scores.append( scores.loc[ (scores['state'].str.endswith(state)) & (scores['state'].str.startswith('bound')) & (scores['struct_num'] <= nstructs) ].copy() )
-            dg_scores = dg_scores.groupby( ['case_name', 'backrub_steps', 'struct_num', 'score_function_name'] ).sum().reset_index()
-            dg_scores = dg_scores.groupby( ['case_name', 'backrub_steps', 'score_function_name'] ).mean().round(decimals=5).reset_index()
-            new_columns = list(dg_scores.columns.values)
-            new_columns.remove( 'struct_num' )
-            dg_scores = dg_scores[new_columns]
-            dg_scores[ 'scored_state' ] = state + '_dG'
-            dg_scores[ 'nstruct' ] = nstructs
-            l.append( dg_scores )
+        struct_sums = calc_signed_struct_sums( scores, scored_state_signs[state + '_dG'] )
+        dg_scores = calc_prefix_means( struct_sums, nstructs_to_analyze, state + '_dG' )
+        if n_bootstrap_samples > 0:
+            resampled_means = calc_bootstrap_means( struct_sums, dg_scores, n_samples = n_bootstrap_samples )
+            add_bootstrap_columns( dg_scores, resampled_means[ :, :, get_score_columns( struct_sums ).index( 'total_score' ) ] )
+        l.extend( [ dg_scores.loc[ dg_scores['nstruct'] == nstructs ] for nstructs in nstructs_to_analyze if (dg_scores['nstruct'] == nstructs).any() ] )
     return l
 
-def analyze_output_folder( output_folder ):
+def analyze_finished_job( finished_job_and_structs ):
+    # Reads all finished structs of one case and returns its (struct_scores, ddg_scores) frames, and the scores that were
+    # missing from the cache as new cache entries (see process_finished_struct). The cache is only read here, and is
+    # written by the parent process, so that pool workers never wait on each other for the cache's write lock.
+    # Takes a single tuple argument so that it can be mapped over a process pool.
+    finished_job, finished_structs, cache_path, gam_param_sets, n_bootstrap_samples = finished_job_and_structs
+    case_name = os.path.basename(finished_job)
+    new_cache_entries = []
+    with instrumentation.stage( 'read_db3', case_name = case_name, structs = len(finished_structs) ):
+        cache = AnalysisCache( cache_path ) if cache_path != None else None
+        scores = pd.concat( [ process_finished_struct( finished_struct, case_name, cache = cache, new_cache_entries = new_cache_entries ) for finished_struct in finished_structs ] )
+        if cache != None:
+            cache.close()
+    struct_scores, ddg_scores = analyze_case_scores( scores, gam_param_sets, n_bootstrap_samples = n_bootstrap_samples )
+    return ( struct_scores, ddg_scores, new_cache_entries )
+
+def analyze_case_scores( scores, gam_param_sets, n_bootstrap_samples = bootstrap_samples ):
+    # Returns the (struct_scores, ddg_scores) frames of one case's pivoted per-struct scores. With n_bootstrap_samples,
+    # the standard error and confidence interval of each mean total_score (bootstrap_columns) are added to ddg_scores.
+    case_name = scores['case_name'].iloc[0]
+    with instrumentation.stage( 'ddg_aggregation', case_name = case_name, rows = len(scores) ):
+        ddg_scores, struct_scores = calc_ddg( scores )
+    ddg_scores_dfs = [ ddg_scores ]
+    with instrumentation.stage( 'gam_reweighting', case_name = case_name, rows = len(ddg_scores) ):
+        ddg_scores_dfs.extend( apply_gam_reweightings( ddg_scores, gam_param_sets ) )
+    if n_bootstrap_samples > 0:
+        with instrumentation.stage( 'bootstrap', case_name = case_name, rows = len(ddg_scores), samples = n_bootstrap_samples ):
+            score_columns = get_score_columns( struct_scores )
+            resampled_means = calc_bootstrap_means( struct_scores, ddg_scores, n_samples = n_bootstrap_samples )
+            # The GAM rows are computed first, so that they do not copy the bootstrap columns of the unweighted rows
+            for gam_scores, resampled_total_scores in zip( ddg_scores_dfs[1:], calc_gam_bootstrap_total_scores( ddg_scores, resampled_means, score_columns, gam_param_sets ) ):
+                add_bootstrap_columns( gam_scores, resampled_total_scores )
+            add_bootstrap_columns( ddg_scores, resampled_means[ :, :, score_columns.index( 'total_score' ) ] )
+    with instrumentation.stage( 'dg_aggregation', case_name = case_name, rows = len(scores) ):
+        ddg_scores_dfs.extend( calc_dgs( scores, n_bootstrap_samples = n_bootstrap_samples ) )
+    return ( struct_scores, pd.concat( ddg_scores_dfs ) )
+
+output_formats = ['csv', 'parquet', 'feather']
+categorical_columns = ['case_name', 'state', 'scored_state', 'score_function_name']
+columnar_rows_per_file = 1000000 # Rows buffered before a Parquet part file is written
+
+class CSVResultsWriter:
+    # Writes each case's rows to a results csv as they arrive, writing the header only for the first case
+    def __init__( self, path ):
+        self.f = open( path + '.csv', 'w' )
+        self.columns = []
+
+    def write( self, df ):
+        if len(self.columns) == 0:
+            self.columns.extend( df.columns )
+            df.to_csv( self.f )
+        else:
+            if set(df.columns) != set(self.columns):
+                raise Exception( 'Score columns of case %s do not match those of earlier cases' % df['case_name'].iloc[0] )
+            df[self.columns].to_csv( self.f, header = False )
+
+    def close( self ):
+        self.f.close()
+
+def to_columnar_frame( df, use_float32 = False ):
+    # Drops the (meaningless) index, stores repeated string columns as categoricals, and optionally stores scores as float32
+    df = df.reset_index( drop = True )
+    for column in categorical_columns:
+        if column in df.columns:
+            df[column] = df[column].astype( 'category' )
+    if use_float32:
+        float_columns = [ column for column in df.columns if df[column].dtype == np.float64 ]
+        df[float_columns] = df[float_columns].astype( np.float32 )
+    return df
+
+class ColumnarResultsWriter:
+    # Writes results as Parquet or Feather. Parquet results are written as a dataset directory, in part files of up to
+    # columnar_rows_per_file rows, so that memory use stays bounded; with partition_column (such as scored_state) a
+    # hive-style partition directory is written per value, so that readers can skip partitions they filter out.
+    # Feather does not support appending, so Feather results are collected and written as a single file when closed.
+    def __init__( self, path, output_format, partition_column = None, use_float32 = False ):
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception( 'pyarrow is required for %s output, and can be installed with "pip install pyarrow"' % output_format )
+        self.path = path + '.' + output_format
+        self.output_format = output_format
+        self.partition_column = partition_column
+        self.use_float32 = use_float32
+        self.buffered_dfs = []
+        self.buffered_rows = 0
+        self.part_number = 0
+        if output_format == 'parquet':
+            if os.path.isdir( self.path ):
+                shutil.rmtree( self.path )
+            os.makedirs( self.path )
+
+    def write( self, df ):
+        self.buffered_dfs.append( df )
+        self.buffered_rows += len(df)
+        if self.output_format == 'parquet' and self.buffered_rows >= columnar_rows_per_file:
+            self.flush()
+
+    def flush( self ):
+        if len(self.buffered_dfs) == 0:
+            return
+        df = to_columnar_frame( pd.concat( self.buffered_dfs ), use_float32 = self.use_float32 )
+        if self.output_format == 'parquet' and self.partition_column:
+            df.to_parquet( self.path, index = False, partition_cols = [self.partition_column], basename_template = 'part-%05d-{i}.parquet' % self.part_number )
+            self.part_number += 1
+        elif self.output_format == 'parquet':
+            df.to_parquet( os.path.join( self.path, 'part-%05d.parquet' % self.part_number ), index = False )
+            self.part_number += 1
+        else:
+            df.to_feather( self.path )
+        self.buffered_dfs = []
+        self.buffered_rows = 0
+
+    def close( self ):
+        self.flush()
+
+def make_results_writer( path, output_format = 'csv', partition_column = None, use_float32 = False ):
+    # path is the output path without a file extension
+    if output_format == 'csv':
+        return CSVResultsWriter( path )
+    return ColumnarResultsWriter( path, output_format, partition_column = partition_column, use_float32 = use_float32 )
+
+def imap_bounded( pool, function, iterable, max_in_flight ):
+    # Like pool.imap, in order, but only keeps max_in_flight tasks submitted ahead of the result being consumed, so
+    # that results which finish out of order do not pile up in the parent
+    in_flight = collections.deque()
+    for args in iterable:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().get()
+        in_flight.append( pool.apply_async( function, (args,) ) )
+    while len(in_flight) > 0:
+        yield in_flight.popleft().get()
+
+def analyze_output_folder( output_folder, jobs = 1, use_cache = True, extra_gam_param_sets = None, output_format = 'csv', use_float32 = False, n_bootstrap_samples = bootstrap_samples ):
     # Pass in an outer output folder. Subdirectories are considered different mutation cases, with subdirectories of different structures.
-    finished_jobs = find_finished_jobs( output_folder )
+    # Cases are analyzed as their db3 files are read (across "jobs" processes if jobs > 1), and each case's results are
+    # written out as soon as it is finished, so that only a single case's scores need to be held in memory at once.
+    # With use_cache, scores of unchanged ddG.db3 files are read from the analysis cache instead of being re-queried.
+    # Structs are numbered by backrub steps using the trajectory stride recorded in the folder (see read_trajectory_stride).
+    # ddG scores are reweighted with the Zemu GAM, and with any extra_gam_param_sets (see load_gam_param_sets).
+    # Results are written as output_format (one of output_formats); Parquet results are partitioned by scored_state.
+    # Mean total scores get bootstrap standard errors and confidence intervals from n_bootstrap_samples resamplings (0 to skip).
+    set_trajectory_stride( read_trajectory_stride( output_folder ) )
+    cache_path = get_analysis_cache_path() if use_cache else None
+    cache = AnalysisCache( cache_path ) if use_cache else None
+    with instrumentation.stage( 'find_finished_jobs', output_folder = output_folder ):
+        finished_jobs = find_finished_jobs( output_folder )
+    gam_param_sets = get_gam_param_sets( extra_gam_param_sets )
+    finished_jobs = [ (finished_job, finished_structs, cache_path, gam_param_sets, n_bootstrap_samples) for finished_job, finished_structs in finished_jobs.items() if len(finished_structs) > 0 ]
     if len(finished_jobs) == 0:
+        if cache != None:
+            cache.close()
         print( 'No finished jobs found' )
         return
 
-    ddg_scores_dfs = []
-    struct_scores_dfs = []
-    for finished_job, finished_structs in finished_jobs.items():
-        inner_scores_list = []
-        for finished_struct in finished_structs:
-            inner_scores = process_finished_struct( finished_struct, os.path.basename(finished_job) )
-            inner_scores_list.append( inner_scores )
-        scores = pd.concat( inner_scores_list )
-        ddg_scores, struct_scores = calc_ddg( scores )
-        struct_scores_dfs.append( struct_scores )
-        ddg_scores_dfs.append( ddg_scores )
-        ddg_scores_dfs.append( apply_zemu_gam(ddg_scores) )
-        ddg_scores_dfs.extend( calc_dgs( scores ) )
-
     if not os.path.isdir(script_output_folder):
         os.makedirs(script_output_folder)
     basename = os.path.basename(output_folder)
 
-    pd.concat( struct_scores_dfs ).to_csv( os.path.join(script_output_folder, basename + '-struct_scores_results.csv' ) )
-
-    df = pd.concat( ddg_scores_dfs )
-    df.to_csv( os.path.join(script_output_folder, basename + '-results.csv') )
-
     display_columns = ['backrub_steps', 'case_name', 'nstruct', 'score_function_name', 'scored_state', 'total_score']
-    for score_type in ['mut_dG', 'wt_dG', 'ddG']:
+    display_rows = 20
+    display_dfs = collections.OrderedDict( [ (score_type, []) for score_type in ['mut_dG', 'wt_dG', 'ddG'] ] )
+
+    pool = None
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool( processes = jobs, initializer = set_trajectory_stride, initargs = (trajectory_stride,) )
+            analyzed_jobs = imap_bounded( pool, analyze_finished_job, finished_jobs, jobs * cases_in_flight_per_job )
+        else:
+            analyzed_jobs = map( analyze_finished_job, finished_jobs )
+
+        struct_scores_writer = make_results_writer( os.path.join(script_output_folder, basename + '-struct_scores_results'), output_format = output_format, use_float32 = use_float32 )
+        ddg_scores_writer = make_results_writer( os.path.join(script_output_folder, basename + '-results'), output_format = output_format, partition_column = 'scored_state', use_float32 = use_float32 )
+        for struct_scores, ddg_scores, new_cache_entries in analyzed_jobs:
+            with instrumentation.stage( 'write_results', case_name = ddg_scores['case_name'].iloc[0], output_format = output_format ):
+                struct_scores_writer.write( struct_scores )
+                ddg_scores_writer.write( ddg_scores )
+                if cache != None:
+                    # Committed per case, so the write lock is only held briefly while workers read the cache
+                    for db3_file, scores, fingerprint in new_cache_entries:
+                        cache.put_scores( db3_file, scores, fingerprint = fingerprint )
+                    cache.commit()
+            for score_type, display_df_list in display_dfs.items():
+                rows_needed = display_rows - sum( [ len(display_df) for display_df in display_df_list ] )
+                if rows_needed > 0:
+                    display_df_list.append( ddg_scores.loc[ ddg_scores['scored_state'] == score_type ][display_columns].head( n = rows_needed ) )
+        with instrumentation.stage( 'write_results', output_format = output_format ):
+            struct_scores_writer.close()
+            ddg_scores_writer.close()
+    finally:
+        # Also reaps the workers if writing the results fails
+        if pool != None:
+            pool.close()
+            pool.join()
+        if cache != None:
+            cache.close()
+
+    for score_type, display_df_list in display_dfs.items():
         print( score_type )
-        print( df.loc[ df['scored_state'] == score_type ][display_columns].head( n = 20 ) )
+        print( pd.concat( display_df_list ) )
         print( '' )
 
 if __name__ == '__main__':
-    for folder_to_analyze in sys.argv[1:]:
+    parser = argparse.ArgumentParser( description = 'Analyze flex ddG output folders' )
+    parser.add_argument( 'folders', nargs = '*', help = 'Output folder(s) to analyze. Subdirectories are mutation cases, each with one subdirectory per struct.' )
+    parser.add_argument( '--jobs', type = int, default = 1, help = 'Number of processes used to read ddG.db3 files and analyze cases (default: 1)' )
+    parser.add_argument( '--no-cache', dest = 'use_cache', action = 'store_false', help = 'Do not read or update the analysis cache of per-struct scores in %s' % os.path.join( script_output_folder, analysis_cache_file_name ) )
+    parser.add_argument( '--evict-stale-cache', action = 'store_true', help = 'Remove cached scores of ddG.db3 files that no longer exist or have changed' )
+    parser.add_argument( '--gam-params', help = 'JSON file of additional GAM parameter sets to reweight ddG scores with, as { "set_name" : { "score_term" : [ log scale, log slope ], ... }, ... }' )
+    parser.add_argument( '--output-format', choices = output_formats, default = 'csv', help = 'Format to write results in (default: csv). Parquet and Feather output require pyarrow.' )
+    parser.add_argument( '--float32', action = 'store_true', help = 'Store scores as float32 in Parquet and Feather output' )
+    parser.add_argument( '--bootstrap-samples', type = int, default = bootstrap_samples, help = 'Resamplings of each case\'s structs used for the standard error and 95%% confidence interval columns of total_score (default: %d, 0 to leave them out)' % bootstrap_samples )
+    instrumentation.add_arguments( parser )
+    args = parser.parse_args()
+    instrumentation.configure_from_args( args )
+    extra_gam_param_sets = load_gam_param_sets( args.gam_params ) if args.gam_params else None
+    if args.evict_stale_cache:
+        cache = AnalysisCache( get_analysis_cache_path() )
+        print( 'Evicted %d stale entries from the analysis cache' % cache.evict_stale() )
+        cache.close()
+    for folder_to_analyze in args.folders:
         if os.path.isdir( folder_to_analyze ):
-            analyze_output_folder( folder_to_analyze )
+            analyze_output_folder(
+                folder_to_analyze, jobs = args.jobs, use_cache = args.use_cache, extra_gam_param_sets = extra_gam_param_sets,
+                output_format = args.output_format, use_float32 = args.float32, n_bootstrap_samples = args.bootstrap_samples,
+            )
@@ -0,0 +1,189 @@
+# Launches Rosetta subprocesses from a single asyncio event loop, rather than polling them one by one, so that one
+# launcher process can manage hundreds of rosetta_scripts children. Each run can be given a wall-clock timeout, after
+# which it is terminated, and the exit code of every run is recorded in the run journal and instrumentation log.
+#
+# Rosetta's output is streamed through a filter as it is written: the complete log is gzip compressed to
+# rosetta.out.gz, and only the lines that analyze_flex_ddG.rosetta_output_succeeded looks for (the
+# protocols.jd2.JobDistributor lines) and error lines are kept uncompressed in rosetta.out. With a scratch directory,
+# both logs are written there and copied back with the rest of Rosetta's output.
+#
+# Each run is waited for with os.wait4 on a thread of its own, so that its CPU time and peak memory are recorded in the
+# instrumentation log, as for the runs of job_scheduler.MemoryAwareScheduler.
+
+from __future__ import print_function
+
+import os
+import re
+import gzip
+import time
+import asyncio
+import tempfile
+import subprocess
+import concurrent.futures
+
+from instrumentation import record_process_exit, wait_for_process
+from job_scheduler import get_cpu_count, copy_back_from_scratch, remove_previous_run_output, completion_marker_file_name
+
+kept_log_line_pattern = re.compile( br'^(?:protocols\.jd2\.JobDistributor.*|.*(?:ERROR|[Ee]xception).*)$', re.MULTILINE )
+log_read_size = 64 * 1024 # Bytes of Rosetta output read at a time
+log_compression_level = 6
+termination_grace_seconds = 30 # After a run times out, seconds between asking it to terminate and killing it
+
+class RosettaLogFilter:
+    # Writes all of Rosetta's output to log_file_name.gz, and the kept lines (see kept_log_line_pattern) to log_file_name
+    def __init__( self, output_directory, log_file_name ):
+        self.kept_log = open( os.path.join( output_directory, log_file_name ), 'wb' )
+        self.compressed_log = gzip.open( os.path.join( output_directory, log_file_name + '.gz' ), 'wb', compresslevel = log_compression_level )
+        self.partial_line = b''
+
+    def write_kept_lines( self, lines ):
+        for match in kept_log_line_pattern.finditer( lines ):
+            self.kept_log.write( match.group(0) + b'\n' )
+
+    def write( self, data ):
+        self.compressed_log.write( data )
+        # Only complete lines are filtered; the rest of the last line is kept until its newline is read
+        last_newline = data.rfind( b'\n' )
+        if last_newline < 0:
+            self.partial_line += data
+            return
+        self.write_kept_lines( self.partial_line + data[ : last_newline ] )
+        self.partial_line = data[ last_newline + 1 : ]
+
+    def close( self ):
+        if len(self.partial_line) > 0:
+            self.write_kept_lines( self.partial_line )
+        self.kept_log.close()
+        self.compressed_log.close()
+
+async def copy_output( stream, log_filter ):
+    while True:
+        data = await stream.read( log_read_size )
+        if len(data) == 0:
+            break
+        log_filter.write( data )
+
+class AsyncLauncher:
+    # Each job is a (get_job_function, args) pair. get_job_function(*args) must return (Rosetta args, output directory),
+    # and Rosetta is run in the output directory (or, with scratch_dir, in a new directory there whose contents are
+    # copied back once Rosetta exits, as for job_scheduler.start_rosetta_process). At most max_processes runs are
+    # started at once, and runs still going after timeout seconds are terminated. A run that raises, for example when its
+    # get_job_function can not find its inputs, is recorded as failed without stopping the other runs; its journal entry
+    # is under get_output_directory(*args), if given.
+    def __init__( self, max_processes = None, timeout = None, journal = None, scratch_dir = None, completion_marker_file_name = completion_marker_file_name, log_file_name = 'rosetta.out', get_output_directory = None ):
+        self.max_processes = max_processes or get_cpu_count()
+        self.get_output_directory = get_output_directory
+        self.timeout = timeout
+        self.journal = journal
+        self.scratch_dir = scratch_dir
+        self.completion_marker_file_name = completion_marker_file_name
+        self.log_file_name = log_file_name
+        self.timed_out = [] # Output directories of runs that were terminated after timing out
+
+    def record( self, event, output_directory, returncode = None ):
+        if self.journal != None:
+            self.journal.record( event, output_directory, returncode )
+
+    async def stop_process( self, process, exited ):
+        # exited is the future of the run's wait_for_process, whose (returncode, rusage) is returned once it has exited
+        process.terminate()
+        try:
+            return await asyncio.wait_for( asyncio.shield( exited ), termination_grace_seconds )
+        except asyncio.TimeoutError:
+            process.kill()
+            return await exited
+
+    async def run_job( self, get_job_function, args ):
+        # Returns the returncode of the run, or None if the run raised, Rosetta could not be started or its output could not be copied back
+        async with self.slots:
+            try:
+                return await self.run_rosetta( get_job_function, args )
+            except Exception as e:
+                output_directory = self.get_output_directory( *args ) if self.get_output_directory != None else None
+                print( 'ERROR: run %s failed: %s: %s' % (output_directory or repr(args), type(e).__name__, e) )
+                if output_directory != None:
+                    self.record( 'failed', output_directory )
+                return None
+
+    async def run_rosetta( self, get_job_function, args ):
+        rosetta_args, output_directory = get_job_function( *args )
+        print( 'Output logged to:', os.path.abspath( os.path.join( output_directory, self.log_file_name + '.gz' ) ) )
+        print()
+        remove_previous_run_output( output_directory, self.completion_marker_file_name, self.log_file_name )
+
+        working_directory = output_directory
+        if self.scratch_dir != None:
+            if not os.path.isdir( self.scratch_dir ):
+                os.makedirs( self.scratch_dir )
+            working_directory = tempfile.mkdtemp( prefix = 'flex_ddG_', dir = self.scratch_dir )
+
+        self.record( 'started', output_directory )
+        start_time = time.time()
+        log_filter = RosettaLogFilter( working_directory, self.log_file_name )
+        try:
+            process = subprocess.Popen( rosetta_args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, close_fds = True, cwd = working_directory )
+        except OSError as e:
+            log_filter.close()
+            print( 'ERROR: could not start Rosetta for %s: %s' % (output_directory, e) )
+            self.record( 'failed', output_directory )
+            return None
+
+        loop = asyncio.get_running_loop()
+        exited = loop.run_in_executor( self.waiters, wait_for_process, process )
+        timed_out = False
+        try:
+            stdout = asyncio.StreamReader()
+            await loop.connect_read_pipe( lambda: asyncio.StreamReaderProtocol( stdout ), process.stdout )
+            output_copied = asyncio.ensure_future( copy_output( stdout, log_filter ) )
+            try:
+                returncode, rusage = await asyncio.wait_for( asyncio.shield( exited ), self.timeout )
+            except asyncio.TimeoutError:
+                timed_out = True
+                print( 'ERROR: %s timed out after %d seconds, terminating' % (output_directory, self.timeout) )
+                returncode, rusage = await self.stop_process( process, exited )
+            await output_copied
+        except BaseException:
+            # Rosetta is not left running, or unreaped, if reading its output fails or the launcher is cancelled
+            if not exited.done():
+                process.kill()
+                await asyncio.shield( exited )
+            raise
+        finally:
+            log_filter.close()
+        record_process_exit(
+            'rosetta', start_time, rusage, job = getattr( get_job_function, '__name__', str(get_job_function) ),
+            args = [ str(arg) for arg in args ], returncode = returncode, timed_out = timed_out,
+        )
+
+        if self.scratch_dir != None:
+            # Copied back on failure as well, to keep the logs and any partial output
+            try:
+                await loop.run_in_executor( None, copy_back_from_scratch, working_directory, output_directory )
+            except OSError as e:
+                print( 'ERROR: could not copy the output of %s back from %s (%s), leaving it there' % (output_directory, working_directory, e) )
+                self.record( 'failed', output_directory, returncode )
+                return None
+        if returncode == 0 and not timed_out:
+            with open( os.path.join( output_directory, self.completion_marker_file_name ), 'w' ) as f:
+                f.write( 'returncode %d\n' % returncode )
+
+        if timed_out:
+            self.timed_out.append( output_directory )
+            self.record( 'timeout', output_directory, returncode )
+        else:
+            self.record( 'finished' if returncode == 0 else 'failed', output_directory, returncode )
+        return returncode
+
+    async def run_jobs( self, jobs ):
+        self.slots = asyncio.Semaphore( self.max_processes )
+        # One thread per running process, each blocked in os.wait4 until its process exits
+        with concurrent.futures.ThreadPoolExecutor( max_workers = self.max_processes ) as self.waiters:
+            return await asyncio.gather( *[ self.run_job( get_job_function, args ) for get_job_function, args in jobs ] )
+
+    def run( self, jobs ):
+        # Runs all jobs, and returns their returncodes in the same order
+        return asyncio.run( self.run_jobs( jobs ) )
+
+    def print_summary( self, returncodes ):
+        succeeded = len( [ returncode for returncode in returncodes if returncode == 0 ] )
+        print( '%d runs succeeded, %d failed (%d of them timed out)' % (succeeded, len(returncodes) - succeeded, len(self.timed_out)) )
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# Benchmarks the stages of analyze_flex_ddG.py on a synthetic output tree, so that changes to analysis performance
+# can be measured without a Rosetta install. The tree has the same layout as the run_example scripts' output:
+# <cases> case directories with <structs> struct directories each, holding a rosetta.out with the JobDistributor
+# success lines and a ddG.db3 with <checkpoints> backrub checkpoints of the four interface_ddG states.
+#
+# Each stage is timed separately (wall and CPU time, rows processed per second, and peak memory allocated during the
+# stage, as traced by tracemalloc), and the best of --repeat runs is reported.
+
+import os
+import time
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+
+import pandas as pd
+
+import analyze_flex_ddG
+from analyze_flex_ddG import (
+    rosetta_output_file_name, output_database_name,
+    find_finished_jobs, get_scores_from_db3_file, calc_ddg, calc_dgs, apply_zemu_gam, calc_bootstrap_means, bootstrap_samples,
+)
+
+# Talaris2014 score terms, as written to the score_types table by the ReportToDB mover in ddG-backrub.xml
+synthetic_score_terms = [
+    'dslf_fa13', 'fa_atr', 'fa_dun', 'fa_elec', 'fa_intra_rep', 'fa_rep', 'fa_sol', 'hbond_bb_sc', 'hbond_lr_bb',
+    'hbond_sc', 'hbond_sr_bb', 'omega', 'p_aa_pp', 'pro_close', 'rama', 'ref', 'yhh_planarity',
+]
+synthetic_states = ['bound_wt', 'unbound_wt', 'bound_mut', 'unbound_mut']
+synthetic_score_function_name = 'talaris2014'
+
+def write_synthetic_ddg_db3( db3_path, n_checkpoints, rng ):
+    # One batch per state, each with its own score_types and score function rows, and one structure per batch per
+    # checkpoint, numbered in the order Rosetta writes them (all batches of a checkpoint before the next checkpoint)
+    conn = sqlite3.connect( db3_path )
+    conn.executescript( '''
+    CREATE TABLE batches ( batch_id INTEGER PRIMARY KEY, protocol_id INTEGER, name TEXT, description TEXT );
+    CREATE TABLE score_types ( batch_id INTEGER, score_type_id INTEGER, score_type_name TEXT, PRIMARY KEY (batch_id, score_type_id) );
+    CREATE TABLE score_function_method_options ( batch_id INTEGER, score_function_name TEXT, PRIMARY KEY (batch_id, score_function_name) );
+    CREATE TABLE structure_scores ( batch_id INTEGER, struct_id INTEGER, score_type_id INTEGER, score_value REAL, PRIMARY KEY (batch_id, struct_id, score_type_id) );
+    ''' )
+    score_type_names = synthetic_score_terms + ['total_score']
+    for batch_id, state in enumerate( synthetic_states, 1 ):
+        conn.execute( 'INSERT INTO batches VALUES (?, 1, ?, ?)', (batch_id, state + '_dbreport', 'interface_ddG') )
+        conn.execute( 'INSERT INTO score_function_method_options VALUES (?, ?)', (batch_id, synthetic_score_function_name) )
+        conn.executemany( 'INSERT INTO score_types VALUES (?, ?, ?)', [ (batch_id, score_type_id, name) for score_type_id, name in enumerate( score_type_names, 1 ) ] )
+
+    rows = []
+    struct_id = 0
+    for checkpoint in range( n_checkpoints ):
+        for batch_id in range( 1, len(synthetic_states) + 1 ):
+            struct_id += 1
+            term_scores = [ rng.gauss( -20.0, 15.0 ) for score_term in synthetic_score_terms ]
+            rows.extend( [ (batch_id, struct_id, score_type_id, score) for score_type_id, score in enumerate( term_scores + [sum(term_scores)], 1 ) ] )
+    conn.executemany( 'INSERT INTO structure_scores VALUES (?, ?, ?, ?)', rows )
+    conn.commit()
+    conn.close()
+
+def write_synthetic_rosetta_output( output_path, n_log_lines, rng ):
+    with open( output_path, 'w' ) as f:
+        f.write( 'core.init: Rosetta version: synthetic benchmark output\n' )
+        for i in range( n_log_lines ):
+            f.write( 'protocols.backrub.BackrubMover: Accepted move %d, score %.3f\n' % (i, rng.gauss( -500.0, 5.0 )) )
+        f.write( 'protocols.jd2.JobDistributor: 1JTG_AB_0001 reported success in %d seconds\n' % rng.randint( 100, 1000 ) )
+        f.write( 'protocols.jd2.JobDistributor: no more batches to process...\n' )
+        f.write( 'protocols.jd2.JobDistributor: 1 jobs considered, 1 jobs attempted in 1000 seconds\n' )
+
+def make_synthetic_output_tree( output_folder, n_cases, n_structs, n_checkpoints, n_log_lines = 1000, seed = 0 ):
+    rng = random.Random( seed )
+    for case_i in range( n_cases ):
+        for struct_num in range( 1, n_structs + 1 ):
+            struct_dir = os.path.join( output_folder, 'case%05d' % case_i, '%02d' % struct_num )
+            os.makedirs( struct_dir )
+            write_synthetic_ddg_db3( os.path.join( struct_dir, output_database_name ), n_checkpoints, rng )
+            write_synthetic_rosetta_output( os.path.join( struct_dir, rosetta_output_file_name ), n_log_lines, rng )
+
+def time_stage( function ):
+    # Returns (result, wall seconds, CPU seconds, peak traced bytes) of function()
+    tracemalloc.start()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = function()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ( result, wall, cpu, peak )
+
+def run_benchmark( output_folder ):
+    # Returns a list of (stage, rows, row unit, wall seconds, CPU seconds, peak bytes)
+    results = []
+
+    finished_jobs, wall, cpu, peak = time_stage( lambda: find_finished_jobs( output_folder ) )
+    n_structs = sum( [ len(finished_structs) for finished_structs in finished_jobs.values() ] )
+    results.append( ('find_finished_jobs', n_structs, 'structs', wall, cpu, peak) )
+
+    def read_all_scores():
+        return [
+            pd.concat( [
+                get_scores_from_db3_file( os.path.join( struct_dir, output_database_name ), int( os.path.basename(struct_dir) ), os.path.basename(case_dir) )
+                for struct_dir in finished_structs
+            ] )
+            for case_dir, finished_structs in sorted( finished_jobs.items() )
+        ]
+    case_scores, wall, cpu, peak = time_stage( read_all_scores )
+    n_score_rows = sum( [ len(scores) * len( analyze_flex_ddG.get_score_columns(scores) ) for scores in case_scores ] )
+    results.append( ('get_scores_from_db3_file', n_score_rows, 'scores', wall, cpu, peak) )
+
+    n_rows = sum( [ len(scores) for scores in case_scores ] )
+    ddg_results, wall, cpu, peak = time_stage( lambda: [ calc_ddg( scores ) for scores in case_scores ] )
+    results.append( ('calc_ddg', n_rows, 'rows', wall, cpu, peak) )
+
+    dg_results, wall, cpu, peak = time_stage( lambda: [ calc_dgs( scores ) for scores in case_scores ] )
+    results.append( ('calc_dgs', n_rows, 'rows', wall, cpu, peak) )
+
+    n_ddg_rows = sum( [ len(ddg_scores) for ddg_scores, struct_scores in ddg_results ] )
+    gam_results, wall, cpu, peak = time_stage( lambda: [ apply_zemu_gam( ddg_scores ) for ddg_scores, struct_scores in ddg_results ] )
+    results.append( ('apply_zemu_gam', n_ddg_rows, 'rows', wall, cpu, peak) )
+
+    # Rows here are resampled means (ddG rows x samples), which the bootstrap's run time is linear in
+    bootstrap_results, wall, cpu, peak = time_stage( lambda: [ calc_bootstrap_means( struct_scores, ddg_scores ) for ddg_scores, struct_scores in ddg_results ] )
+    results.append( ('calc_bootstrap_means', n_ddg_rows * bootstrap_samples, 'samples', wall, cpu, peak) )
+
+    return results
+
+def best_of( runs ):
+    # Keeps the fastest wall time of each stage over several runs, and the largest peak memory
+    best = []
+    for stage_runs in zip( *runs ):
+        fastest = min( stage_runs, key = lambda result: result[3] )
+        best.append( fastest[:5] + ( max( [ result[5] for result in stage_runs ] ), ) )
+    return best
+
+def print_results( results ):
+    print( '%-26s %12s %-8s %10s %10s %14s %12s' % ('stage', 'rows', '', 'wall (s)', 'cpu (s)', 'rows/s', 'peak (MB)') )
+    for stage, rows, row_unit, wall, cpu, peak in results:
+        print( '%-26s %12d %-8s %10.3f %10.3f %14.0f %12.1f' % (stage, rows, row_unit, wall, cpu, rows / wall if wall > 0 else float('inf'), peak / 1024.0 ** 2) )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'Time the stages of analyze_flex_ddG.py on a synthetic flex ddG output tree' )
+    parser.add_argument( '--cases', type = int, default = 20, help = 'Number of mutation cases (default: 20)' )
+    parser.add_argument( '--structs', type = int, default = 35, help = 'Number of structs (nstruct) per case (default: 35)' )
+    parser.add_argument( '--checkpoints', type = int, default = 5, help = 'Number of backrub trajectory stride checkpoints per struct (default: 5)' )
+    parser.add_argument( '--log-lines', type = int, default = 1000, help = 'Number of lines of Rosetta output before the JobDistributor lines (default: 1000)' )
+    parser.add_argument( '--repeat', type = int, default = 3, help = 'Number of times to run each stage; the fastest run is reported (default: 3)' )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    parser.add_argument( '--tree', help = 'Directory to write the synthetic output tree to, and keep it in. If it already exists, it is reused as is. By default a temporary directory is used.' )
+    parser.add_argument( '--json', help = 'Also write the results to this JSON file, to compare against later runs' )
+    args = parser.parse_args()
+
+    temporary_dir = None
+    if args.tree:
+        output_folder = args.tree
+    else:
+        temporary_dir = tempfile.mkdtemp( prefix = 'flex_ddG_benchmark_' )
+        output_folder = os.path.join( temporary_dir, 'output' )
+
+    try:
+        if not os.path.isdir( output_folder ):
+            print( 'Writing synthetic output tree of %d cases x %d structs x %d checkpoints to %s' % (args.cases, args.structs, args.checkpoints, output_folder) )
+            start = time.perf_counter()
+            make_synthetic_output_tree( output_folder, args.cases, args.structs, args.checkpoints, n_log_lines = args.log_lines, seed = args.seed )
+            print( 'Done in %.1f seconds\n' % (time.perf_counter() - start) )
+        results = best_of( [ run_benchmark( output_folder ) for i in range( args.repeat ) ] )
+    finally:
+        if temporary_dir != None:
+            shutil.rmtree( temporary_dir )
+
+    print_results( results )
+    if args.json:
+        with open( args.json, 'w' ) as f:
+            json.dump( {
+                'tree' : { 'cases' : args.cases, 'structs' : args.structs, 'checkpoints' : args.checkpoints, 'log_lines' : args.log_lines },
+                'stages' : [
+                    { 'stage' : stage, 'rows' : rows, 'row_unit' : row_unit, 'wall_seconds' : wall, 'cpu_seconds' : cpu, 'peak_bytes' : peak }
+                    for stage, rows, row_unit, wall, cpu, peak in results
+                ],
+            }, f, indent = 2 )
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Gathers the heavy atom coordinates of every pose in the struct.db3 files of a case into one contiguous
+# n_poses x n_atoms x 3 float32 array, saved as a .npy file that is opened memory-mapped, so that ensemble-wide
+# analyses (RMSD to the input structure, interface contacts, drift over the backrub checkpoints) can be run with
+# vectorized NumPy operations instead of by writing and re-parsing thousands of PDB files.
+#
+# Each case is stored in <store dir> as:
+#   <case>.coords.npy   Coordinates, one row per pose. Atoms that a pose does not have are NaN.
+#   <case>.poses.tsv    The (state, struct_num, backrub_steps) of each row
+#   <case>.atoms.tsv    The (chain, resi, icode, name3, atom_name) of each atom column
+# The atom columns are the union of the heavy atoms of every pose, grouped by residue. At mutated positions,
+# the columns of both the wild type and mutant side chains are included, and name3 is that of the first pose read.
+
+import os
+import csv
+import sqlite3
+import argparse
+import collections
+
+import numpy as np
+
+from extract_structures import struct_db3_file, recursive_find_struct_dbs, get_struct_db_case, get_heavy_atom_names, iter_pose_residues, flex_ddG_state, get_trajectory_stride
+
+default_store_folder = 'ensemble_store'
+coordinates_suffix = '.coords.npy'
+poses_suffix = '.poses.tsv'
+atoms_suffix = '.atoms.tsv'
+pose_dtype = np.dtype( [ ('state', 'U16'), ('struct_num', 'i4'), ('backrub_steps', 'i4') ] )
+atom_dtype = np.dtype( [ ('chain', 'U4'), ('resi', 'i4'), ('icode', 'U1'), ('name3', 'U3'), ('atom_name', 'U4') ] )
+pose_chunk_size = 64 # Poses processed at a time by the analysis functions, to bound their temporary memory
+contact_chunk_elements = 8 * 1024 ** 2 # Atom pair distances computed at a time by contact_maps
+default_contact_distance = 4.5 # Angstroms between heavy atoms
+
+def get_store_paths( store_folder, case_name ):
+    prefix = os.path.join( store_folder, case_name )
+    return ( prefix + coordinates_suffix, prefix + poses_suffix, prefix + atoms_suffix )
+
+def get_case_struct_dbs( output_folder ):
+    # case name -> sorted [(struct_num, struct.db3 path)]
+    case_struct_dbs = collections.defaultdict( list )
+    for struct_db in recursive_find_struct_dbs( output_folder ):
+        if get_struct_db_case( struct_db ) == None:
+            print( 'Skipping %s, which is not in a <case name>/<struct number> directory' % struct_db )
+            continue
+        case_name, struct_num = get_struct_db_case( struct_db )
+        case_struct_dbs[case_name].append( (struct_num, struct_db) )
+    return { case_name : sorted( struct_dbs ) for case_name, struct_dbs in case_struct_dbs.items() }
+
+def get_atom_columns( struct_dbs ):
+    # Returns the atom_dtype array of the union of the heavy atoms of every pose, read from the residue types in each
+    # struct.db3 rather than from the coordinates. Residues are kept in the order they are first seen.
+    residue_atom_names = collections.OrderedDict() # (chain, resi, icode) -> [name3, [atom names]]
+    for struct_num, struct_db in struct_dbs:
+        conn = sqlite3.connect( struct_db )
+        try:
+            residues = conn.execute( '''
+            SELECT DISTINCT residues.resNum, residues.name3, residues.res_type, residue_pdb_identification.chain_id,
+                residue_pdb_identification.pdb_residue_number, residue_pdb_identification.insertion_code
+            FROM residues
+            INNER JOIN residue_pdb_identification ON residue_pdb_identification.struct_id=residues.struct_id AND residue_pdb_identification.residue_number=residues.resNum
+            ORDER BY residues.resNum
+            ''' ).fetchall()
+        finally:
+            conn.close()
+        for resNum, name3, res_type, chain, resi, icode in residues:
+            residue = residue_atom_names.setdefault( (chain, resi, icode.strip()), [name3, []] )
+            residue[1].extend( [ atom_name for atom_name in get_heavy_atom_names( name3, res_type ) if atom_name not in residue[1] ] )
+    return np.array( [
+        (chain, resi, icode, name3, atom_name)
+        for (chain, resi, icode), (name3, atom_names) in residue_atom_names.items() for atom_name in atom_names
+    ], dtype = atom_dtype )
+
+def count_poses( struct_dbs ):
+    n_poses = 0
+    for struct_num, struct_db in struct_dbs:
+        conn = sqlite3.connect( struct_db )
+        try:
+            n_poses += conn.execute( 'SELECT COUNT(*) FROM structures' ).fetchone()[0]
+        finally:
+            conn.close()
+    return n_poses
+
+def write_tsv( path, array ):
+    with open( path, 'w' ) as f:
+        f.write( '\t'.join( array.dtype.names ) + '\n' )
+        for row in array.tolist():
+            f.write( '\t'.join( [ str(value) for value in row ] ) + '\n' )
+
+def read_tsv( path, dtype ):
+    with open( path, 'r' ) as f:
+        reader = csv.reader( f, delimiter = '\t' )
+        header = next( reader )
+        if tuple(header) != dtype.names:
+            raise Exception( '%s has columns %s, expected %s' % (path, header, list(dtype.names)) )
+        return np.array( [ tuple(row) for row in reader ], dtype = dtype )
+
+def is_store_current( store_folder, case_name, struct_dbs ):
+    # The store is current if it is newer than every struct.db3 of the case, and holds exactly those databases' poses
+    coordinates_path, poses_path, atoms_path = get_store_paths( store_folder, case_name )
+    if not all( [ os.path.isfile( path ) for path in ( coordinates_path, poses_path, atoms_path ) ] ):
+        return False
+    store_mtime = min( [ os.path.getmtime( path ) for path in ( coordinates_path, poses_path, atoms_path ) ] )
+    if any( [ os.path.getmtime( struct_db ) > store_mtime for struct_num, struct_db in struct_dbs ] ):
+        return False
+    struct_nums = set( read_tsv( poses_path, pose_dtype )['struct_num'].tolist() )
+    return struct_nums == set( [ struct_num for struct_num, struct_db in struct_dbs ] )
+
+def build_case_store( store_folder, case_name, struct_dbs ):
+    # Writes the store of one case. The coordinates are written through a memory map, one pose at a time, so the
+    # ensemble never has to fit in memory. Files are written under temporary names and then renamed into place.
+    if not os.path.isdir( store_folder ):
+        os.makedirs( store_folder )
+    coordinates_path, poses_path, atoms_path = get_store_paths( store_folder, case_name )
+    atoms = get_atom_columns( struct_dbs )
+    atom_columns = { (chain, resi, icode, atom_name) : i for i, (chain, resi, icode, name3, atom_name) in enumerate( atoms.tolist() ) }
+    n_poses = count_poses( struct_dbs )
+
+    temporary_coordinates_path = coordinates_path + '.tmp.npy'
+    coordinates = np.lib.format.open_memmap( temporary_coordinates_path, mode = 'w+', dtype = np.float32, shape = (n_poses, len(atoms), 3) )
+    coordinates[:] = np.nan
+    poses = np.zeros( n_poses, dtype = pose_dtype )
+    pose = 0
+    for struct_num, struct_db in struct_dbs:
+        # Backrub steps are numbered with the stride recorded in the output folder, as by analyze_flex_ddG.py
+        trajectory_stride = get_trajectory_stride( struct_db )
+        conn = sqlite3.connect( struct_db )
+        try:
+            for (struct_id,) in conn.execute( 'SELECT struct_id FROM structures ORDER BY struct_id' ).fetchall():
+                columns, xyzs = [], []
+                for chain, resi, icode, name3, residue_atoms in iter_pose_residues( conn, struct_id ):
+                    for atom_name, xyz in residue_atoms:
+                        columns.append( atom_columns[(chain, resi, icode, atom_name)] )
+                        xyzs.append( xyz )
+                coordinates[pose, columns] = xyzs
+                state, backrub_steps = flex_ddG_state( struct_id, trajectory_stride )
+                poses[pose] = (state, struct_num, backrub_steps)
+                pose += 1
+        finally:
+            conn.close()
+    coordinates.flush()
+    del coordinates
+
+    write_tsv( poses_path + '.tmp', poses )
+    write_tsv( atoms_path + '.tmp', atoms )
+    os.replace( temporary_coordinates_path, coordinates_path )
+    os.replace( poses_path + '.tmp', poses_path )
+    os.replace( atoms_path + '.tmp', atoms_path )
+    return n_poses
+
+def build_store( output_folder, store_folder = default_store_folder, case_names = None, force = False ):
+    # Builds (or rebuilds, if out of date) the store of every case in output_folder. Returns (built, current) case counts.
+    built = current = 0
+    for case_name, struct_dbs in sorted( get_case_struct_dbs( output_folder ).items() ):
+        if case_names != None and case_name not in case_names:
+            continue
+        if not force and is_store_current( store_folder, case_name, struct_dbs ):
+            current += 1
+            continue
+        n_poses = build_case_store( store_folder, case_name, struct_dbs )
+        print( '%s: %d poses from %d %s files' % (case_name, n_poses, len(struct_dbs), struct_db3_file) )
+        built += 1
+    return (built, current)
+
+class EnsembleStore:
+    # Read access to the store of one case. coordinates is a read-only memory map; poses and atoms are structured
+    # arrays (see pose_dtype and atom_dtype) of its rows and atom columns.
+    def __init__( self, case_name, store_folder = default_store_folder ):
+        coordinates_path, poses_path, atoms_path = get_store_paths( store_folder, case_name )
+        self.case_name = case_name
+        self.coordinates = np.load( coordinates_path, mmap_mode = 'r' )
+        self.poses = read_tsv( poses_path, pose_dtype )
+        self.atoms = read_tsv( atoms_path, atom_dtype )
+
+    def select_poses( self, states = None, struct_nums = None, backrub_steps = None ):
+        # Returns the row indices of the poses matching all given filters (each a list of allowed values)
+        selected = np.ones( len(self.poses), dtype = bool )
+        for column, values in ( ('state', states), ('struct_num', struct_nums), ('backrub_steps', backrub_steps) ):
+            if values != None:
+                selected &= np.isin( self.poses[column], list(values) )
+        return np.flatnonzero( selected )
+
+    def select_atoms( self, chains = None, atom_names = None, residues = None ):
+        # Returns the column indices of the atoms matching all given filters. residues is a list of (chain, resi, icode).
+        selected = np.ones( len(self.atoms), dtype = bool )
+        if chains != None:
+            selected &= np.isin( self.atoms['chain'], list(chains) )
+        if atom_names != None:
+            selected &= np.isin( self.atoms['atom_name'], list(atom_names) )
+        if residues != None:
+            residue_set = set( [ (chain, int(resi), icode) for chain, resi, icode in residues ] )
+            selected &= np.array( [ (chain, resi, icode) in residue_set for chain, resi, icode, name3, atom_name in self.atoms.tolist() ], dtype = bool )
+        return np.flatnonzero( selected )
+
+    def get_coordinates( self, poses = None, atoms = None ):
+        # Reads the coordinates of the selected poses and atoms (all of them if None) into memory
+        coordinates = self.coordinates if poses is None else self.coordinates[poses]
+        return np.asarray( coordinates if atoms is None else coordinates[:, atoms] )
+
+    def read_reference_coordinates( self, pdb_path ):
+        # Returns the n_atoms x 3 coordinates of the store's atoms in a PDB file, such as the input structure, with NaN for missing atoms
+        from starting_structure_cache import read_pdb_coordinates
+        pdb_coordinates = read_pdb_coordinates( pdb_path )
+        return np.array( [
+            pdb_coordinates.get( (chain, str(resi), icode, atom_name), (np.nan, np.nan, np.nan) )
+            for chain, resi, icode, name3, atom_name in self.atoms.tolist()
+        ], dtype = np.float32 )
+
+def rmsd_to_reference( coordinates, reference, superimpose = True ):
+    # RMSD of each pose (n_poses x n_atoms x 3) to reference (n_atoms x 3), over the atoms that are present in the
+    # reference and in every pose. With superimpose, each pose is first optimally superimposed onto the reference
+    # (Kabsch), with the SVDs of all poses of a chunk computed at once.
+    common = np.isfinite( reference ).all( axis = 1 ) & np.isfinite( coordinates ).all( axis = (0, 2) )
+    if not common.any():
+        raise Exception( 'No atoms are present in the reference and every pose' )
+    reference = reference[common].astype( np.float64 )
+    if superimpose:
+        reference = reference - reference.mean( axis = 0 )
+    rmsds = np.empty( len(coordinates) )
+    for start in range( 0, len(coordinates), pose_chunk_size ):
+        chunk = np.asarray( coordinates[ start : start + pose_chunk_size ] )[:, common].astype( np.float64 )
+        if superimpose:
+            chunk -= chunk.mean( axis = 1, keepdims = True )
+            u, s, vt = np.linalg.svd( np.einsum( 'pai,aj->pij', chunk, reference ) )
+            # Flips the last axis where needed, so that each rotation is proper (no reflection)
+            signs = np.sign( np.linalg.det( np.matmul( u, vt ) ) )
+            u[:, :, -1] *= signs[:, np.newaxis]
+            chunk = np.matmul( chunk, np.matmul( u, vt ) )
+        rmsds[ start : start + pose_chunk_size ] = np.sqrt( ( ( chunk - reference ) ** 2 ).sum( axis = 2 ).mean( axis = 1 ) )
+    return rmsds
+
+def contact_maps( coordinates, row_atoms, column_atoms, contact_distance = default_contact_distance ):
+    # Returns an n_poses x len(row_atoms) x len(column_atoms) boolean array of which atoms are within contact_distance
+    # of each other in each pose. Missing (NaN) atoms are never in contact.
+    contacts = np.zeros( (len(coordinates), len(row_atoms), len(column_atoms)), dtype = bool )
+    chunk_size = max( 1, contact_chunk_elements // max( 1, len(row_atoms) * len(column_atoms) ) )
+    for start in range( 0, len(coordinates), chunk_size ):
+        chunk = np.asarray( coordinates[ start : start + chunk_size ] ).astype( np.float64 )
+        rows, columns = chunk[:, row_atoms], chunk[:, column_atoms]
+        # Squared distances as |a|^2 + |b|^2 - 2 a.b, so that no n_rows x n_columns x 3 difference array is needed
+        squared_distances = ( rows ** 2 ).sum( axis = 2 )[:, :, np.newaxis] + ( columns ** 2 ).sum( axis = 2 )[:, np.newaxis, :] - 2.0 * np.matmul( rows, columns.transpose( 0, 2, 1 ) )
+        contacts[ start : start + chunk_size ] = squared_distances <= contact_distance ** 2
+    return contacts
+
+def get_residue_starts( atoms ):
+    # Indices into atoms (a slice of EnsembleStore.atoms, in store order) where each residue's atoms start, and the residues
+    residue_keys = list( zip( atoms['chain'].tolist(), atoms['resi'].tolist(), atoms['icode'].tolist() ) )
+    starts = [ i for i in range( len(residue_keys) ) if i == 0 or residue_keys[i] != residue_keys[i - 1] ]
+    return ( np.array( starts, dtype = np.intp ), [ residue_keys[i] for i in starts ] )
+
+def residue_contact_frequencies( store, poses, row_atoms, column_atoms, contact_distance = default_contact_distance ):
+    # Fraction of the given poses in which each pair of residues (of row_atoms and column_atoms, such as the two sides
+    # of an interface) has any heavy atoms within contact_distance. Returns (frequencies, row residues, column residues).
+    row_starts, row_residues = get_residue_starts( store.atoms[row_atoms] )
+    column_starts, column_residues = get_residue_starts( store.atoms[column_atoms] )
+    counts = np.zeros( (len(row_residues), len(column_residues)) )
+    for start in range( 0, len(poses), pose_chunk_size ):
+        contacts = contact_maps( store.coordinates[ poses[ start : start + pose_chunk_size ] ], row_atoms, column_atoms, contact_distance = contact_distance )
+        residue_contacts = np.logical_or.reduceat( np.logical_or.reduceat( contacts, row_starts, axis = 1 ), column_starts, axis = 2 )
+        counts += residue_contacts.sum( axis = 0 )
+    return ( counts / max( 1, len(poses) ), row_residues, column_residues )
+
+def print_rmsd_summary( store, reference_pdb_path, atom_names = ('CA',) ):
+    # Mean and largest RMSD to the reference of each (state, backrub_steps) group of poses
+    atoms = store.select_atoms( atom_names = atom_names )
+    reference = store.read_reference_coordinates( reference_pdb_path )[atoms]
+    rmsds = rmsd_to_reference( store.get_coordinates( atoms = atoms ), reference )
+    print( '%s: %s RMSD to %s' % (store.case_name, '+'.join( atom_names ), reference_pdb_path) )
+    for state, backrub_steps in sorted( set( zip( store.poses['state'].tolist(), store.poses['backrub_steps'].tolist() ) ) ):
+        group_rmsds = rmsds[ store.select_poses( states = [state], backrub_steps = [backrub_steps] ) ]
+        print( '  %-8s %8d steps  mean %.3f  max %.3f  (%d poses)' % (state, backrub_steps, group_rmsds.mean(), group_rmsds.max(), len(group_rmsds)) )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'Gather the pose coordinates of the struct.db3 files of each case in output folders into memory-mappable NumPy arrays' )
+    parser.add_argument( 'output_folders', nargs = '+' )
+    parser.add_argument( '--store-dir', default = default_store_folder, help = 'Directory to write the stores to (default: %s)' % default_store_folder )
+    parser.add_argument( '--case-name', nargs = '+', help = 'Cases (output subdirectories) to store' )
+    parser.add_argument( '--force', action = 'store_true', help = 'Rebuild stores even if they are newer than their struct.db3 files' )
+    parser.add_argument( '--rmsd-reference', help = 'After building, print the CA RMSD of each state and backrub checkpoint of each case to this PDB, such as the input structure' )
+    args = parser.parse_args()
+
+    for output_folder in args.output_folders:
+        if not os.path.isdir( output_folder ):
+            print( 'ERROR: %s is not a valid directory' % output_folder )
+            continue
+        built, current = build_store( output_folder, store_folder = args.store_dir, case_names = set(args.case_name) if args.case_name else None, force = args.force )
+        print( '%s: built %d case stores, %d already up to date' % (output_folder, built, current) )
+        if args.rmsd_reference:
+            for case_name in sorted( get_case_struct_dbs( output_folder ) ):
+                if args.case_name and case_name not in args.case_name:
+                    continue
+                print_rmsd_summary( EnsembleStore( case_name, store_folder = args.store_dir ), args.rmsd_reference )
@@ -9,10 +9,14 @@ import datetime
 import math
 import collections
 import threading
+import functools
+import argparse
+import sqlite3
+import csv
+import multiprocessing
+import time
 
-use_multiprocessing = False
-if use_multiprocessing:
-    import multiprocessing
+import instrumentation
 
 # The Reporter class is useful for printing output for tasks which will take a long time
 # Really, you should just use tqdm now, but I used this before I knew about tqdm and it removes a dependency
@@ -114,13 +118,13 @@ class Reporter:
         if self.completion_time:
             return self.completion_time - self.start
         else:
-            return time.time() - self.start
+            return datetime.datetime.now() - self.start
 
 
 struct_db3_file = 'struct.db3'
 
-# Important - to correctly name extracted structures by the stride, this trajectory_stride must be used
-trajectory_stride = 5
+# Important - to correctly name extracted structures by the stride, the trajectory_stride of their output folder must be used
+default_trajectory_stride = 5 # As analyze_flex_ddG.default_trajectory_stride, for output folders that do not record their stride
 
 def recursive_find_struct_dbs( input_dir ):
     return_list = []
@@ -133,7 +137,7 @@ def recursive_find_struct_dbs( input_dir ):
 
     return return_list
 
-def extract_structures( struct_db, rename_function = None ):
+def extract_structures( struct_db, rename_function = None, verbose = True ):
     args = [
         os.path.expanduser( '~/rosetta/source/bin/score_jd2' ),
         '-inout:dbms:database_name', struct_db3_file,
@@ -143,17 +147,19 @@ def extract_structures( struct_db, rename_function = None ):
 
     working_directory = os.path.dirname( struct_db )
     rosetta_outfile_path = os.path.join(working_directory, 'structure_output.txt' )
-    if not use_multiprocessing:
+    if verbose:
         print(rosetta_outfile_path)
     rosetta_outfile = open( rosetta_outfile_path, 'w')
-    if not use_multiprocessing:
+    if verbose:
         print( ' '.join( args ) )
+    start_time = time.time()
     rosetta_process = subprocess.Popen(
         ' '.join(args),
         stdout=rosetta_outfile, stderr=subprocess.STDOUT, close_fds = True, cwd = working_directory, shell = True,
     )
-    return_code = rosetta_process.wait()
+    return_code, rusage = instrumentation.wait_for_process( rosetta_process )
     rosetta_outfile.close()
+    instrumentation.record_process_exit( 'score_jd2', start_time, rusage, struct_db = struct_db, returncode = return_code )
 
     if return_code == 0:
         os.remove( rosetta_outfile_path )
@@ -168,45 +174,310 @@ def extract_structures( struct_db, rename_function = None ):
 
     return return_code
 
-def flex_ddG_rename(struct_id):
-    steps = [
-        'backrub',
-        'wt',
-        'mut',
-    ]
-
-    return '%s_%05d.pdb' % ( steps[ (struct_id-1) % len(steps) ], (((struct_id-1) // len(steps)) + 1) * trajectory_stride )
+flex_ddG_states = [
+    'backrub',
+    'wt',
+    'mut',
+]
+
+def flex_ddG_state(struct_id, trajectory_stride = default_trajectory_stride):
+    # Returns the (state, backrub_steps) of a struct_id, as structures are reported in this order at each backrub trajectory checkpoint
+    return ( flex_ddG_states[ (struct_id-1) % len(flex_ddG_states) ], (((struct_id-1) // len(flex_ddG_states)) + 1) * trajectory_stride )
+
+def flex_ddG_rename(struct_id, trajectory_stride = default_trajectory_stride):
+    return '%s_%05d.pdb' % flex_ddG_state(struct_id, trajectory_stride)
+
+def get_trajectory_stride( struct_db ):
+    # The checkpoint stride recorded by the launcher in the output folder of struct_db (see get_struct_db_case), such as
+    # the number of backrub trials of run_example_3_split_saturation.py. analyze_flex_ddG is only imported here, so
+    # that extraction without it does not need pandas.
+    from analyze_flex_ddG import read_trajectory_stride
+    return read_trajectory_stride( os.path.dirname( os.path.dirname( os.path.dirname( os.path.abspath(struct_db) ) ) ) )
+
+class StructureSelection:
+    # Filters for selective extraction. Each filter is a set of allowed values, or None to allow anything.
+    # final_checkpoint only selects structures from the last backrub trajectory checkpoint in each database.
+    # case_checkpoints, if given, is a set of (case_name, backrub_steps) pairs (for example from a results csv).
+    def __init__( self, states = None, backrub_steps = None, case_names = None, struct_nums = None, final_checkpoint = False, case_checkpoints = None ):
+        self.states = states
+        self.backrub_steps = backrub_steps
+        self.case_names = case_names
+        self.struct_nums = struct_nums
+        self.final_checkpoint = final_checkpoint
+        self.case_checkpoints = case_checkpoints
+        if case_checkpoints != None:
+            selected_case_names = set( [ case_name for case_name, steps in case_checkpoints ] )
+            self.case_names = selected_case_names if self.case_names == None else self.case_names & selected_case_names
+
+    def matches_db( self, case_name, struct_num ):
+        return ( self.case_names == None or case_name in self.case_names ) and ( self.struct_nums == None or struct_num in self.struct_nums )
+
+    def matches_struct( self, case_name, state, backrub_steps, final_backrub_steps ):
+        if self.states != None and state not in self.states:
+            return False
+        if self.backrub_steps != None and backrub_steps not in self.backrub_steps:
+            return False
+        if self.final_checkpoint and backrub_steps != final_backrub_steps:
+            return False
+        if self.case_checkpoints != None and (case_name, backrub_steps) not in self.case_checkpoints:
+            return False
+        return True
+
+def get_struct_db_case( struct_db ):
+    # Output is laid out as <output folder>/<case name>/<struct number>/struct.db3. Returns (case name, struct number),
+    # or None for a struct_db that is not laid out this way.
+    struct_dir = os.path.dirname( os.path.abspath(struct_db) )
+    if not os.path.basename(struct_dir).isdigit():
+        return None
+    return ( os.path.basename( os.path.dirname(struct_dir) ), int( os.path.basename(struct_dir) ) )
+
+def read_results_case_checkpoints( results_csv, top = None, score_function_name = None ):
+    # Returns the (case_name, backrub_steps) pairs of the ddG rows of an analyze_flex_ddG.py results csv. With top,
+    # only the top cases with the lowest (most stabilizing) ddG are used, ranked by the ddG of their final backrub
+    # checkpoint at their largest nstruct. Ranking needs a single score function, so top requires score_function_name.
+    with open( results_csv, 'r' ) as f:
+        rows = [ row for row in csv.DictReader( f ) if row['scored_state'] == 'ddG' ]
+    if score_function_name != None:
+        rows = [ row for row in rows if row['score_function_name'] == score_function_name ]
+    if top != None:
+        if score_function_name == None:
+            raise Exception( 'Selecting the top cases of %s requires a score function name' % results_csv )
+        final_rows = {}
+        for row in rows:
+            key = ( int(row['nstruct']), int(row['backrub_steps']) )
+            if row['case_name'] not in final_rows or key > final_rows[row['case_name']][0]:
+                final_rows[row['case_name']] = ( key, float(row['total_score']) )
+        top_case_names = set( sorted( final_rows, key = lambda case_name: final_rows[case_name][1] )[:top] )
+        rows = [ row for row in rows if row['case_name'] in top_case_names ]
+    return set( [ (row['case_name'], int(row['backrub_steps'])) for row in rows ] )
+
+# Heavy atoms of the canonical amino acids, in the order of their Rosetta residue type (and so of the atomno
+# column of residue_atom_coords). Hydrogens follow the heavy atoms in Rosetta residue types, and are not written.
+rosetta_heavy_atom_names = {
+    'ALA' : ['N', 'CA', 'C', 'O', 'CB'],
+    'ARG' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'NE', 'CZ', 'NH1', 'NH2'],
+    'ASN' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'OD1', 'ND2'],
+    'ASP' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'OD1', 'OD2'],
+    'CYS' : ['N', 'CA', 'C', 'O', 'CB', 'SG'],
+    'GLN' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'OE1', 'NE2'],
+    'GLU' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'OE1', 'OE2'],
+    'GLY' : ['N', 'CA', 'C', 'O'],
+    'HIS' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'ND1', 'CD2', 'CE1', 'NE2'],
+    'ILE' : ['N', 'CA', 'C', 'O', 'CB', 'CG1', 'CG2', 'CD1'],
+    'LEU' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD1', 'CD2'],
+    'LYS' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'CE', 'NZ'],
+    'MET' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'SD', 'CE'],
+    'PHE' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'],
+    'PRO' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD'],
+    'SER' : ['N', 'CA', 'C', 'O', 'CB', 'OG'],
+    'THR' : ['N', 'CA', 'C', 'O', 'CB', 'OG1', 'CG2'],
+    'TRP' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD1', 'CD2', 'NE1', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2'],
+    'TYR' : ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ', 'OH'],
+    'VAL' : ['N', 'CA', 'C', 'O', 'CB', 'CG1', 'CG2'],
+}
+
+# Residue types with the same heavy atoms as a canonical amino acid, by the base name in res_type
+rosetta_residue_type_name3s = dict( [ (name3, name3) for name3 in rosetta_heavy_atom_names ] + [ ('HIS_D', 'HIS') ] )
+
+# Heavy atoms added by the patches of the residue types that flex ddG writes, which follow the other heavy atoms.
+# The terminal and disulfide patches only add or remove hydrogens otherwise.
+rosetta_patch_heavy_atom_names = {
+    'NtermProteinFull' : [],
+    'CtermProteinFull' : ['OXT'],
+    'disulfide' : [],
+}
+
+def get_heavy_atom_names( name3, res_type ):
+    # Raises for residue types and patches that are not in the tables above, rather than writing their atoms under wrong names
+    base_type, patches = res_type.split(':')[0], res_type.split(':')[1:]
+    unknown_patches = [ patch for patch in patches if patch not in rosetta_patch_heavy_atom_names ]
+    if rosetta_residue_type_name3s.get( base_type ) != name3 or len(unknown_patches) > 0:
+        raise Exception( 'Residue type %s (%s) is not a canonical amino acid with known patches, and can not be read without Rosetta' % (res_type, name3) )
+    atom_names = list( rosetta_heavy_atom_names[name3] )
+    for patch in patches:
+        atom_names.extend( rosetta_patch_heavy_atom_names[patch] )
+    return atom_names
+
+def format_pdb_atom_line( serial, atom_name, name3, chain, resi, icode, x, y, z ):
+    element = atom_name[0]
+    if len(atom_name) < 4:
+        atom_name = ' ' + atom_name
+    return 'ATOM  %5d %-4s %3s %1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f          %2s\n' % (
+        serial % 100000, atom_name, name3, chain, resi, icode, x, y, z, 1.0, 0.0, element,
+    )
 
-def main( input_dir ):
+def iter_pose_residues( conn, struct_id ):
+    # Reads the heavy atoms of one pose from the ResidueFeatures, PdbDataFeatures and (Protein)ResidueConformationFeatures
+    # tables written by the structreport ReportToDB mover. Yields (chain, PDB residue number, insertion code, name3,
+    # [(atom name, (x, y, z)), ...]) for each residue, in order.
+    residues = conn.execute( '''
+    SELECT residues.resNum, residues.name3, residues.res_type, residue_pdb_identification.chain_id,
+        residue_pdb_identification.pdb_residue_number, residue_pdb_identification.insertion_code
+    FROM residues
+    INNER JOIN residue_pdb_identification ON residue_pdb_identification.struct_id=residues.struct_id AND residue_pdb_identification.residue_number=residues.resNum
+    WHERE residues.struct_id=?
+    ORDER BY residues.resNum
+    ''', (struct_id,) ).fetchall()
+
+    coords = collections.defaultdict( dict )
+    for seqpos, atomno, x, y, z in conn.execute( 'SELECT seqpos, atomno, x, y, z FROM residue_atom_coords WHERE struct_id=?', (struct_id,) ):
+        coords[seqpos][atomno] = (x, y, z)
+
+    for resNum, name3, res_type, chain, resi, icode in residues:
+        atom_names = get_heavy_atom_names( name3, res_type )
+        residue_coords = coords[resNum]
+        # Hydrogens (and virtual atoms) are numbered after the heavy atoms, and are not read
+        missing_atom_names = [ atom_name for atomno, atom_name in enumerate( atom_names, start = 1 ) if atomno not in residue_coords ]
+        if len(missing_atom_names) > 0:
+            raise Exception( 'Residue %d (%s) of struct %d has no coordinates for %s' % (resNum, res_type, struct_id, ', '.join(missing_atom_names)) )
+        yield ( chain, resi, icode.strip(), name3, [ (atom_name, residue_coords[atomno]) for atomno, atom_name in enumerate( atom_names, start = 1 ) ] )
+
+def iter_pdb_lines( conn, struct_id ):
+    # Rebuilds the PDB ATOM records of one pose
+    serial = 0
+    last_chain = None
+    for chain, resi, icode, name3, atoms in iter_pose_residues( conn, struct_id ):
+        if last_chain != None and chain != last_chain:
+            yield 'TER\n'
+        last_chain = chain
+        for atom_name, (x, y, z) in atoms:
+            serial += 1
+            yield format_pdb_atom_line( serial, atom_name, name3, chain, resi, icode, x, y, z )
+    yield 'TER\nEND\n'
+
+def extract_structures_native( struct_db, rename_function = None, verbose = True, selection = None ):
+    # Writes the heavy atoms of every pose in struct_db as PDB files by reading its tables directly, instead of starting
+    # Rosetta's score_jd2. Files are written under their final (rename_function) names, or as score_jd2 would name them.
+    # If a StructureSelection is given, only the poses it selects are written.
+    # Returns 0, like a successful extract_structures call.
+    with instrumentation.stage( 'extract_native', struct_db = struct_db ):
+        return write_native_structures( struct_db, rename_function = rename_function, verbose = verbose, selection = selection )
+
+def write_native_structures( struct_db, rename_function = None, verbose = True, selection = None ):
+    working_directory = os.path.dirname( struct_db )
+    conn = sqlite3.connect( struct_db )
+    try:
+        struct_ids = [ row[0] for row in conn.execute( 'SELECT struct_id FROM structures ORDER BY struct_id' ) ]
+        if selection != None and len(struct_ids) > 0:
+            if get_struct_db_case( struct_db ) == None:
+                raise Exception( '%s is not in a <case name>/<struct number> directory, so its structures can not be selected' % struct_db )
+            case_name, struct_num = get_struct_db_case( struct_db )
+            trajectory_stride = get_trajectory_stride( struct_db )
+            final_backrub_steps = max( [ flex_ddG_state(struct_id, trajectory_stride)[1] for struct_id in struct_ids ] )
+            struct_ids = [
+                struct_id for struct_id in struct_ids
+                if selection.matches_struct( case_name, *(flex_ddG_state(struct_id, trajectory_stride) + (final_backrub_steps,)) )
+            ]
+        for struct_id in struct_ids:
+            if rename_function != None:
+                pdb_name = rename_function( struct_id )
+            else:
+                pdb_name = '%d_0001.pdb' % struct_id
+            if verbose:
+                print( os.path.join( working_directory, pdb_name ) )
+            with open( os.path.join( working_directory, pdb_name ), 'w' ) as f:
+                f.writelines( iter_pdb_lines( conn, struct_id ) )
+    finally:
+        conn.close()
+    return 0
+
+def get_rename_function( struct_db ):
+    return functools.partial( flex_ddG_rename, trajectory_stride = get_trajectory_stride( struct_db ) )
+
+def main( input_dir, jobs = 1, native = False, selection = None ):
+    # Extracts all struct.db3 files under input_dir, using a pool of "jobs" worker processes if jobs > 1.
+    # With native, PDBs are written by reading the databases directly instead of with Rosetta's score_jd2.
+    # A StructureSelection limits extraction to the structures it selects, and implies native extraction.
+    # Returns a list of (struct_db, error) for the databases that could not be extracted.
     struct_dbs = recursive_find_struct_dbs( input_dir )
+    extraction_kwds = {}
+    if selection != None:
+        native = True
+        unlaid_struct_dbs = [ struct_db for struct_db in struct_dbs if get_struct_db_case(struct_db) == None ]
+        for struct_db in unlaid_struct_dbs:
+            print( 'Skipping %s, which is not in a <case name>/<struct number> directory' % struct_db )
+        struct_dbs = [ struct_db for struct_db in struct_dbs if struct_db not in unlaid_struct_dbs and selection.matches_db( *get_struct_db_case(struct_db) ) ]
+        extraction_kwds['selection'] = selection
     print( 'Found {:d} structure database files to extract'.format( len(struct_dbs) ) )
 
-    if use_multiprocessing:
-        pool = multiprocessing.Pool()
     r = Reporter('extracting structure database files', entries = '.db3 files')
     r.set_total_count( len(struct_dbs) )
+    failures = []
+    extraction_function = extract_structures_native if native else extract_structures
+
+    def extraction_finished( struct_db, return_code ):
+        if return_code != 0:
+            failures.append( (struct_db, 'score_jd2 exited with return code %d, see %s' % (return_code, os.path.join( os.path.dirname(struct_db), 'structure_output.txt' ))) )
+        r.increment_report()
 
-    for struct_db in struct_dbs:
-        if use_multiprocessing:
+    def extraction_failed( struct_db, exception ):
+        failures.append( (struct_db, '%s: %s' % (type(exception).__name__, exception)) )
+        r.increment_report()
+
+    if jobs > 1:
+        pool = multiprocessing.Pool( processes = jobs )
+        for struct_db in struct_dbs:
             pool.apply_async(
-                extract_structures,
+                extraction_function,
                 args = (struct_db,),
-                kwds = {'rename_function' : flex_ddG_rename},
-                callback = r.increment_report_callback
-            )
-        else:
-            r.increment_report_callback(
-                extract_structures( struct_db, rename_function = flex_ddG_rename )
+                kwds = dict( extraction_kwds, rename_function = get_rename_function( struct_db ), verbose = False ),
+                callback = functools.partial( extraction_finished, struct_db ),
+                error_callback = functools.partial( extraction_failed, struct_db ),
             )
-
-    if use_multiprocessing:
         pool.close()
         pool.join()
+    else:
+        for struct_db in struct_dbs:
+            try:
+                return_code = extraction_function( struct_db, rename_function = get_rename_function( struct_db ), **extraction_kwds )
+            except Exception as e:
+                extraction_failed( struct_db, e )
+            else:
+                extraction_finished( struct_db, return_code )
     r.done()
 
+    if len(failures) > 0:
+        print( 'ERROR: failed to extract {:d} structure database files:'.format( len(failures) ) )
+        for struct_db, error in sorted( failures ):
+            print( '  %s: %s' % (struct_db, error) )
+    return failures
+
 if __name__ == '__main__':
-    for x in sys.argv[1:]:
+    parser = argparse.ArgumentParser( description = 'Extract PDBs from all struct.db3 files found under the given directories' )
+    parser.add_argument( 'input_dirs', nargs = '+' )
+    parser.add_argument( '--jobs', type = int, default = 1, help = 'Number of struct.db3 files to extract in parallel (default: 1). Each extraction runs its own Rosetta process.' )
+    parser.add_argument( '--native', action = 'store_true', help = 'Write PDBs (heavy atoms only) by reading struct.db3 directly, without starting Rosetta' )
+    selection_args = parser.add_argument_group( 'structure selection', 'Only extract the selected structures. Any of these options implies --native.' )
+    selection_args.add_argument( '--state', nargs = '+', choices = flex_ddG_states, help = 'States to extract' )
+    selection_args.add_argument( '--backrub-steps', nargs = '+', type = int, help = 'Backrub trajectory checkpoints to extract' )
+    selection_args.add_argument( '--final-checkpoint', action = 'store_true', help = 'Only extract the last backrub trajectory checkpoint of each run' )
+    selection_args.add_argument( '--case-name', nargs = '+', help = 'Cases (output subdirectories) to extract' )
+    selection_args.add_argument( '--struct-num', nargs = '+', type = int, help = 'Struct numbers to extract' )
+    selection_args.add_argument( '--from-results', help = 'Only extract the cases and backrub checkpoints of the ddG rows in this analyze_flex_ddG.py results csv' )
+    selection_args.add_argument( '--top', type = int, help = 'With --from-results, only use the TOP cases with the lowest ddG at their final backrub checkpoint and largest nstruct. Requires --score-function-name.' )
+    selection_args.add_argument( '--score-function-name', help = 'With --from-results, only use rows of this score function (for example fa_talaris2014-gam)' )
+    instrumentation.add_arguments( parser )
+    args = parser.parse_args()
+    if args.top != None and not ( args.from_results and args.score_function_name ):
+        parser.error( '--top requires --from-results and --score-function-name' )
+    instrumentation.configure_from_args( args )
+
+    selection = None
+    if args.state or args.backrub_steps or args.final_checkpoint or args.case_name or args.struct_num or args.from_results:
+        selection = StructureSelection(
+            states = set(args.state) if args.state else None,
+            backrub_steps = set(args.backrub_steps) if args.backrub_steps else None,
+            case_names = set(args.case_name) if args.case_name else None,
+            struct_nums = set(args.struct_num) if args.struct_num else None,
+            final_checkpoint = args.final_checkpoint,
+            case_checkpoints = read_results_case_checkpoints( args.from_results, top = args.top, score_function_name = args.score_function_name ) if args.from_results else None,
+        )
+
+    failures = []
+    for x in args.input_dirs:
         if os.path.isdir(x):
-            main( x )
+            failures.extend( main( x, jobs = args.jobs, native = args.native, selection = selection ) )
         else:
             print( 'ERROR: %s is not a valid directory' % x )
+    if len(failures) > 0:
+        sys.exit(1)
@@ -0,0 +1,85 @@
+# Command line options shared by the run_example launchers, and the code that runs a sweep of flex ddG cases with
+# them. run_example_1.py and run_example_2_saturation.py take all of the options of add_arguments, and hand their list
+# of cases (tuples of the arguments of their get_output_directory and job functions) to run_cases.
+# run_example_3_split_saturation.py only takes --scratch (add_scratch_argument) and the instrumentation options.
+
+from __future__ import print_function
+
+import instrumentation
+import job_manifest
+from async_launcher import AsyncLauncher
+from job_scheduler import MemoryAwareScheduler, RunJournal, AdaptiveNstruct, run_job, skip_completed_runs, completion_marker_file_name
+
+adaptive_min_nstruct = 10 # With --adaptive, replicates run for every case before its convergence is checked
+adaptive_ddg_se_threshold = 0.1 # With --adaptive, no more replicates are started for a case once the bootstrap standard error of its mean ddG is below this
+
+def add_scratch_argument( parser ):
+    # The default scratch directory is resolved by job_scheduler.get_scratch_dir
+    parser.add_argument( '--scratch', nargs = '?', const = True, help = 'Run Rosetta in a scratch directory under SCRATCH (default: $TMPDIR or /dev/shm), then compress its log and copy its output back to the output directory' )
+
+def add_arguments( parser ):
+    parser.add_argument( '--resume', action = 'store_true', help = 'Skip output directories that already hold a successful run, and clean and rerun any incomplete ones' )
+    parser.add_argument( '--adaptive', action = 'store_true', help = 'Only run replicates (up to nstruct) for each case until the standard error of its mean ddG is below --se-threshold, starting with the noisiest cases' )
+    parser.add_argument( '--se-threshold', type = float, default = adaptive_ddg_se_threshold, help = 'Bootstrap standard error of the mean ddG at which --adaptive stops running replicates of a case (default: %.2f)' % adaptive_ddg_se_threshold )
+    parser.add_argument( '--min-nstruct', type = int, default = adaptive_min_nstruct, help = 'Successful replicates run for every case, replacing failed ones, before --adaptive checks its convergence (at least 2; default: %d)' % adaptive_min_nstruct )
+    add_scratch_argument( parser )
+    parser.add_argument( '--preminimize', action = 'store_true', help = 'Minimize each input PDB once, caching the result in preminimized_cache, and start all replicates from the minimized structure' )
+    parser.add_argument( '--verify-preminimized', action = 'store_true', help = 'Rerun the minimization of each input PDB, check that it matches the cached structure and that the first case gives the same ddG as without --preminimize, and exit' )
+    parser.add_argument( '--async-launcher', action = 'store_true', help = 'Run Rosetta from a single asyncio event loop, keeping only the JobDistributor and error lines of its output in rosetta.out and compressing all of it to rosetta.out.gz' )
+    parser.add_argument( '--job-timeout', type = float, help = 'With --async-launcher, terminate runs that are still going after this many seconds' )
+    job_manifest.add_arguments( parser )
+    instrumentation.add_arguments( parser, profile = False )
+
+def parse_arguments( parser, argv = None ):
+    # Parses and checks the options of add_arguments, applies the launch options of --run-manifest, and configures
+    # instrumentation
+    args = parser.parse_args( argv )
+    job_manifest.check_arguments( parser, args )
+    if args.run_manifest and args.adaptive:
+        parser.error( '--adaptive needs all replicates of a case, so can not be combined with --run-manifest' )
+    if args.async_launcher and args.adaptive:
+        parser.error( '--async-launcher can not be combined with --adaptive' )
+    if args.job_timeout != None and not args.async_launcher:
+        parser.error( '--job-timeout requires --async-launcher' )
+    if args.run_manifest:
+        # Array tasks repeat the --preminimize and --scratch options the manifest was written with
+        job_manifest.apply_launch_options( args )
+    instrumentation.configure_from_args( args )
+    return args
+
+def run_cases( args, launcher, cases, get_output_directory, start_function, get_job, run_journal_path, max_processes = None, scratch_dir = None ):
+    # Writes cases to --write-manifest, or runs them with the scheduler chosen by --adaptive and --async-launcher,
+    # first skipping the runs that have already succeeded with --resume. start_function(*case_args) starts a run
+    # (as for MemoryAwareScheduler), and get_job(*case_args) returns its Rosetta args and output directory (as for
+    # AsyncLauncher). A max_processes of None uses all available cores, only starting new Rosetta instances while the
+    # node has memory free for them; with a max_processes of 1, the runs are run one after the other.
+    if args.write_manifest:
+        # With --preminimize, the cache is filled before the array tasks start, so that they do not race to fill it
+        job_manifest.write_job_manifest(
+            args.write_manifest, launcher, cases, tasks_per_index = args.tasks_per_index,
+            options = job_manifest.get_launch_options( args ),
+        )
+        return
+
+    journal = RunJournal( run_journal_path )
+    finished_cases = []
+    if args.resume:
+        cases_to_run = skip_completed_runs( cases, get_output_directory, journal = journal )
+        cases_left = set( cases_to_run )
+        finished_cases = [ case_args for case_args in cases if case_args not in cases_left ]
+        cases = cases_to_run
+        print( 'Resuming: %d runs left to do' % len(cases) )
+    start_function_journaled = journal.journaled( start_function, get_output_directory )
+
+    if args.adaptive:
+        adaptive = AdaptiveNstruct( cases, start_function_journaled, get_output_directory, args.min_nstruct, args.se_threshold, finished_cases = finished_cases )
+        adaptive.run( MemoryAwareScheduler( max_processes = max_processes ) )
+    elif args.async_launcher:
+        async_launcher = AsyncLauncher( max_processes = max_processes, timeout = args.job_timeout, journal = journal, scratch_dir = scratch_dir, completion_marker_file_name = completion_marker_file_name, get_output_directory = get_output_directory )
+        async_launcher.print_summary( async_launcher.run( [ (get_job, case_args) for case_args in cases ] ) )
+    elif max_processes != 1:
+        scheduler = MemoryAwareScheduler( max_processes = max_processes )
+        scheduler.run( [ (start_function_journaled, case_args) for case_args in cases ] )
+    else:
+        for case_args in cases:
+            run_job( start_function_journaled, case_args )
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Generates the job table for a batch of flex ddG mutation cases, for use with "run_example_1.py --job-table".
+#
+# The sweep file lists one request per line, as an input case (a directory in inputs/) followed by what to mutate:
+#
+#   1JTG  B135K,B163K                       # A mutation set, in PDB numbering: chain, residue number, insertion code, mutant amino acid
+#   1JTG  saturate B49                      # Mutate a position to all 20 amino acids, one case per amino acid
+#   1JTG  saturate interface                # Saturation mutagenesis of every interface residue on the chainstomove side
+#   1JTG  mutfile inputs/1JTG/mutations.mutfile   # Mutation sets from a Rosetta mutfile (Rosetta numbering)
+#
+# Positions are checked against (and mutfile numbering converted through) the case's pdb2rosetta/rosetta2pdb resmaps.
+# Each distinct mutation set of an input case becomes one case, and identical resfiles are only written once.
+
+import os
+import sys
+import re
+import json
+import hashlib
+import argparse
+import collections
+
+inputs_folder = 'inputs'
+amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+interface_distance = 5.0 # Residues with a heavy atom this close to the other side of the interface are mutated by "saturate interface"
+max_case_name_length = 100
+job_table_columns = ['case_name', 'input_case', 'resfile', 'mutations']
+
+three_to_one = {
+    'ALA' : 'A', 'CYS' : 'C', 'ASP' : 'D', 'GLU' : 'E', 'PHE' : 'F', 'GLY' : 'G', 'HIS' : 'H', 'ILE' : 'I', 'LYS' : 'K', 'LEU' : 'L',
+    'MET' : 'M', 'ASN' : 'N', 'PRO' : 'P', 'GLN' : 'Q', 'ARG' : 'R', 'SER' : 'S', 'THR' : 'T', 'VAL' : 'V', 'TRP' : 'W', 'TYR' : 'Y',
+}
+
+mutation_re = re.compile( r'^([A-Za-z0-9])(-?\d+)([A-Z]?)([%s])$' % amino_acids )
+position_re = re.compile( r'^([A-Za-z0-9])(-?\d+)([A-Z]?)$' )
+
+def resmap_key( chain, resi, icode ):
+    # Residue keys as used in the *.resmap.json files, e.g. "B 135 "
+    return '%s%4d%s' % (chain, resi, icode if icode != '' else ' ')
+
+def parse_resmap_key( key ):
+    return ( key[0], int(key[1:5]), key[5].strip() )
+
+def find_input_pdb( case_path ):
+    for f in sorted( os.listdir(case_path) ):
+        if f.endswith('.pdb'):
+            return os.path.join( case_path, f )
+    raise Exception( 'No PDB file found in %s' % case_path )
+
+def read_chains_to_move( case_path ):
+    with open( os.path.join( case_path, 'chains_to_move.txt' ), 'r' ) as f:
+        return f.readlines()[0].strip()
+
+def read_pdb_residues( pdb_path ):
+    # Returns an OrderedDict of (chain, resi, icode) -> (one letter amino acid, list of heavy atom coordinates)
+    residues = collections.OrderedDict()
+    with open( pdb_path, 'r' ) as f:
+        for line in f:
+            if not line.startswith( 'ATOM' ):
+                continue
+            element = line[76:78].strip() or line[12:16].strip()[0]
+            residue = ( line[21], int(line[22:26]), line[26].strip() )
+            if residue not in residues:
+                residues[residue] = ( three_to_one.get( line[17:20], 'X' ), [] )
+            if element != 'H':
+                residues[residue][1].append( ( float(line[30:38]), float(line[38:46]), float(line[46:54]) ) )
+    return residues
+
+def find_interface_residues( pdb_path, chains_to_move ):
+    # Residues of the chains_to_move side with any heavy atom within interface_distance of the other side.
+    # Atoms of the other side are binned into a grid with interface_distance sized cells, so only neighboring cells are searched.
+    moving_chains = set( chains_to_move.split(',') )
+    residues = read_pdb_residues( pdb_path )
+
+    def cell( xyz ):
+        return tuple( [ int( x // interface_distance ) for x in xyz ] )
+
+    grid = collections.defaultdict( list )
+    for residue, (aa, atoms) in residues.items():
+        if residue[0] not in moving_chains:
+            for xyz in atoms:
+                grid[cell(xyz)].append( xyz )
+
+    cutoff_squared = interface_distance ** 2
+    interface_residues = []
+    for residue, (aa, atoms) in residues.items():
+        if residue[0] not in moving_chains:
+            continue
+        found = False
+        for xyz in atoms:
+            cx, cy, cz = cell( xyz )
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for dz in (-1, 0, 1):
+                        for other in grid.get( (cx + dx, cy + dy, cz + dz), [] ):
+                            if (xyz[0] - other[0]) ** 2 + (xyz[1] - other[1]) ** 2 + (xyz[2] - other[2]) ** 2 <= cutoff_squared:
+                                found = True
+                                break
+                        if found: break
+                    if found: break
+                if found: break
+            if found: break
+        if found:
+            interface_residues.append( residue )
+    return interface_residues
+
+class InputCase:
+    def __init__( self, input_case ):
+        self.name = input_case
+        self.path = os.path.join( inputs_folder, input_case )
+        self.pdb_path = find_input_pdb( self.path )
+        self.chains_to_move = read_chains_to_move( self.path )
+        with open( os.path.join( self.path, 'pdb2rosetta.resmap.json' ), 'r' ) as f:
+            self.pdb2rosetta = json.load( f )
+        with open( os.path.join( self.path, 'rosetta2pdb.resmap.json' ), 'r' ) as f:
+            self.rosetta2pdb = json.load( f )
+        self._residues = None
+
+    def residues( self ):
+        if self._residues is None:
+            self._residues = read_pdb_residues( self.pdb_path )
+        return self._residues
+
+    def check_position( self, position ):
+        if resmap_key( *position ) not in self.pdb2rosetta:
+            raise Exception( 'Residue %s%d%s is not in the pdb2rosetta resmap of input case %s' % (position + (self.name,)) )
+
+    def parse_mutation( self, mutation_string ):
+        m = mutation_re.match( mutation_string )
+        if not m:
+            raise Exception( 'Could not parse mutation "%s", expected chain, residue number, insertion code and amino acid, like B135K' % mutation_string )
+        position = ( m.group(1), int(m.group(2)), m.group(3) )
+        self.check_position( position )
+        return position + ( m.group(4), )
+
+    def parse_position( self, position_string ):
+        m = position_re.match( position_string )
+        if not m:
+            raise Exception( 'Could not parse position "%s", expected chain, residue number and insertion code, like B49' % position_string )
+        position = ( m.group(1), int(m.group(2)), m.group(3) )
+        self.check_position( position )
+        return position
+
+    def read_mutfile( self, mutfile_path ):
+        # Rosetta mutfile: "total N", then for each mutation set its number of mutations followed by "wt_aa rosetta_resnum mut_aa" lines
+        with open( mutfile_path, 'r' ) as f:
+            tokens = [ line.split() for line in f if line.strip() != '' ]
+        mutation_sets = []
+        i = 1
+        while i < len(tokens):
+            n = int( tokens[i][0] )
+            mutation_set = []
+            for wt_aa, rosetta_resnum, mut_aa in tokens[i + 1 : i + 1 + n]:
+                chain, resi, icode = parse_resmap_key( self.rosetta2pdb[rosetta_resnum] )
+                pdb_wt_aa = self.residues()[ (chain, resi, icode) ][0]
+                if pdb_wt_aa != wt_aa:
+                    raise Exception( 'Mutfile %s has wild type %s at Rosetta residue %s, but the PDB has %s' % (mutfile_path, wt_aa, rosetta_resnum, pdb_wt_aa) )
+                mutation_set.append( (chain, resi, icode, mut_aa) )
+            mutation_sets.append( mutation_set )
+            i += n + 1
+        return mutation_sets
+
+def expand_request( input_case, request ):
+    # Returns the list of mutation sets (lists of (chain, resi, icode, mut_aa)) for one line of the sweep file
+    if request[0] == 'saturate':
+        if request[1] == 'interface':
+            positions = find_interface_residues( input_case.pdb_path, input_case.chains_to_move )
+        else:
+            positions = [ input_case.parse_position( position_string ) for position_string in request[1].split(',') ]
+        return [ [ position + (aa,) ] for position in positions for aa in amino_acids ]
+    elif request[0] == 'mutfile':
+        return input_case.read_mutfile( request[1] )
+    else:
+        return [ [ input_case.parse_mutation( mutation_string ) for mutation_string in ','.join(request).split(',') if mutation_string != '' ] ]
+
+def mutation_name( mutation ):
+    chain, resi, icode, aa = mutation
+    return '%s%d%s%s' % (chain, resi, icode, aa)
+
+def make_resfile( mutation_set ):
+    return 'NATAA\nstart\n' + ''.join( [ '%d%s %s PIKAA %s\n' % (resi, icode, chain, aa) for chain, resi, icode, aa in mutation_set ] )
+
+def make_case_name( input_case_name, mutation_set ):
+    case_name = '_'.join( [input_case_name] + [ mutation_name(mutation) for mutation in mutation_set ] )
+    if len(case_name) > max_case_name_length:
+        case_name = '%s_%dmut_%s' % ( input_case_name, len(mutation_set), hashlib.sha1( case_name.encode() ).hexdigest()[:12] )
+    return case_name
+
+def generate_sweep( sweep_file, output_dir ):
+    input_cases = {}
+    cases = collections.OrderedDict() # (input_case, mutation_set) -> case_name
+    with open( sweep_file, 'r' ) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line == '':
+                continue
+            fields = line.split()
+            if fields[0] not in input_cases:
+                input_cases[fields[0]] = InputCase( fields[0] )
+            input_case = input_cases[fields[0]]
+            for mutation_set in expand_request( input_case, fields[1:] ):
+                # Mutation sets are deduplicated regardless of the order their mutations were given in
+                mutation_set = tuple( sorted( set(mutation_set) ) )
+                positions = [ mutation[:3] for mutation in mutation_set ]
+                if len(set(positions)) != len(positions):
+                    raise Exception( 'Mutation set %s mutates the same position more than once' % ','.join( [ mutation_name(m) for m in mutation_set ] ) )
+                key = (input_case.name, mutation_set)
+                if key not in cases:
+                    cases[key] = make_case_name( input_case.name, mutation_set )
+
+    resfiles_dir = os.path.join( output_dir, 'resfiles' )
+    if not os.path.isdir( resfiles_dir ):
+        os.makedirs( resfiles_dir )
+
+    job_table_path = os.path.join( output_dir, 'jobs.tsv' )
+    written_resfiles = set()
+    with open( job_table_path, 'w' ) as f:
+        f.write( '\t'.join( job_table_columns ) + '\n' )
+        for (input_case_name, mutation_set), case_name in cases.items():
+            resfile_contents = make_resfile( mutation_set )
+            resfile_path = os.path.join( resfiles_dir, hashlib.sha1( resfile_contents.encode() ).hexdigest()[:16] + '.resfile' )
+            if resfile_path not in written_resfiles:
+                with open( resfile_path, 'w' ) as resfile:
+                    resfile.write( resfile_contents )
+                written_resfiles.add( resfile_path )
+            f.write( '\t'.join( [ case_name, input_case_name, resfile_path, ','.join( [ mutation_name(m) for m in mutation_set ] ) ] ) + '\n' )
+
+    print( 'Wrote %d cases (%d distinct resfiles) to %s' % (len(cases), len(written_resfiles), job_table_path) )
+    return job_table_path
+
+def read_job_table( job_table_path ):
+    # Returns a list of dicts with the job_table_columns keys
+    with open( job_table_path, 'r' ) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        return [ dict( zip( header, line.rstrip('\n').split('\t') ) ) for line in f if line.strip() != '' ]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'Generate a flex ddG job table from a sweep file of mutation sets and saturation requests' )
+    parser.add_argument( 'sweep_file' )
+    parser.add_argument( '--output-dir', default = 'sweep', help = 'Directory to write jobs.tsv and the deduplicated resfiles to (default: sweep)' )
+    args = parser.parse_args()
+    generate_sweep( args.sweep_file, args.output_dir )
@@ -0,0 +1,134 @@
+# Records the wall time, CPU time and peak RSS of each stage of launching, extraction and analysis to a JSON-lines log,
+# one object per stage run, so that it is possible to see where the time goes on a production sweep.
+# Recording is off unless a log path is configured, with configure() or the FLEX_DDG_INSTRUMENTATION_LOG environment
+# variable; configure() sets the environment variables, so that worker processes and subprocesses log to the same file.
+# If a profile directory is also configured, each in-process stage is run under cProfile, and its (accumulated) stats
+# are written to <profile dir>/<stage>-<pid>.prof, which can be read with pstats or snakeviz.
+
+import os
+import time
+import json
+import socket
+import datetime
+import contextlib
+
+log_path_environment_variable = 'FLEX_DDG_INSTRUMENTATION_LOG'
+profile_dir_environment_variable = 'FLEX_DDG_PROFILE_DIR'
+
+stage_profiles = {} # stage -> cProfile.Profile of this process
+active_stages = [] # Stages currently being timed in this process. Only the outermost one is profiled, as profilers can not be nested.
+
+def configure( log_path = None, profile_dir = None ):
+    if log_path:
+        os.environ[log_path_environment_variable] = os.path.abspath( log_path )
+    if profile_dir:
+        if not os.path.isdir( profile_dir ):
+            os.makedirs( profile_dir )
+        os.environ[profile_dir_environment_variable] = os.path.abspath( profile_dir )
+
+def add_arguments( parser, profile = True ):
+    parser.add_argument( '--instrumentation-log', help = 'Append the wall time, CPU time and peak memory of each stage to this JSON-lines file' )
+    if profile:
+        parser.add_argument( '--profile', metavar = 'PROFILE_DIR', help = 'Run each stage under cProfile, writing its stats to PROFILE_DIR/<stage>-<pid>.prof' )
+
+def configure_from_args( args ):
+    configure( log_path = args.instrumentation_log, profile_dir = getattr( args, 'profile', None ) )
+
+def get_log_path():
+    return os.environ.get( log_path_environment_variable )
+
+def get_profile_dir():
+    return os.environ.get( profile_dir_environment_variable )
+
+def record( stage, wall_seconds, cpu_seconds, peak_rss_bytes, **fields ):
+    log_path = get_log_path()
+    if not log_path:
+        return
+    entry = {
+        'time' : datetime.datetime.now().isoformat(),
+        'stage' : stage,
+        'host' : socket.gethostname(),
+        'pid' : os.getpid(),
+        'wall_seconds' : round( wall_seconds, 6 ),
+        'cpu_seconds' : None if cpu_seconds is None else round( cpu_seconds, 6 ),
+        'peak_rss_bytes' : peak_rss_bytes,
+    }
+    entry.update( fields )
+    # Lines are written with a single append, so that processes logging to the same file do not interleave within a line
+    with open( log_path, 'a' ) as f:
+        f.write( json.dumps( entry, default = str ) + '\n' )
+
+def reset_peak_rss():
+    # Resets this process's VmHWM, so that the peak RSS of a stage can be measured on its own (Linux 4.0 and later)
+    try:
+        with open( '/proc/self/clear_refs', 'w' ) as f:
+            f.write( '5' )
+        return True
+    except (IOError, OSError):
+        return False
+
+def get_peak_rss():
+    try:
+        with open( '/proc/self/status', 'r' ) as f:
+            for line in f:
+                if line.startswith( 'VmHWM:' ):
+                    return int( line.split()[1] ) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+
+@contextlib.contextmanager
+def stage( name, **fields ):
+    # Times the code run in the with block as one run of the named stage. Extra keyword arguments, such as the case name,
+    # are written to the log entry. When nothing is being logged or profiled, this adds no more than a few time calls.
+    log_path, profile_dir = get_log_path(), get_profile_dir()
+    profile = None
+    if profile_dir and len(active_stages) == 0:
+        import cProfile
+        profile = stage_profiles.setdefault( name, cProfile.Profile() )
+    peak_rss_reset = log_path and len(active_stages) == 0 and reset_peak_rss()
+
+    active_stages.append( name )
+    start_wall, start_cpu = time.time(), time.process_time()
+    if profile != None:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile != None:
+            profile.disable()
+        wall_seconds, cpu_seconds = time.time() - start_wall, time.process_time() - start_cpu
+        active_stages.pop()
+        if profile != None:
+            profile.dump_stats( os.path.join( profile_dir, '%s-%d.prof' % (name, os.getpid()) ) )
+        if log_path:
+            # Without a reset, the peak is that of the whole process so far
+            record( name, wall_seconds, cpu_seconds, get_peak_rss(), peak_rss_scope = 'stage' if peak_rss_reset else 'process', **fields )
+
+def record_process_exit( stage, start_time, rusage, **fields ):
+    # Records a subprocess from the resource usage returned by os.wait4, which covers the subprocess itself
+    # (and any of its children it waited for) rather than this process
+    if rusage is None:
+        record( stage, time.time() - start_time, None, None, **fields )
+    else:
+        record( stage, time.time() - start_time, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * 1024, **fields )
+
+def wait_for_process( process, nohang = False ):
+    # Waits for a subprocess.Popen to exit, returning (returncode, rusage), or (None, None) if nohang and it is still
+    # running. process.returncode is set, as Popen.wait or Popen.poll would. rusage is None where os.wait4 is not available.
+    if process.returncode is not None or not hasattr( os, 'wait4' ):
+        returncode = process.poll() if nohang else process.wait()
+        return ( returncode, None )
+    try:
+        pid, status, rusage = os.wait4( process.pid, os.WNOHANG if nohang else 0 )
+    except ChildProcessError:
+        # Already reaped elsewhere
+        return ( process.poll() if nohang else process.wait(), None )
+    if pid == 0:
+        return ( None, None )
+    process.returncode = os.waitstatus_to_exitcode( status )
+    return ( process.returncode, rusage )
@@ -0,0 +1,100 @@
+# Writes every run of a launcher's sweep to a job manifest, and reads back slices of it, so that a sweep can be spread
+# over a cluster as a scheduler array job. Each array task runs the launcher with --run-manifest and its own
+# --task-index (such as $SLURM_ARRAY_TASK_ID), and only runs its slice of the manifest. Slices can also be run one
+# after the other on a single machine.
+#
+# The manifest is a JSON-lines file: a header object naming the launcher, the number of runs and the launch options
+# (--preminimize and --scratch) that every array task applies, followed by the arguments of one run (the launcher's
+# case tuple) per line.
+
+from __future__ import print_function
+
+import json
+import itertools
+
+manifest_format_version = 1
+
+def get_launch_options( args ):
+    # A --scratch without a directory is stored as true (see job_scheduler.get_scratch_dir), so that each array task
+    # uses the default scratch directory of its own node. A directory given with --scratch is stored as it is.
+    return { 'preminimize' : args.preminimize, 'scratch' : args.scratch }
+
+def get_launch_option_flags( options ):
+    flags = ''
+    if options.get( 'preminimize' ):
+        flags += ' --preminimize'
+    if options.get( 'scratch' ) == True:
+        flags += ' --scratch'
+    elif options.get( 'scratch' ):
+        flags += ' --scratch %s' % options['scratch']
+    return flags
+
+def write_job_manifest( manifest_path, launcher, cases, tasks_per_index = 1, options = None ):
+    options = options or {}
+    with open( manifest_path, 'w' ) as f:
+        f.write( json.dumps( { 'format' : manifest_format_version, 'launcher' : launcher, 'runs' : len(cases), 'options' : options } ) + '\n' )
+        for case_args in cases:
+            f.write( json.dumps( list(case_args), separators = (',', ':') ) + '\n' )
+    n_indices = ( len(cases) + tasks_per_index - 1 ) // tasks_per_index
+    print( 'Wrote %d runs to %s' % (len(cases), manifest_path) )
+    print( 'Run them as an array job of %d tasks, for example with SLURM:' % n_indices )
+    # The launch options are read back from the manifest, and are only repeated here to show what the tasks will do
+    print( '  sbatch --array=0-%d --wrap "python %s --run-manifest %s --task-index \\$SLURM_ARRAY_TASK_ID%s%s"' % (
+        n_indices - 1, launcher, manifest_path, '' if tasks_per_index == 1 else ' --tasks-per-index %d' % tasks_per_index,
+        get_launch_option_flags( options ),
+    ) )
+
+def read_job_manifest_header( manifest_path ):
+    with open( manifest_path, 'r' ) as f:
+        return json.loads( f.readline() )
+
+def get_task_slice( task_index = None, task_range = None, tasks_per_index = 1 ):
+    # Returns the [start, stop) range of manifest runs for an array task index, or for an inclusive task range
+    # given as FIRST-LAST (as in SLURM's --array) or a single run number
+    if task_range != None:
+        first, _, last = task_range.partition( '-' )
+        return ( int(first), int(last or first) + 1 )
+    return ( task_index * tasks_per_index, (task_index + 1) * tasks_per_index )
+
+def read_job_manifest( manifest_path, launcher, start, stop, allow_short_slice = False ):
+    # Returns the case tuples of runs start to stop - 1 of the manifest. With allow_short_slice (for the last
+    # --task-index of a sweep whose runs are not a multiple of --tasks-per-index), stop may be past the last run.
+    header = read_job_manifest_header( manifest_path )
+    if header.get( 'format' ) != manifest_format_version or header.get( 'launcher' ) != launcher:
+        raise Exception( '%s is a job manifest for %s (format %s), not for %s' % (manifest_path, header.get( 'launcher' ), header.get( 'format' ), launcher) )
+    if start < 0 or start >= header['runs'] or stop <= start or ( stop > header['runs'] and not allow_short_slice ):
+        raise Exception( 'Runs %d to %d are outside the %d runs of %s' % (start, stop - 1, header['runs'], manifest_path) )
+    with open( manifest_path, 'r' ) as f:
+        return [ tuple( json.loads( line ) ) for line in itertools.islice( f, start + 1, stop + 1 ) ]
+
+def add_arguments( parser ):
+    parser.add_argument( '--write-manifest', metavar = 'MANIFEST', help = 'Write every run of the sweep to this job manifest for an array job, instead of running them' )
+    parser.add_argument( '--run-manifest', metavar = 'MANIFEST', help = 'Run a slice of the runs in this job manifest, given by --task-index or --task-range' )
+    task_slice = parser.add_mutually_exclusive_group()
+    task_slice.add_argument( '--task-index', type = int, help = 'Array task index (such as $SLURM_ARRAY_TASK_ID) of the slice of --run-manifest to run, counting from 0' )
+    task_slice.add_argument( '--task-range', help = 'Inclusive range FIRST-LAST of the runs of --run-manifest to run, counting from 0' )
+    parser.add_argument( '--tasks-per-index', type = int, default = 1, help = 'Number of manifest runs in each --task-index slice (default: 1)' )
+
+def check_arguments( parser, args ):
+    if args.run_manifest and args.task_index is None and args.task_range is None:
+        parser.error( '--run-manifest requires --task-index or --task-range' )
+    if not args.run_manifest and ( args.task_index != None or args.task_range != None ):
+        parser.error( '--task-index and --task-range require --run-manifest' )
+    if args.tasks_per_index < 1:
+        parser.error( '--tasks-per-index must be at least 1' )
+
+def apply_launch_options( args ):
+    # Sets args.preminimize and args.scratch from the launch options in the header of --run-manifest, unless they were
+    # given on the command line
+    options = read_job_manifest_header( args.run_manifest ).get( 'options', {} )
+    if options.get( 'preminimize' ):
+        args.preminimize = True
+    if args.scratch is None and options.get( 'scratch' ):
+        args.scratch = options['scratch']
+
+def get_manifest_cases( args, launcher ):
+    # Only the last --task-index slice may be short; a --task-range must lie within the manifest
+    return read_job_manifest(
+        args.run_manifest, launcher, *get_task_slice( args.task_index, args.task_range, args.tasks_per_index ),
+        allow_short_slice = args.task_index != None,
+    )
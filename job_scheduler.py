@@ -0,0 +1,411 @@
+# Schedules Rosetta subprocesses so that a node's cores are kept busy without running out of memory.
+# New jobs are only started while there is a free core and enough available memory for another job,
+# taking into account how much more memory the already running jobs are expected to grow into.
+# Also has the helpers the launchers use to resume an interrupted sweep, and to stop running replicates
+# of cases whose ddG has already converged.
+
+from __future__ import print_function
+
+import os
+import time
+import datetime
+import shutil
+import multiprocessing
+import collections
+import functools
+import subprocess
+import tempfile
+import gzip
+
+from instrumentation import wait_for_process, record_process_exit
+
+default_job_memory_estimate = 2 * 1024 ** 3 # Rosetta takes about 2 Gb of memory per instance, until we have measured it
+default_memory_reserve_fraction = 0.05 # Fraction of total memory to always leave free
+scratch_ignored_file_patterns = ('*-journal', '*-wal', '*-shm') # SQLite temporary files, not copied back from scratch directories
+completion_marker_file_name = 'rosetta.done' # Written to an output directory once its run has succeeded, so that analyze_flex_ddG.py does not need to scan rosetta.out
+min_structs_for_standard_error = 2 # AdaptiveNstruct runs at least this many successful replicates of a case before estimating its standard error
+
+def read_proc_kb_fields( path, fields ):
+    # Reads "Name:   1234 kB" style fields from files like /proc/meminfo and /proc/<pid>/status into bytes
+    values = {}
+    try:
+        with open( path, 'r' ) as f:
+            for line in f:
+                name, _, value = line.partition( ':' )
+                if name in fields:
+                    values[name] = int( value.split()[0] ) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return values
+
+def read_cgroup_value( path ):
+    try:
+        with open( path, 'r' ) as f:
+            value = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if value == 'max' or not value.isdigit():
+        return None
+    return int( value )
+
+def get_available_memory():
+    # Returns (available, total) memory in bytes, or (None, None) if it can not be determined on this platform.
+    # If we are inside a (v2) cgroup with a memory limit, such as a SLURM allocation, that limit is respected as well.
+    meminfo = read_proc_kb_fields( '/proc/meminfo', ('MemAvailable', 'MemTotal') )
+    if 'MemAvailable' not in meminfo or 'MemTotal' not in meminfo:
+        return (None, None)
+    available, total = meminfo['MemAvailable'], meminfo['MemTotal']
+
+    cgroup_limit = read_cgroup_value( '/sys/fs/cgroup/memory.max' )
+    cgroup_usage = read_cgroup_value( '/sys/fs/cgroup/memory.current' )
+    if cgroup_limit != None and cgroup_usage != None and cgroup_limit < total:
+        available = min( available, cgroup_limit - cgroup_usage )
+        total = cgroup_limit
+
+    return (available, total)
+
+def get_process_rss( pid ):
+    return read_proc_kb_fields( '/proc/%d/status' % pid, ('VmRSS',) ).get( 'VmRSS', 0 )
+
+def get_cpu_count():
+    if hasattr( os, 'sched_getaffinity' ):
+        return len( os.sched_getaffinity(0) )
+    return multiprocessing.cpu_count()
+
+def get_default_scratch_dir():
+    # Node-local scratch space: $TMPDIR if the batch system set one, otherwise the /dev/shm tmpfs
+    if os.environ.get( 'TMPDIR' ):
+        return os.environ['TMPDIR']
+    if os.path.isdir( '/dev/shm' ):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def get_scratch_dir( scratch_option ):
+    # The launchers' --scratch option is True when given without a directory, and is resolved on the node the runs
+    # are started on (so each task of an array job uses its own node's scratch space)
+    return get_default_scratch_dir() if scratch_option == True else scratch_option
+
+def copy_back_from_scratch( scratch_directory, output_directory, log_file_name = None ):
+    # Compresses the log (if it was written to the scratch directory) into output_directory, copies everything else
+    # Rosetta wrote (except SQLite temporary files) back in a single pass, and removes the scratch directory
+    ignored_file_patterns = scratch_ignored_file_patterns
+    if log_file_name != None:
+        with open( os.path.join( scratch_directory, log_file_name ), 'rb' ) as log, gzip.open( os.path.join( output_directory, log_file_name + '.gz' ), 'wb' ) as compressed_log:
+            shutil.copyfileobj( log, compressed_log, 1024 * 1024 )
+        ignored_file_patterns = (log_file_name,) + ignored_file_patterns
+    shutil.copytree(
+        scratch_directory, output_directory, dirs_exist_ok = True,
+        ignore = shutil.ignore_patterns( *ignored_file_patterns ),
+    )
+    shutil.rmtree( scratch_directory )
+
+class CopyBackError( Exception ):
+    # Raised by a run's finish_function when its output could not be copied back from its scratch directory
+    pass
+
+def remove_previous_run_output( output_directory, completion_marker_file_name, log_file_name ):
+    # Removes the completion marker and logs of an earlier run, so that a new run is not mistaken for a finished one
+    for path in ( os.path.join( output_directory, completion_marker_file_name ), os.path.join( output_directory, log_file_name ), os.path.join( output_directory, log_file_name + '.gz' ) ):
+        if os.path.isfile( path ):
+            os.remove( path )
+
+def start_rosetta_process( args, output_directory, completion_marker_file_name, log_file_name = 'rosetta.out', scratch_dir = None ):
+    # Starts Rosetta in output_directory, logging to log_file_name, and returns (process, finish_function) as used by
+    # MemoryAwareScheduler. finish_function writes the completion marker if Rosetta succeeded.
+    # With scratch_dir (such as node-local $TMPDIR or /dev/shm), Rosetta is instead run in a new directory there, so
+    # that its many small SQLite transactions stay off the shared filesystem. Once it exits, its log is gzip compressed
+    # into output_directory, the databases and other files it wrote are copied back, and the scratch directory is removed.
+    # The completion marker is only written after everything has been copied back. If copying back fails (such as when
+    # the shared filesystem is full), finish_function raises CopyBackError, and the scratch directory is kept.
+    completion_marker_path = os.path.join( output_directory, completion_marker_file_name )
+    remove_previous_run_output( output_directory, completion_marker_file_name, log_file_name )
+
+    if scratch_dir != None:
+        if not os.path.isdir( scratch_dir ):
+            os.makedirs( scratch_dir )
+        working_directory = tempfile.mkdtemp( prefix = 'flex_ddG_', dir = scratch_dir )
+    else:
+        working_directory = output_directory
+
+    outfile = open( os.path.join( working_directory, log_file_name ), 'w' )
+    process = subprocess.Popen( args, stdout = outfile, stderr = subprocess.STDOUT, close_fds = True, cwd = working_directory )
+
+    def finish( returncode ):
+        outfile.close()
+        if scratch_dir != None:
+            # Copied back on failure as well, to keep the log
+            try:
+                copy_back_from_scratch( working_directory, output_directory, log_file_name )
+            except OSError as e:
+                raise CopyBackError( 'could not copy the output of %s back from %s (%s), leaving it there' % (output_directory, working_directory, e) )
+        if returncode == 0:
+            with open( completion_marker_path, 'w' ) as f:
+                f.write( 'returncode %d\n' % returncode )
+
+    return (process, finish)
+
+def record_job_exit( start_function, args, start_time, returncode, rusage ):
+    record_process_exit( 'rosetta', start_time, rusage, job = getattr( start_function, '__name__', str(start_function) ), args = [ str(arg) for arg in args ], returncode = returncode )
+
+def finish_job( finish_function, returncode ):
+    # Returns the returncode of the run, or None if its output could not be copied back from scratch
+    try:
+        finish_function( returncode )
+    except CopyBackError as e:
+        print( 'ERROR: %s' % e )
+        return None
+    return returncode
+
+def run_job( start_function, args ):
+    # Runs a single job (see MemoryAwareScheduler) in the foreground, and returns its returncode (see finish_job)
+    start_time = time.time()
+    process, finish_function = start_function( *args )
+    returncode, rusage = wait_for_process( process )
+    record_job_exit( start_function, args, start_time, returncode, rusage )
+    return finish_job( finish_function, returncode )
+
+class MemoryAwareScheduler:
+    # Each job is a (start_function, args) pair. start_function(*args) must start a subprocess and return
+    # (process, finish_function); finish_function(returncode) is called once the process has exited.
+    # Jobs that depend on another job can be queued from its finish_function with add_job.
+    # A job whose finish_function raises CopyBackError is counted as failed, with a returncode of None, and the
+    # other jobs carry on.
+    def __init__( self, max_processes = None, job_memory_estimate = default_job_memory_estimate, memory_reserve_fraction = default_memory_reserve_fraction, poll_interval = 1.0 ):
+        self.max_processes = max_processes or get_cpu_count()
+        self.job_memory_estimate = job_memory_estimate
+        self.memory_reserve_fraction = memory_reserve_fraction
+        self.poll_interval = poll_interval
+        self.pending = collections.deque()
+        self.running = [] # [process, finish_function, peak_rss, start_time, start_function, args]
+        self.returncodes = []
+        self.finished_peak_rss = 0 # Largest peak RSS of any job that has run to completion
+
+    def expected_job_memory( self ):
+        # Until a job has finished, and so has been measured over its whole run, the initial estimate is used as a lower bound
+        running_peak_rss = max( [0] + [ job[2] for job in self.running ] )
+        if self.finished_peak_rss > 0:
+            return max( self.finished_peak_rss, running_peak_rss )
+        return max( self.job_memory_estimate, running_peak_rss )
+
+    def update_running( self ):
+        still_running = []
+        for job in self.running:
+            process, finish_function, peak_rss, start_time, start_function, args = job
+            returncode, rusage = wait_for_process( process, nohang = True )
+            if returncode is None:
+                job[2] = max( peak_rss, get_process_rss( process.pid ) )
+                still_running.append( job )
+            else:
+                if rusage != None:
+                    # The kernel's peak RSS also covers any growth between polls
+                    peak_rss = max( peak_rss, rusage.ru_maxrss * 1024 )
+                self.finished_peak_rss = max( self.finished_peak_rss, peak_rss )
+                record_job_exit( start_function, args, start_time, returncode, rusage )
+                self.returncodes.append( finish_job( finish_function, returncode ) )
+        self.running = still_running
+
+    def can_start_job( self ):
+        if len(self.running) >= self.max_processes:
+            return False
+        if len(self.running) == 0:
+            # Always make progress, even if memory is tight
+            return True
+
+        available, total = get_available_memory()
+        if available is None:
+            return True
+
+        # Memory that running jobs have not yet grown into is not really available
+        expected_job_memory = self.expected_job_memory()
+        pending_growth = sum( [ max( 0, expected_job_memory - job[2] ) for job in self.running ] )
+        return available - pending_growth - expected_job_memory >= total * self.memory_reserve_fraction
+
+    def add_job( self, start_function, args ):
+        self.pending.append( (start_function, args) )
+
+    def run( self, jobs, next_job = None ):
+        # If given, next_job() is asked for another job whenever there is room to start one and nothing is pending.
+        # It returns a (start_function, args) pair, or None if it has nothing to start right now.
+        self.pending.extend( jobs )
+        while True:
+            self.update_running()
+            while self.can_start_job():
+                if len(self.pending) == 0 and next_job != None:
+                    job = next_job()
+                    if job is not None:
+                        self.pending.append( job )
+                if len(self.pending) == 0:
+                    break
+                start_function, args = self.pending.popleft()
+                start_time = time.time()
+                process, finish_function = start_function( *args )
+                self.running.append( [process, finish_function, get_process_rss( process.pid ), start_time, start_function, args] )
+            if len(self.running) > 0:
+                time.sleep( self.poll_interval )
+            elif len(self.pending) == 0:
+                break
+        return self.returncodes
+
+class RunJournal:
+    # Appends a line per launch event (started, finished, failed, timeout, skipped, cleaned) for each output directory
+    # to a tab separated log, so that it is possible to see which runs were in progress when a sweep was interrupted.
+    def __init__( self, path ):
+        self.path = path
+        journal_directory = os.path.dirname( path )
+        if journal_directory != '' and not os.path.isdir( journal_directory ):
+            os.makedirs( journal_directory )
+
+    def record( self, event, output_directory, returncode = None ):
+        with open( self.path, 'a' ) as f:
+            f.write( '%s\t%s\t%s\t%s\n' % (
+                datetime.datetime.now().strftime( '%Y-%m-%d %H:%M:%S' ), event, output_directory,
+                '' if returncode is None else returncode,
+            ) )
+
+    def journaled( self, start_function, get_output_directory ):
+        # Wraps a start function (see MemoryAwareScheduler) so that its start and end are recorded
+        @functools.wraps( start_function )
+        def journaled_start_function( *args ):
+            output_directory = get_output_directory( *args )
+            self.record( 'started', output_directory )
+            process, finish_function = start_function( *args )
+            def journaled_finish_function( returncode ):
+                try:
+                    finish_function( returncode )
+                except CopyBackError:
+                    self.record( 'failed', output_directory, returncode )
+                    raise
+                self.record( 'finished' if returncode == 0 else 'failed', output_directory, returncode )
+            return (process, journaled_finish_function)
+        return journaled_start_function
+
+def skip_completed_runs( cases, get_output_directory, journal = None ):
+    # Returns the cases whose output directory does not already hold a successful run, using the same
+    # success criteria as the analysis script. Output directories left by incomplete runs are removed,
+    # as Rosetta would otherwise append to their partially written databases.
+    from analyze_flex_ddG import rosetta_output_succeeded
+
+    cases_to_run = []
+    for args in cases:
+        output_directory = get_output_directory( *args )
+        if rosetta_output_succeeded( output_directory ):
+            if journal != None:
+                journal.record( 'skipped', output_directory )
+            continue
+        if os.path.isdir( output_directory ):
+            shutil.rmtree( output_directory )
+            if journal != None:
+                journal.record( 'cleaned', output_directory )
+        cases_to_run.append( args )
+    return cases_to_run
+
+class AdaptiveNstruct:
+    # Runs each case's nstruct replicates only until its ddG has converged. cases holds the args of every replicate, as
+    # for skip_completed_runs, and replicates are grouped into cases by the parent of their output directory.
+    # min_nstruct replicates of every case are started first (at least min_structs_for_standard_error). After that, each
+    # free slot first goes to a case with fewer than min_nstruct successful or running replicates, replacing ones that
+    # failed, and then to the unconverged case with the largest bootstrap standard error of its mean ddG, scaled down
+    # for the replicates it still has running. A case has converged once that projected standard error is below
+    # se_threshold, or all its replicates have run.
+    # finished_cases are replicates that already ran successfully (such as those skipped by skip_completed_runs), and count towards their case.
+    def __init__( self, cases, start_function, get_output_directory, min_nstruct, se_threshold, finished_cases = () ):
+        self.start_function = start_function
+        self.get_output_directory = get_output_directory
+        self.min_nstruct = max( min_structs_for_standard_error, min_nstruct )
+        self.se_threshold = se_threshold
+        self.unscheduled = collections.OrderedDict() # case directory -> deque of replicate args not yet started
+        for args in cases:
+            self.unscheduled.setdefault( os.path.dirname( get_output_directory( *args ) ), collections.deque() ).append( args )
+        self.started = collections.Counter()
+        self.failed = collections.Counter()
+        self.struct_ddgs = collections.defaultdict( list ) # case directory -> ddG rows of each finished struct, at the final backrub step
+        self.standard_errors = {}
+        for args in finished_cases:
+            output_directory = get_output_directory( *args )
+            case_directory = os.path.dirname( output_directory )
+            self.unscheduled.setdefault( case_directory, collections.deque() )
+            self.started[case_directory] += 1
+            self.add_finished_struct( case_directory, output_directory )
+
+    def add_finished_struct( self, case_directory, output_directory ):
+        from analyze_flex_ddG import output_database_name, get_scores_from_db3_file, calc_signed_struct_sums, scored_state_signs
+        scores = get_scores_from_db3_file( os.path.join( output_directory, output_database_name ), int( os.path.basename(output_directory) ), os.path.basename(case_directory) )
+        struct_sums = calc_signed_struct_sums( scores, scored_state_signs['ddG'] )
+        self.struct_ddgs[case_directory].append( struct_sums.loc[ struct_sums['backrub_steps'] == struct_sums['backrub_steps'].max() ] )
+        self.update_standard_error( case_directory )
+
+    def update_standard_error( self, case_directory ):
+        # The largest standard error over the case's score functions
+        import pandas as pd
+        from analyze_flex_ddG import bootstrap_standard_error
+        if len(self.struct_ddgs[case_directory]) < self.min_nstruct:
+            return
+        struct_ddgs = pd.concat( self.struct_ddgs[case_directory] )
+        self.standard_errors[case_directory] = max( [
+            bootstrap_standard_error( ddgs['total_score'].values ) for score_function_name, ddgs in struct_ddgs.groupby( 'score_function_name' )
+        ] )
+
+    def expected_structs( self, case_directory ):
+        # Replicates of the case that have succeeded or are still running
+        return self.started[case_directory] - self.failed[case_directory]
+
+    def projected_standard_error( self, case_directory ):
+        # Expected standard error once the case's running replicates have also finished
+        finished = len( self.struct_ddgs[case_directory] )
+        expected = self.expected_structs( case_directory )
+        return self.standard_errors[case_directory] * ( float(finished) / max( finished, expected ) ) ** 0.5
+
+    def is_converged( self, case_directory ):
+        return case_directory in self.standard_errors and self.projected_standard_error( case_directory ) < self.se_threshold
+
+    def start_replicate( self, *args ):
+        from analyze_flex_ddG import rosetta_output_succeeded
+        output_directory = self.get_output_directory( *args )
+        case_directory = os.path.dirname( output_directory )
+        process, finish_function = self.start_function( *args )
+        def finish_replicate( returncode ):
+            try:
+                finish_function( returncode )
+            except CopyBackError:
+                self.failed[case_directory] += 1
+                raise
+            if returncode == 0 and rosetta_output_succeeded( output_directory ):
+                self.add_finished_struct( case_directory, output_directory )
+                if self.is_converged( case_directory ) and len(self.unscheduled[case_directory]) > 0:
+                    print( 'Converged: %s (ddG standard error %.3f after %d structs)' % (case_directory, self.standard_errors[case_directory], len(self.struct_ddgs[case_directory])) )
+            else:
+                self.failed[case_directory] += 1
+        return (process, finish_replicate)
+
+    def schedule( self, case_directory ):
+        self.started[case_directory] += 1
+        return ( self.start_replicate, self.unscheduled[case_directory].popleft() )
+
+    def initial_jobs( self ):
+        jobs = []
+        for i in range( self.min_nstruct ):
+            for case_directory, replicates in self.unscheduled.items():
+                if len(replicates) > 0 and self.expected_structs( case_directory ) < self.min_nstruct:
+                    jobs.append( self.schedule( case_directory ) )
+        return jobs
+
+    def next_job( self ):
+        # Cases that can not have a standard error yet, including those whose initial replicates failed, come first
+        for case_directory, replicates in self.unscheduled.items():
+            if len(replicates) > 0 and self.expected_structs( case_directory ) < self.min_nstruct:
+                return self.schedule( case_directory )
+        candidates = [
+            case_directory for case_directory, replicates in self.unscheduled.items()
+            if len(replicates) > 0 and case_directory in self.standard_errors and not self.is_converged( case_directory )
+        ]
+        if len(candidates) == 0:
+            return None
+        return self.schedule( max( candidates, key = self.projected_standard_error ) )
+
+    def run( self, scheduler ):
+        scheduler.run( self.initial_jobs(), next_job = self.next_job )
+        for case_directory in self.unscheduled:
+            standard_error = self.standard_errors.get( case_directory )
+            print( '%s: %d structs, ddG standard error %s' % (
+                case_directory, len(self.struct_ddgs[case_directory]), 'unknown' if standard_error is None else '%.3f' % standard_error,
+            ) )
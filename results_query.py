@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# Answers queries about the -results files written by analyze_flex_ddG.py and score_warehouse.py (such as "the ddG
+# of case X at nstruct 35 under fa_talaris2014-gam", or "the 50 most stabilizing mutations") from memory, instead
+# of parsing the whole file again for every question. A results file is loaded once into a ResultsIndex: its key
+# columns are stored as integer arrays (the string keys as codes into lists of names), and its scores as one float
+# array, with a dict from each row's key to its row number for point queries. Rows sorted by total_score are built
+# once per (scored_state, score_function_name, backrub_steps, nstruct) group, so a top-k query is a slice.
+#
+# ResultsCache keeps the most recently used result sets loaded, and loads a file again when it has changed on disk.
+# It can be used as a library (from notebooks), from the command line, or served as JSON over HTTP on localhost.
+
+import os
+import json
+import argparse
+import collections
+import urllib.parse
+import http.server
+
+import numpy as np
+import pandas as pd
+
+from analyze_flex_ddG import script_output_folder
+
+key_columns = ['case_name', 'scored_state', 'score_function_name', 'backrub_steps', 'nstruct']
+name_key_columns = ['case_name', 'scored_state', 'score_function_name'] # Stored as codes into ResultsIndex.names
+results_cache_size = 8 # Result sets kept loaded by ResultsCache
+server_address = '127.0.0.1' # The query server only accepts connections from this machine
+default_server_port = 8765
+default_top_k = 50
+
+def get_results_path( output_folder, output_format = 'csv' ):
+    # The path analyze_flex_ddG.analyze_output_folder writes the results of output_folder to
+    return os.path.join( script_output_folder, os.path.basename( os.path.normpath(output_folder) ) + '-results.' + output_format )
+
+def get_results_fingerprint( results_path ):
+    # Parquet results are a dataset directory of part files, which is fingerprinted by all of its files
+    if os.path.isdir( results_path ):
+        paths = sorted( [ os.path.join( root, file_name ) for root, dirs, file_names in os.walk( results_path ) for file_name in file_names ] )
+    else:
+        paths = [ results_path ]
+    fingerprint = []
+    for path in paths:
+        st = os.stat( path )
+        fingerprint.append( (path, st.st_mtime_ns, st.st_size) )
+    return tuple( fingerprint )
+
+def read_results_file( results_path ):
+    if results_path.endswith( '.csv' ):
+        return pd.read_csv( results_path, index_col = 0 )
+    if results_path.endswith( '.parquet' ):
+        return pd.read_parquet( results_path )
+    if results_path.endswith( '.feather' ):
+        return pd.read_feather( results_path )
+    raise Exception( 'Unknown results file format of %s (expected .csv, .parquet or .feather)' % results_path )
+
+class ResultsIndex:
+    def __init__( self, df ):
+        missing_columns = [ column for column in key_columns if column not in df.columns ]
+        if len(missing_columns) > 0:
+            raise Exception( 'Results are missing the key columns %s' % ', '.join( missing_columns ) )
+        self.names = {} # column -> list of names; the column's codes index this list
+        self.codes = {} # column -> { name : code }
+        self.keys = {} # column -> int32 array of the column (codes for name_key_columns)
+        for column in name_key_columns:
+            codes, names = pd.factorize( df[column].astype( str ) )
+            self.names[column] = names.tolist()
+            self.codes[column] = { name : code for code, name in enumerate( self.names[column] ) }
+            self.keys[column] = codes.astype( np.int32 )
+        for column in ['backrub_steps', 'nstruct']:
+            self.keys[column] = df[column].to_numpy( dtype = np.int32 )
+        self.value_columns = [ column for column in df.columns if column not in key_columns and pd.api.types.is_numeric_dtype( df[column] ) ]
+        self.values = df[self.value_columns].to_numpy( dtype = np.float64 )
+        self.total_scores = self.values[ :, self.value_columns.index( 'total_score' ) ]
+
+        # Point lookups: the full key, and the key without nstruct (as -1), which finds the row with the most structs
+        self.rows = {}
+        key_arrays = [ self.keys[column].tolist() for column in key_columns ]
+        for row, key in enumerate( zip( *key_arrays ) ):
+            self.rows[key] = row
+            last_key = key[:4] + (-1,)
+            last_row = self.rows.get( last_key )
+            if last_row == None or key[4] > key_arrays[4][last_row]:
+                self.rows[last_key] = row
+        self.sorted_rows = {} # Top-k group key -> rows sorted by total_score, built when the group is first queried
+
+    def __len__( self ):
+        return len(self.total_scores)
+
+    def get_code( self, column, name ):
+        code = self.codes[column].get( name )
+        if code == None:
+            raise Exception( 'No results with %s %s (choices: %s)' % (column, name, ', '.join( self.names[column] )) )
+        return code
+
+    def get_last_backrub_steps( self ):
+        return int( self.keys['backrub_steps'].max() )
+
+    def get_row( self, case_name, score_function_name, scored_state = 'ddG', backrub_steps = None, nstruct = None ):
+        # Returns the row number of a result. By default, the result at the last backrub checkpoint and with the
+        # largest nstruct of the case is returned.
+        if backrub_steps == None:
+            backrub_steps = self.get_last_backrub_steps()
+        key = (
+            self.get_code( 'case_name', case_name ), self.get_code( 'scored_state', scored_state ),
+            self.get_code( 'score_function_name', score_function_name ), backrub_steps, -1 if nstruct == None else nstruct,
+        )
+        row = self.rows.get( key )
+        if row == None:
+            raise Exception( 'No %s result of %s under %s at %s backrub steps and nstruct %s' % (scored_state, case_name, score_function_name, backrub_steps, nstruct) )
+        return row
+
+    def get_result( self, row ):
+        # The result of a row number as a dict
+        result = { column : self.names[column][ self.keys[column][row] ] for column in name_key_columns }
+        result['backrub_steps'] = int( self.keys['backrub_steps'][row] )
+        result['nstruct'] = int( self.keys['nstruct'][row] )
+        for column, value in zip( self.value_columns, self.values[row].tolist() ):
+            result[column] = None if np.isnan( value ) else value
+        return result
+
+    def query( self, case_name, score_function_name, scored_state = 'ddG', backrub_steps = None, nstruct = None ):
+        return self.get_result( self.get_row( case_name, score_function_name, scored_state = scored_state, backrub_steps = backrub_steps, nstruct = nstruct ) )
+
+    def get_sorted_rows( self, scored_state, score_function_name, backrub_steps, nstruct ):
+        # Rows of a group in increasing total_score, with NaN scores left out. With nstruct None, the group holds
+        # the row with the largest nstruct of each case.
+        group_key = ( self.get_code( 'scored_state', scored_state ), self.get_code( 'score_function_name', score_function_name ), backrub_steps, nstruct )
+        rows = self.sorted_rows.get( group_key )
+        if rows is None:
+            if nstruct == None:
+                rows = np.array( sorted( [ row for key, row in self.rows.items() if key[1:] == group_key[:3] + (-1,) ] ), dtype = np.int64 )
+            else:
+                rows = np.flatnonzero(
+                    ( self.keys['scored_state'] == group_key[0] ) & ( self.keys['score_function_name'] == group_key[1] )
+                    & ( self.keys['backrub_steps'] == backrub_steps ) & ( self.keys['nstruct'] == nstruct )
+                )
+            rows = rows[ ~np.isnan( self.total_scores[rows] ) ]
+            rows = rows[ np.argsort( self.total_scores[rows], kind = 'stable' ) ]
+            self.sorted_rows[group_key] = rows
+        return rows
+
+    def top( self, score_function_name, k = default_top_k, scored_state = 'ddG', backrub_steps = None, nstruct = None, highest = False ):
+        # The k results of a group with the lowest total_score (for ddG, the most stabilizing mutations), or with highest
+        # the k with the highest. By default, each case's result at the last backrub checkpoint with its largest nstruct is ranked.
+        if backrub_steps == None:
+            backrub_steps = self.get_last_backrub_steps()
+        rows = self.get_sorted_rows( scored_state, score_function_name, backrub_steps, nstruct )
+        rows = rows[ ::-1 ][ :k ] if highest else rows[ :k ]
+        return [ self.get_result( row ) for row in rows.tolist() ]
+
+class ResultsCache:
+    # Keeps up to max_result_sets ResultsIndexes loaded, dropping the least recently used. A results file that has
+    # changed since it was loaded (such as by a new run of analyze_flex_ddG.py) is loaded again when it is next used.
+    def __init__( self, max_result_sets = results_cache_size ):
+        self.max_result_sets = max_result_sets
+        self.result_sets = collections.OrderedDict() # Absolute path -> (fingerprint, ResultsIndex)
+        self.loads = 0
+
+    def get( self, results_path ):
+        results_path = os.path.abspath( results_path )
+        fingerprint = get_results_fingerprint( results_path )
+        entry = self.result_sets.get( results_path )
+        if entry != None and entry[0] == fingerprint:
+            self.result_sets.move_to_end( results_path )
+            return entry[1]
+        index = ResultsIndex( read_results_file( results_path ) )
+        self.loads += 1
+        self.result_sets[results_path] = (fingerprint, index)
+        self.result_sets.move_to_end( results_path )
+        while len(self.result_sets) > self.max_result_sets:
+            self.result_sets.popitem( last = False )
+        return index
+
+    def query( self, results_path, case_name, score_function_name, **kwargs ):
+        return self.get( results_path ).query( case_name, score_function_name, **kwargs )
+
+    def top( self, results_path, score_function_name, **kwargs ):
+        return self.get( results_path ).top( score_function_name, **kwargs )
+
+def get_int_parameter( parameters, name, default = None ):
+    value = parameters.get( name )
+    return default if value == None else int( value )
+
+def make_request_handler( cache, results_paths ):
+    # Queries name their results file by its file name, and can only read the files the server was started with
+    results_paths = { os.path.basename( os.path.normpath( results_path ) ) : results_path for results_path in results_paths }
+
+    class ResultsRequestHandler( http.server.BaseHTTPRequestHandler ):
+        def send_json( self, status, data ):
+            body = json.dumps( data ).encode()
+            self.send_response( status )
+            self.send_header( 'Content-Type', 'application/json' )
+            self.send_header( 'Content-Length', str(len(body)) )
+            self.end_headers()
+            self.wfile.write( body )
+
+        def do_GET( self ):
+            url = urllib.parse.urlparse( self.path )
+            parameters = { name : values[-1] for name, values in urllib.parse.parse_qs( url.query ).items() }
+            results_name = parameters.get( 'results' )
+            if results_name == None and len(results_paths) == 1:
+                results_name = next( iter( results_paths ) )
+            if url.path == '/results':
+                self.send_json( 200, sorted( results_paths ) )
+                return
+            try:
+                if results_name not in results_paths:
+                    raise Exception( 'Unknown results %s (choices: %s)' % (results_name, ', '.join( sorted( results_paths ) )) )
+                query_parameters = dict(
+                    scored_state = parameters.get( 'scored_state', 'ddG' ),
+                    backrub_steps = get_int_parameter( parameters, 'backrub_steps' ),
+                    nstruct = get_int_parameter( parameters, 'nstruct' ),
+                )
+                if url.path == '/query':
+                    result = cache.query( results_paths[results_name], parameters.get( 'case_name' ), parameters.get( 'score_function_name' ), **query_parameters )
+                elif url.path == '/top':
+                    result = cache.top(
+                        results_paths[results_name], parameters.get( 'score_function_name' ), k = get_int_parameter( parameters, 'k', default_top_k ),
+                        highest = parameters.get( 'order' ) == 'highest', **query_parameters
+                    )
+                else:
+                    self.send_json( 404, { 'error' : 'Unknown path %s (expected /query, /top or /results)' % url.path } )
+                    return
+            except Exception as e:
+                self.send_json( 400, { 'error' : str(e) } )
+                return
+            self.send_json( 200, result )
+
+        def log_message( self, format, *args ):
+            pass
+
+    return ResultsRequestHandler
+
+def serve( results_paths, port = default_server_port, max_result_sets = results_cache_size ):
+    cache = ResultsCache( max_result_sets = max_result_sets )
+    for results_path in results_paths:
+        cache.get( results_path )
+    server = http.server.HTTPServer( (server_address, port), make_request_handler( cache, results_paths ) )
+    print( 'Serving %s at http://%s:%d/' % (', '.join( results_paths ), server_address, port) )
+    print( 'For example: http://%s:%d/top?score_function_name=fa_talaris2014-gam&k=10' % (server_address, port) )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def print_results( results ):
+    print( pd.DataFrame( results ).to_string( index = False ) )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'Query the results files of analyze_flex_ddG.py, or serve queries of them over HTTP on localhost' )
+    parser.add_argument( 'results', nargs = '+', help = 'Results file(s), such as %s' % get_results_path( 'output' ) )
+    parser.add_argument( '--case-name', help = 'Print the result of this case' )
+    parser.add_argument( '--top', type = int, metavar = 'K', help = 'Print the K results with the lowest total_score (the most stabilizing, for ddG)' )
+    parser.add_argument( '--highest', action = 'store_true', help = 'With --top, print the results with the highest total_score instead' )
+    parser.add_argument( '--score-function-name', help = 'Score function of the results, such as fa_talaris2014-gam' )
+    parser.add_argument( '--scored-state', default = 'ddG', help = 'ddG, mut_dG or wt_dG (default: ddG)' )
+    parser.add_argument( '--backrub-steps', type = int, help = 'Backrub checkpoint of the results (default: the last)' )
+    parser.add_argument( '--nstruct', type = int, help = 'Number of structs of the results (default: the largest of each case)' )
+    parser.add_argument( '--serve', action = 'store_true', help = 'Serve /query, /top and /results as JSON at http://%s:PORT/, with the same parameters as the options here' % server_address )
+    parser.add_argument( '--port', type = int, default = default_server_port, help = 'Port to serve on (default: %d)' % default_server_port )
+    args = parser.parse_args()
+
+    if args.serve:
+        serve( args.results, port = args.port )
+    else:
+        if args.case_name == None and args.top == None:
+            parser.error( 'Pass --case-name, --top or --serve' )
+        if args.score_function_name == None:
+            parser.error( '--case-name and --top require --score-function-name' )
+        cache = ResultsCache()
+        for results_path in args.results:
+            query_parameters = dict( scored_state = args.scored_state, backrub_steps = args.backrub_steps, nstruct = args.nstruct )
+            if args.case_name != None:
+                print_results( [ cache.query( results_path, args.case_name, args.score_function_name, **query_parameters ) ] )
+            if args.top != None:
+                print_results( cache.top( results_path, args.score_function_name, k = args.top, highest = args.highest, **query_parameters ) )
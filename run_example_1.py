@@ -6,11 +6,17 @@ import socket
 import sys
 import os
 import subprocess
+import argparse
+
+import flex_ddg_launcher
+import job_manifest
+from starting_structure_cache import preminimized_script_path, preminimize_inputs, get_preminimized_pdb, verify_preminimized
+from job_scheduler import start_rosetta_process, get_scratch_dir, run_job, completion_marker_file_name
+from generate_mutation_sweep import read_job_table, find_input_pdb, read_chains_to_move
 
 use_multiprocessing = True
 if use_multiprocessing:
-    import multiprocessing
-    max_cpus = 2 # We might want to not run on the full number of cores, as Rosetta take about 2 Gb of memory per instance
+    max_cpus = None # Defaults to all available cores
 
 ###################################################################################################################################################################
 # Important: The variables below are set to values that will make the run complete faster (as a tutorial example), but will not give scientifically valid results.
@@ -24,72 +30,115 @@ abs_score_convergence_thresh = 200.0 # Normally 1.0
 number_backrub_trials = 10 # Normally 35000
 backrub_trajectory_stride = 5 # Can be whatever you want, if you would like to see results from earlier time points in the backrub trajectory. 7000 is a reasonable number, to give you three checkpoints for a 35000 step run, but you could also set it to 35000 for quickest run time (as the final minimization and packing steps will only need to be run one time).
 path_to_script = 'ddG-backrub.xml'
+output_folder = 'output'
+run_journal_path = os.path.join( output_folder, 'run_journal.tsv' )
+use_preminimized = False # If set (with --preminimize), replicates start from a cached pre-minimized structure of their input PDB, see starting_structure_cache.py
+rosetta_flags = [
+    '-restore_talaris_behavior',
+    '-in:file:fullatom',
+    '-ignore_unrecognized_res',
+    '-ignore_zero_occupancy false',
+    '-ex1',
+    '-ex2',
+]
+scratch_dir = None # Set with --scratch
+
+def get_minimization_vars():
+    return [ 'max_minimization_iter=%d' % max_minimization_iter, 'abs_score_convergence_thresh=%.1f' % abs_score_convergence_thresh ]
 
 if not os.path.isfile(rosetta_scripts_path):
     print('ERROR: "rosetta_scripts_path" variable must be set to the location of the "rosetta_scripts" binary executable')
     print('This file might look something like: "rosetta_scripts.linuxgccrelease"')
     raise Exception('Rosetta scripts missing')
 
-def run_flex_ddg( name, input_path, input_pdb_path, chains_to_move, nstruct_i ):
-    output_directory = os.path.join( 'output', os.path.join( name, '%02d' % nstruct_i ) )
-    if not os.path.isdir(output_directory):
-        os.makedirs(output_directory)
+def get_output_directory( name, input_path, input_pdb_path, chains_to_move, nstruct_i, resfile_path = None ):
+    return os.path.join( output_folder, os.path.join( name, '%02d' % nstruct_i ) )
 
-    flex_ddg_args = [
+def get_flex_ddg_args( input_pdb_path, script_path, chains_to_move, resfile_path ):
+    return [
         os.path.abspath(rosetta_scripts_path),
         "-s %s" % os.path.abspath(input_pdb_path),
-        '-parser:protocol', os.path.abspath(path_to_script),
+        '-parser:protocol', os.path.abspath(script_path),
         '-parser:script_vars',
         'chainstomove=' + chains_to_move,
-        'mutate_resfile_relpath=' + os.path.abspath( os.path.join( input_path, 'nataa_mutations.resfile' ) ),
+        'mutate_resfile_relpath=' + os.path.abspath( resfile_path ),
         'number_backrub_trials=%d' % number_backrub_trials,
         'max_minimization_iter=%d' % max_minimization_iter,
         'abs_score_convergence_thresh=%.1f' % abs_score_convergence_thresh,
         'backrub_trajectory_stride=%d' % backrub_trajectory_stride ,
-        '-restore_talaris_behavior',
-        '-in:file:fullatom',
-        '-ignore_unrecognized_res',
-        '-ignore_zero_occupancy false',
-        '-ex1',
-        '-ex2',
-    ]
+    ] + rosetta_flags
+
+def get_resfile_path( input_path, resfile_path = None ):
+    # resfile_path defaults to the nataa_mutations.resfile of the input case
+    if resfile_path == None:
+        return os.path.join( input_path, 'nataa_mutations.resfile' )
+    return resfile_path
+
+def get_flex_ddg_job( name, input_path, input_pdb_path, chains_to_move, nstruct_i, resfile_path = None ):
+    # Returns the Rosetta args and output directory of a run, as used by AsyncLauncher
+    resfile_path = get_resfile_path( input_path, resfile_path )
+    output_directory = get_output_directory( name, input_path, input_pdb_path, chains_to_move, nstruct_i )
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
 
-    log_path = os.path.join(output_directory, 'rosetta.out')
+    script_path = path_to_script
+    if use_preminimized:
+        input_pdb_path = get_preminimized_pdb( rosetta_scripts_path, input_pdb_path, get_minimization_vars(), rosetta_flags )
+        script_path = preminimized_script_path
+
+    flex_ddg_args = get_flex_ddg_args( input_pdb_path, script_path, chains_to_move, resfile_path )
 
     print( 'Running Rosetta with args:' )
     print( ' '.join(flex_ddg_args) )
-    print( 'Output logged to:', os.path.abspath(log_path) )
+    return (flex_ddg_args, output_directory)
+
+def start_flex_ddg( *args ):
+    flex_ddg_args, output_directory = get_flex_ddg_job( *args )
+    log_path = os.path.join(output_directory, 'rosetta.out')
+    print( 'Output logged to:', os.path.abspath(log_path) + ( '.gz' if scratch_dir != None else '' ) )
     print()
 
-    outfile = open(log_path, 'w')
-    process = subprocess.Popen(flex_ddg_args, stdout=outfile, stderr=subprocess.STDOUT, close_fds = True, cwd = output_directory)
-    returncode = process.wait()
-    outfile.close()
+    return start_rosetta_process( flex_ddg_args, output_directory, completion_marker_file_name, scratch_dir = scratch_dir )
+
+def run_flex_ddg( *args ):
+    return run_job( start_flex_ddg, args )
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--job-table', help = 'Run the cases of a job table written by generate_mutation_sweep.py, instead of the nataa_mutations.resfile of each input case' )
+    flex_ddg_launcher.add_arguments( parser )
+    args = flex_ddg_launcher.parse_arguments( parser )
+    scratch_dir = get_scratch_dir( args.scratch )
+    max_processes = max_cpus if use_multiprocessing else 1
+
     cases = []
-    for nstruct_i in range(1, nstruct + 1 ):
-        for case_name in os.listdir('inputs'):
-            case_path = os.path.join( 'inputs', case_name )
-            for f in os.listdir(case_path):
-                if f.endswith('.pdb'):
-                    input_pdb_path = os.path.join( case_path, f )
-                    break
-
-            with open( os.path.join( case_path, 'chains_to_move.txt' ), 'r' ) as f:
-                chains_to_move = f.readlines()[0].strip()
-
-            cases.append( (case_name, case_path, input_pdb_path, chains_to_move, nstruct_i) )
-
-    if use_multiprocessing:
-        pool = multiprocessing.Pool( processes = min(max_cpus, multiprocessing.cpu_count()) )
-
-    for args in cases:
-        if use_multiprocessing:
-            pool.apply_async( run_flex_ddg, args = args )
-        else:
-            run_flex_ddg( *args )
-
-    if use_multiprocessing:
-        pool.close()
-        pool.join()
+    if args.job_table:
+        jobs = read_job_table( args.job_table )
+        for nstruct_i in range(1, nstruct + 1 ):
+            for job in jobs:
+                case_path = os.path.join( 'inputs', job['input_case'] )
+                cases.append( (job['case_name'], case_path, find_input_pdb(case_path), read_chains_to_move(case_path), nstruct_i, job['resfile']) )
+    else:
+        for nstruct_i in range(1, nstruct + 1 ):
+            for case_name in os.listdir('inputs'):
+                case_path = os.path.join( 'inputs', case_name )
+                cases.append( (case_name, case_path, find_input_pdb(case_path), read_chains_to_move(case_path), nstruct_i) )
+
+    if args.run_manifest:
+        cases = job_manifest.get_manifest_cases( args, os.path.basename(__file__) )
+
+    input_pdb_paths = sorted( set( [ case_args[2] for case_args in cases ] ) )
+    if args.verify_preminimized:
+        name, input_path, input_pdb_path, chains_to_move, nstruct_i = cases[0][:5]
+        resfile_path = get_resfile_path( input_path, *cases[0][5:] )
+        verify_preminimized( rosetta_scripts_path, input_pdb_paths, get_minimization_vars(), rosetta_flags, ddg_case = (
+            input_pdb_path, lambda pdb_path, script_path, output_directory: get_flex_ddg_args( pdb_path, script_path, chains_to_move, resfile_path ),
+        ) )
+    if args.preminimize:
+        use_preminimized = True
+        preminimize_inputs( rosetta_scripts_path, input_pdb_paths, get_minimization_vars(), rosetta_flags, max_processes = max_processes )
+
+    flex_ddg_launcher.run_cases(
+        args, os.path.basename(__file__), cases, get_output_directory, start_flex_ddg, get_flex_ddg_job, run_journal_path,
+        max_processes = max_processes, scratch_dir = scratch_dir,
+    )
@@ -6,98 +6,113 @@ import socket
 import sys
 import os
 import subprocess
+import argparse
+
+import flex_ddg_launcher
+import job_manifest
+from starting_structure_cache import preminimized_script_path, preminimize_inputs, get_preminimized_pdb, verify_preminimized
+from job_scheduler import start_rosetta_process, get_scratch_dir, run_job, completion_marker_file_name
+from run_example_1 import rosetta_scripts_path, path_to_script, rosetta_flags, get_minimization_vars, get_flex_ddg_args
 
 use_multiprocessing = True
 if use_multiprocessing:
-    import multiprocessing
-    max_cpus = 2 # We might want to not run on the full number of cores, as Rosetta take about 2 Gb of memory per instance
+    max_cpus = None # Defaults to all available cores
 
 ###################################################################################################################################################################
 # Important: The variables below are set to values that will make the run complete faster (as a tutorial example), but will not give scientifically valid results.
 #            Please change them to the "normal" default values before a real run.
 ###################################################################################################################################################################
 
-rosetta_scripts_path = os.path.expanduser("~/rosetta/source/bin/rosetta_scripts")
+# rosetta_scripts_path, the ddG-backrub.xml parameters and the Rosetta flags are those of run_example_1.py
 nstruct = 3 # Normally 35
-max_minimization_iter = 5 # Normally 5000
-abs_score_convergence_thresh = 200.0 # Normally 1.0
-number_backrub_trials = 10 # Normally 35000
-backrub_trajectory_stride = 5 # Can be whatever you want, if you would like to see results from earlier time points in the backrub trajectory. 7000 is a reasonable number, to give you three checkpoints for a 35000 step run, but you could also set it to 35000 for quickest run time (as the final minimization and packing steps will only need to be run one time).
-path_to_script = 'ddG-backrub.xml'
+output_folder = 'output_saturation'
+run_journal_path = os.path.join( output_folder, 'run_journal.tsv' )
+use_preminimized = False # Set with --preminimize
+scratch_dir = None # Set with --scratch
 residue_to_mutate = ('B', 49, '') # Residue position to perfrom saturation mutatagenesis. Format: (Chain, PDB residue number, insertion code).
 
-if not os.path.isfile(rosetta_scripts_path):
-    print('ERROR: "rosetta_scripts_path" variable must be set to the location of the "rosetta_scripts" binary executable')
-    print('This file might look something like: "rosetta_scripts.linuxgccrelease"')
-    raise Exception('Rosetta scripts missing')
-
-def run_flex_ddg_saturation( name, input_path, input_pdb_path, chains_to_move, mut_aa, nstruct_i ):
-    output_directory = os.path.join( 'output_saturation', os.path.join( '%s_%s' % (name, mut_aa), '%02d' % nstruct_i ) )
-    if not os.path.isdir(output_directory):
-        os.makedirs(output_directory)
-
+def get_inputs( inputs_folder = 'inputs' ):
+    # (case name, case path, input PDB path, chains to move) of each case directory in inputs_folder
+    inputs = []
+    for case_name in os.listdir(inputs_folder):
+        case_path = os.path.join( inputs_folder, case_name )
+        for f in os.listdir(case_path):
+            if f.endswith('.pdb'):
+                input_pdb_path = os.path.join( case_path, f )
+                break
+
+        with open( os.path.join( case_path, 'chains_to_move.txt' ), 'r' ) as f:
+            chains_to_move = f.readlines()[0].strip()
+        inputs.append( (case_name, case_path, input_pdb_path, chains_to_move) )
+    return inputs
+
+def get_output_directory( name, input_path, input_pdb_path, chains_to_move, mut_aa, nstruct_i ):
+    return os.path.join( output_folder, os.path.join( '%s_%s' % (name, mut_aa), '%02d' % nstruct_i ) )
+
+def write_mutation_resfile( output_directory, mut_aa ):
     mutation_chain, mutation_resi, mutation_icode = residue_to_mutate
     resfile_path = os.path.join( output_directory, 'mutate_%s%d%s_to_%s.resfile' % (mutation_chain, mutation_resi, mutation_icode, mut_aa) )
     with open( resfile_path, 'w') as f:
         f.write( 'NATRO\nstart\n%d%s %s PIKAA %s\n' % (mutation_resi, mutation_icode, mutation_chain, mut_aa) )
+    return resfile_path
 
-    flex_ddg_args = [
-        os.path.abspath(rosetta_scripts_path),
-        "-s %s" % os.path.abspath(input_pdb_path),
-        '-parser:protocol', os.path.abspath(path_to_script),
-        '-parser:script_vars',
-        'chainstomove=' + chains_to_move,
-        'mutate_resfile_relpath=' + os.path.abspath( resfile_path ),
-        'number_backrub_trials=%d' % number_backrub_trials,
-        'max_minimization_iter=%d' % max_minimization_iter,
-        'abs_score_convergence_thresh=%.1f' % abs_score_convergence_thresh,
-        'backrub_trajectory_stride=%d' % backrub_trajectory_stride ,
-        '-restore_talaris_behavior',
-        '-in:file:fullatom',
-        '-ignore_unrecognized_res',
-        '-ignore_zero_occupancy false',
-        '-ex1',
-        '-ex2',
-    ]
+def get_flex_ddg_saturation_job( name, input_path, input_pdb_path, chains_to_move, mut_aa, nstruct_i ):
+    # Returns the Rosetta args and output directory of a run, as used by AsyncLauncher
+    output_directory = get_output_directory( name, input_path, input_pdb_path, chains_to_move, mut_aa, nstruct_i )
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    resfile_path = write_mutation_resfile( output_directory, mut_aa )
 
-    log_path = os.path.join(output_directory, 'rosetta.out')
+    script_path = path_to_script
+    if use_preminimized:
+        input_pdb_path = get_preminimized_pdb( rosetta_scripts_path, input_pdb_path, get_minimization_vars(), rosetta_flags )
+        script_path = preminimized_script_path
+
+    flex_ddg_args = get_flex_ddg_args( input_pdb_path, script_path, chains_to_move, resfile_path )
 
     print( 'Running Rosetta with args:' )
     print( ' '.join(flex_ddg_args) )
-    print( 'Output logged to:', os.path.abspath(log_path) )
+    return (flex_ddg_args, output_directory)
+
+def start_flex_ddg_saturation( *args ):
+    flex_ddg_args, output_directory = get_flex_ddg_saturation_job( *args )
+    log_path = os.path.join(output_directory, 'rosetta.out')
+    print( 'Output logged to:', os.path.abspath(log_path) + ( '.gz' if scratch_dir != None else '' ) )
     print()
 
-    outfile = open(log_path, 'w')
-    process = subprocess.Popen(flex_ddg_args, stdout=outfile, stderr=subprocess.STDOUT, close_fds = True, cwd = output_directory)
-    returncode = process.wait()
-    outfile.close()
+    return start_rosetta_process( flex_ddg_args, output_directory, completion_marker_file_name, scratch_dir = scratch_dir )
+
+def run_flex_ddg_saturation( *args ):
+    return run_job( start_flex_ddg_saturation, args )
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    flex_ddg_launcher.add_arguments( parser )
+    args = flex_ddg_launcher.parse_arguments( parser )
+    scratch_dir = get_scratch_dir( args.scratch )
+    max_processes = max_cpus if use_multiprocessing else 1
+
     mutation_chain, mutation_resi, mutation_icode = residue_to_mutate
     cases = []
     for nstruct_i in range(1, nstruct + 1 ):
-        for case_name in os.listdir('inputs'):
-            case_path = os.path.join( 'inputs', case_name )
-            for f in os.listdir(case_path):
-                if f.endswith('.pdb'):
-                    input_pdb_path = os.path.join( case_path, f )
-                    break
-
-            with open( os.path.join( case_path, 'chains_to_move.txt' ), 'r' ) as f:
-                chains_to_move = f.readlines()[0].strip()
-
+        for case_name, case_path, input_pdb_path, chains_to_move in get_inputs():
             for mut_aa in 'ACDEFGHIKLMNPQRSTVWY':
                 cases.append( ('%s_%s%d%s' % (case_name, mutation_chain, mutation_resi, mutation_icode), case_path, input_pdb_path, chains_to_move, mut_aa, nstruct_i) )
 
-    if use_multiprocessing:
-        pool = multiprocessing.Pool( processes = min(max_cpus, multiprocessing.cpu_count()) )
-
-    for args in cases:
-        if use_multiprocessing:
-            pool.apply_async( run_flex_ddg_saturation, args = args )
-        else:
-            run_flex_ddg_saturation( *args )
-
-    if use_multiprocessing:
-        pool.close()
-        pool.join()
+    if args.run_manifest:
+        cases = job_manifest.get_manifest_cases( args, os.path.basename(__file__) )
+
+    input_pdb_paths = sorted( set( [ case_args[2] for case_args in cases ] ) )
+    if args.verify_preminimized:
+        name, input_path, input_pdb_path, chains_to_move, mut_aa, nstruct_i = cases[0]
+        verify_preminimized( rosetta_scripts_path, input_pdb_paths, get_minimization_vars(), rosetta_flags, ddg_case = (
+            input_pdb_path, lambda pdb_path, script_path, output_directory: get_flex_ddg_args( pdb_path, script_path, chains_to_move, write_mutation_resfile( output_directory, mut_aa ) ),
+        ) )
+    if args.preminimize:
+        use_preminimized = True
+        preminimize_inputs( rosetta_scripts_path, input_pdb_paths, get_minimization_vars(), rosetta_flags, max_processes = max_processes )
+
+    flex_ddg_launcher.run_cases(
+        args, os.path.basename(__file__), cases, get_output_directory, start_flex_ddg_saturation, get_flex_ddg_saturation_job, run_journal_path,
+        max_processes = max_processes, scratch_dir = scratch_dir,
+    )
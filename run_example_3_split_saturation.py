@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+
+import sys
+import os
+import shutil
+import subprocess
+import argparse
+
+import instrumentation
+import analyze_flex_ddG
+import flex_ddg_launcher
+from run_example_1 import rosetta_scripts_path, rosetta_flags
+from run_example_2_saturation import get_inputs
+from job_scheduler import MemoryAwareScheduler, RunJournal, start_rosetta_process, get_scratch_dir, skip_completed_runs, completion_marker_file_name
+
+max_cpus = None # Defaults to all available cores
+
+###################################################################################################################################################################
+# Important: The variables below are set to values that will make the run complete faster (as a tutorial example), but will not give scientifically valid results.
+#            Please change them to the "normal" default values before a real run.
+###################################################################################################################################################################
+
+# Saturation mutagenesis using the two step protocol in split_protocol/. The expensive backrub step only depends on the
+# mutated positions, so it is run once per (position, nstruct) and the cheap mutation step is then run for all
+# 20 amino acids against the cached backrub and minimized wild type models.
+
+# rosetta_scripts_path and the Rosetta flags are those of run_example_1.py, and the inputs those of run_example_2_saturation.py
+nstruct = 3 # Normally 35
+min_max_iter = 5 # Normally 5000
+min_abs_score_convergence_threshold = 200.0 # Normally 1.0
+min_tolerance = 0.000001
+backrub_trials = 10 # Normally 35000
+backrub_kt = 1.2
+neighbor_distance = 8.0 # Same neighborhood distance as ddG-backrub.xml
+backrub_script_path = os.path.join( 'split_protocol', 'flex_ddG-backrub_step.xml' )
+mutation_script_path = os.path.join( 'split_protocol', 'flex_ddG-mutation_step.xml' )
+residues_to_mutate = [ ('B', 49, '') ] # Residue positions to perform saturation mutagenesis. Format: (Chain, PDB residue number, insertion code).
+mutant_amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+backrub_output_folder = 'output_split_backrub'
+output_folder = 'output_split'
+run_journal_path = os.path.join( output_folder, 'run_journal.tsv' )
+scratch_dir = None # Set with --scratch
+
+# The backrub step is run with a single trajectory checkpoint (its stride is the number of trials), after which the
+# final backrub model is written by the job distributor and the repacked and minimized wild type model by the
+# PDBTrajectoryRecorder in flex_ddG-backrub_step.xml. The stride is recorded in output_folder, so that
+# analyze_flex_ddG.py labels the mutation step scores with the number of backrub trials that were run.
+wt_minimized_pdb_name = 'wt_minimized.pdb'
+
+def write_trajectory_stride():
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    with open( os.path.join( output_folder, analyze_flex_ddG.trajectory_stride_file_name ), 'w' ) as f:
+        f.write( '%d\n' % backrub_trials )
+
+def position_name( residue ):
+    chain, resi, icode = residue
+    return '%s%d%s' % (chain, resi, icode)
+
+def get_backrub_output_directory( name, input_pdb_path, chains_to_move, residue, nstruct_i ):
+    return os.path.join( backrub_output_folder, os.path.join( '%s_%s' % (name, position_name(residue)), '%02d' % nstruct_i ) )
+
+def get_backrub_pdb_paths( name, input_pdb_path, chains_to_move, residue, nstruct_i ):
+    output_directory = get_backrub_output_directory( name, input_pdb_path, chains_to_move, residue, nstruct_i )
+    backrub_pdb_name = '%s_0001.pdb' % os.path.splitext( os.path.basename(input_pdb_path) )[0]
+    return ( os.path.join( output_directory, backrub_pdb_name ), os.path.join( output_directory, wt_minimized_pdb_name ) )
+
+def backrub_step_succeeded( *backrub_args ):
+    output_directory = get_backrub_output_directory( *backrub_args )
+    if not os.path.isfile( os.path.join( output_directory, completion_marker_file_name ) ):
+        return False
+    return all( [ os.path.isfile( path ) for path in get_backrub_pdb_paths( *backrub_args ) ] )
+
+def get_mutation_output_directory( name, input_pdb_path, chains_to_move, residue, nstruct_i, mut_aa ):
+    return os.path.join( output_folder, os.path.join( '%s_%s_%s' % (name, position_name(residue), mut_aa), '%02d' % nstruct_i ) )
+
+def start_rosetta( output_directory, args ):
+    log_path = os.path.join(output_directory, 'rosetta.out')
+
+    print( 'Running Rosetta with args:' )
+    print( ' '.join(args) )
+    print( 'Output logged to:', os.path.abspath(log_path) + ( '.gz' if scratch_dir != None else '' ) )
+    print()
+
+    return start_rosetta_process( args, output_directory, completion_marker_file_name, scratch_dir = scratch_dir )
+
+def start_backrub_step( name, input_pdb_path, chains_to_move, residue, nstruct_i ):
+    output_directory = get_backrub_output_directory( name, input_pdb_path, chains_to_move, residue, nstruct_i )
+    # Rosetta appends to existing databases, so anything left by an earlier, incomplete backrub step is removed first
+    if os.path.isdir(output_directory):
+        shutil.rmtree(output_directory)
+    os.makedirs(output_directory)
+
+    # Only the mutated positions matter for the backrub step, as they define the backrub region
+    chain, resi, icode = residue
+    resfile_path = os.path.join( output_directory, 'backrub_%s.resfile' % position_name(residue) )
+    with open( resfile_path, 'w') as f:
+        f.write( 'NATAA\nstart\n%d%s %s ALLAA\n' % (resi, icode, chain) )
+
+    backrub_args = [
+        os.path.abspath(rosetta_scripts_path),
+        "-s %s" % os.path.abspath(input_pdb_path),
+        '-parser:protocol', os.path.abspath(backrub_script_path),
+        '-parser:script_vars',
+        'mutate_resfile_relpath=' + os.path.abspath( resfile_path ),
+        'backrub_kt=%.1f' % backrub_kt,
+        'backrub_trials=%d' % backrub_trials,
+        'backrub_stride=%d' % backrub_trials,
+        'neighbor_distance=%.1f' % neighbor_distance,
+        'min_tolerance=%f' % min_tolerance,
+        'min_max_iter=%d' % min_max_iter,
+        'min_abs_score_convergence_threshold=%.1f' % min_abs_score_convergence_threshold,
+    ] + rosetta_flags
+
+    return start_rosetta( output_directory, backrub_args )
+
+def start_mutation_step( name, input_pdb_path, chains_to_move, residue, nstruct_i, mut_aa ):
+    output_directory = get_mutation_output_directory( name, input_pdb_path, chains_to_move, residue, nstruct_i, mut_aa )
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    chain, resi, icode = residue
+    resfile_path = os.path.join( output_directory, 'mutate_%s_to_%s.resfile' % (position_name(residue), mut_aa) )
+    with open( resfile_path, 'w') as f:
+        f.write( 'NATAA\nstart\n%d%s %s PIKAA %s\n' % (resi, icode, chain, mut_aa) )
+
+    backrub_pdb_path, wt_minimized_pdb_path = get_backrub_pdb_paths( name, input_pdb_path, chains_to_move, residue, nstruct_i )
+
+    mutation_args = [
+        os.path.abspath(rosetta_scripts_path),
+        "-s %s" % os.path.abspath(wt_minimized_pdb_path),
+        "-native %s" % os.path.abspath(input_pdb_path),
+        '-parser:protocol', os.path.abspath(mutation_script_path),
+        '-parser:script_vars',
+        'chainstomove=' + chains_to_move,
+        'mutate_resfile_relpath=' + os.path.abspath( resfile_path ),
+        'backrub_pdb_path=' + os.path.abspath( backrub_pdb_path ),
+        'neighbor_distance=%.1f' % neighbor_distance,
+        'min_tolerance=%f' % min_tolerance,
+        'min_max_iter=%d' % min_max_iter,
+        'min_abs_score_convergence_threshold=%.1f' % min_abs_score_convergence_threshold,
+    ] + rosetta_flags
+
+    return start_rosetta( output_directory, mutation_args )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--resume', action = 'store_true', help = 'Skip mutation step output directories that already hold a successful run, and clean and rerun any incomplete ones' )
+    flex_ddg_launcher.add_scratch_argument( parser )
+    instrumentation.add_arguments( parser, profile = False )
+    args = parser.parse_args()
+    instrumentation.configure_from_args( args )
+    scratch_dir = get_scratch_dir( args.scratch )
+
+    backrub_cases = []
+    for nstruct_i in range(1, nstruct + 1 ):
+        for case_name, case_path, input_pdb_path, chains_to_move in get_inputs():
+            for residue in residues_to_mutate:
+                backrub_cases.append( (case_name, input_pdb_path, chains_to_move, residue, nstruct_i) )
+
+    write_trajectory_stride()
+    journal = RunJournal( run_journal_path )
+    scheduler = MemoryAwareScheduler( max_processes = max_cpus )
+    start_mutation_step_journaled = journal.journaled( start_mutation_step, get_mutation_output_directory )
+
+    def queue_mutation_steps( backrub_args ):
+        mutation_cases = [ backrub_args + (mut_aa,) for mut_aa in mutant_amino_acids ]
+        if args.resume:
+            mutation_cases = skip_completed_runs( mutation_cases, get_mutation_output_directory, journal = journal )
+        for mutation_args in mutation_cases:
+            scheduler.add_job( start_mutation_step_journaled, mutation_args )
+
+    def start_backrub_step_then_mutation_steps( *backrub_args ):
+        # The mutation steps of a position only become runnable once its backrub step has succeeded
+        process, finish = journal.journaled( start_backrub_step, get_backrub_output_directory )( *backrub_args )
+        def finish_then_queue_mutation_steps( returncode ):
+            finish( returncode )
+            if returncode == 0 and backrub_step_succeeded( *backrub_args ):
+                queue_mutation_steps( backrub_args )
+            else:
+                print( 'ERROR: backrub step failed in %s, skipping its mutation steps' % get_backrub_output_directory( *backrub_args ) )
+        return (process, finish_then_queue_mutation_steps)
+
+    for backrub_args in backrub_cases:
+        if backrub_step_succeeded( *backrub_args ):
+            # Reuse the cached backrub ensemble member
+            journal.record( 'skipped', get_backrub_output_directory( *backrub_args ) )
+            queue_mutation_steps( backrub_args )
+        else:
+            scheduler.add_job( start_backrub_step_then_mutation_steps, backrub_args )
+
+    scheduler.run( [] )
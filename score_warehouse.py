@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+# Consolidates the per-struct ddG.db3 files of an output folder into a single indexed SQLite score warehouse,
+# so that a sweep can be queried and analyzed from one file instead of opening every struct's database.
+#
+# Score type and score function names are normalized into dimension tables, and scores are indexed on
+# (case_name, struct_num, state, backrub_steps). The warehouse is updated incrementally: each source ddG.db3
+# is fingerprinted (mtime, size and trajectory_stride), and only new or changed files are read again.
+
+import os
+import sqlite3
+import argparse
+
+import pandas as pd
+
+import instrumentation
+import analyze_flex_ddG
+from analyze_flex_ddG import (
+    output_database_name, script_output_folder, output_formats, bootstrap_samples,
+    find_finished_jobs, get_unpivoted_scores_from_db3_file, get_gam_param_sets, load_gam_param_sets,
+    analyze_case_scores, make_results_writer,
+)
+
+warehouse_file_suffix = '-score_warehouse.db3'
+warehouse_commit_interval = 100 # Source files loaded between commits, so an interrupted update keeps most of its progress
+
+class ScoreWarehouse:
+    def __init__( self, warehouse_path ):
+        self.conn = sqlite3.connect( warehouse_path, timeout = 60 )
+        self.conn.executescript( '''
+        CREATE TABLE IF NOT EXISTS score_types (
+            score_type_id INTEGER PRIMARY KEY,
+            score_type_name TEXT UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS score_functions (
+            score_function_id INTEGER PRIMARY KEY,
+            score_function_name TEXT UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS source_files (
+            source_id INTEGER PRIMARY KEY,
+            db3_path TEXT UNIQUE,
+            mtime_ns INTEGER,
+            size INTEGER,
+            trajectory_stride INTEGER,
+            case_name TEXT,
+            struct_num INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS scores (
+            source_id INTEGER REFERENCES source_files(source_id),
+            case_name TEXT,
+            struct_num INTEGER,
+            state TEXT,
+            backrub_steps INTEGER,
+            score_function_id INTEGER REFERENCES score_functions(score_function_id),
+            score_type_id INTEGER REFERENCES score_types(score_type_id),
+            score_value REAL
+        );
+        CREATE INDEX IF NOT EXISTS scores_case_struct_state_steps ON scores (case_name, struct_num, state, backrub_steps);
+        CREATE INDEX IF NOT EXISTS scores_source ON scores (source_id);
+        ''' )
+        self.conn.commit()
+        self.score_type_ids = dict( self.conn.execute( 'SELECT score_type_name, score_type_id FROM score_types' ).fetchall() )
+        self.score_function_ids = dict( self.conn.execute( 'SELECT score_function_name, score_function_id FROM score_functions' ).fetchall() )
+
+    def fingerprint( self, db3_file ):
+        stat = os.stat( db3_file )
+        return ( stat.st_mtime_ns, stat.st_size, analyze_flex_ddG.trajectory_stride )
+
+    def is_current( self, db3_file ):
+        row = self.conn.execute( 'SELECT mtime_ns, size, trajectory_stride FROM source_files WHERE db3_path=?', (os.path.abspath(db3_file),) ).fetchone()
+        return row is not None and os.path.isfile( db3_file ) and tuple(row) == self.fingerprint( db3_file )
+
+    def get_dimension_id( self, ids, table, name_column, name ):
+        if name not in ids:
+            cursor = self.conn.execute( 'INSERT INTO %s (%s) VALUES (?)' % (table, name_column), (name,) )
+            ids[name] = cursor.lastrowid
+        return ids[name]
+
+    def remove_source( self, db3_path ):
+        row = self.conn.execute( 'SELECT source_id FROM source_files WHERE db3_path=?', (db3_path,) ).fetchone()
+        if row is not None:
+            self.conn.execute( 'DELETE FROM scores WHERE source_id=?', row )
+            self.conn.execute( 'DELETE FROM source_files WHERE source_id=?', row )
+
+    def load_struct( self, db3_file, case_name, struct_num ):
+        # (Re)loads the scores of one struct's ddG.db3, replacing any rows loaded from an earlier version of the file
+        db3_path = os.path.abspath( db3_file )
+        self.remove_source( db3_path )
+        scores = get_unpivoted_scores_from_db3_file( db3_path )
+        cursor = self.conn.execute(
+            'INSERT INTO source_files (db3_path, mtime_ns, size, trajectory_stride, case_name, struct_num) VALUES (?, ?, ?, ?, ?, ?)',
+            (db3_path,) + self.fingerprint( db3_path ) + (case_name, struct_num),
+        )
+        source_id = cursor.lastrowid
+        score_type_ids = [ self.get_dimension_id( self.score_type_ids, 'score_types', 'score_type_name', name ) for name in scores['score_type_name'] ]
+        score_function_ids = [ self.get_dimension_id( self.score_function_ids, 'score_functions', 'score_function_name', name ) for name in scores['score_function_name'] ]
+        self.conn.executemany(
+            'INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            zip(
+                [source_id] * len(scores), [case_name] * len(scores), [struct_num] * len(scores),
+                scores['name'].tolist(), scores['struct_id'].astype(int).tolist(), score_function_ids, score_type_ids, scores['score_value'].astype(float).tolist(),
+            ),
+        )
+        return len(scores)
+
+    def update( self, output_folder ):
+        # Loads the ddG.db3 of every finished struct in output_folder that is not already loaded and unchanged, and
+        # removes sources in output_folder that are no longer finished. Returns (loaded, unchanged, removed) counts.
+        analyze_flex_ddG.set_trajectory_stride( analyze_flex_ddG.read_trajectory_stride( output_folder ) )
+        finished_jobs = find_finished_jobs( output_folder )
+        finished_db3_paths = set()
+        loaded = unchanged = 0
+        for finished_job, finished_structs in sorted( finished_jobs.items() ):
+            case_name = os.path.basename( finished_job )
+            for finished_struct in finished_structs:
+                db3_file = os.path.join( finished_struct, output_database_name )
+                finished_db3_paths.add( db3_file )
+                if not os.path.isfile( db3_file ):
+                    continue
+                if self.is_current( db3_file ):
+                    unchanged += 1
+                    continue
+                self.load_struct( db3_file, case_name, int( os.path.basename(finished_struct) ) )
+                loaded += 1
+                if loaded % warehouse_commit_interval == 0:
+                    self.conn.commit()
+
+        output_folder_prefix = os.path.join( os.path.abspath( output_folder ), '' )
+        removed = 0
+        for (db3_path,) in self.conn.execute( 'SELECT db3_path FROM source_files' ).fetchall():
+            if db3_path.startswith( output_folder_prefix ) and db3_path not in finished_db3_paths:
+                self.remove_source( db3_path )
+                removed += 1
+        self.conn.commit()
+        return (loaded, unchanged, removed)
+
+    def case_names( self ):
+        return [ row[0] for row in self.conn.execute( 'SELECT DISTINCT case_name FROM source_files ORDER BY case_name' ).fetchall() ]
+
+    def get_case_scores( self, case_name ):
+        # Returns a case's scores pivoted to one row per (struct_num, state, backrub_steps, score function), with the
+        # same columns as analyze_flex_ddG.get_scores_from_db3_file. The pivot is done in SQL with one conditional
+        # aggregate per score type, so only the pivoted rows are transferred into pandas.
+        score_types = self.conn.execute( '''
+        SELECT score_types.score_type_id, score_types.score_type_name FROM score_types
+        WHERE score_types.score_type_id IN (SELECT DISTINCT score_type_id FROM scores WHERE case_name=?)
+        ORDER BY score_types.score_type_name
+        ''', (case_name,) ).fetchall()
+        score_type_columns = ', '.join( [
+            'AVG(CASE WHEN scores.score_type_id=%d THEN scores.score_value END) AS "%s"' % (score_type_id, score_type_name.replace('"', '""'))
+            for score_type_id, score_type_name in score_types
+        ] )
+        return pd.read_sql_query( '''
+        SELECT scores.state, scores.backrub_steps, score_functions.score_function_name, %s, scores.struct_num, scores.case_name FROM scores
+        INNER JOIN score_functions ON score_functions.score_function_id=scores.score_function_id
+        WHERE scores.case_name=?
+        GROUP BY scores.struct_num, scores.state, scores.backrub_steps, scores.score_function_id
+        ORDER BY scores.struct_num, scores.state, scores.backrub_steps, score_functions.score_function_name
+        ''' % score_type_columns, self.conn, params = (case_name,) )
+
+    def close( self ):
+        self.conn.commit()
+        self.conn.close()
+
+def get_warehouse_path( output_folder ):
+    if not os.path.isdir(script_output_folder):
+        os.makedirs(script_output_folder)
+    return os.path.join( script_output_folder, os.path.basename( os.path.normpath(output_folder) ) + warehouse_file_suffix )
+
+def analyze_warehouse( warehouse, basename, extra_gam_param_sets = None, output_format = 'csv', use_float32 = False, n_bootstrap_samples = bootstrap_samples ):
+    # Writes the same <basename>-results and <basename>-struct_scores_results files as analyze_flex_ddG.analyze_output_folder,
+    # reading each case's scores from the warehouse
+    gam_param_sets = get_gam_param_sets( extra_gam_param_sets )
+    struct_scores_writer = make_results_writer( os.path.join(script_output_folder, basename + '-struct_scores_results'), output_format = output_format, use_float32 = use_float32 )
+    ddg_scores_writer = make_results_writer( os.path.join(script_output_folder, basename + '-results'), output_format = output_format, partition_column = 'scored_state', use_float32 = use_float32 )
+    for case_name in warehouse.case_names():
+        with instrumentation.stage( 'read_warehouse', case_name = case_name ):
+            case_scores = warehouse.get_case_scores( case_name )
+        struct_scores, ddg_scores = analyze_case_scores( case_scores, gam_param_sets, n_bootstrap_samples = n_bootstrap_samples )
+        with instrumentation.stage( 'write_results', case_name = case_name, output_format = output_format ):
+            struct_scores_writer.write( struct_scores )
+            ddg_scores_writer.write( ddg_scores )
+    with instrumentation.stage( 'write_results', output_format = output_format ):
+        struct_scores_writer.close()
+        ddg_scores_writer.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'Merge the ddG.db3 files of flex ddG output folders into indexed score warehouses, and optionally analyze them' )
+    parser.add_argument( 'folders', nargs = '*', help = 'Output folder(s) to consolidate. Each gets its own warehouse, %s' % os.path.join( script_output_folder, '<folder>' + warehouse_file_suffix ) )
+    parser.add_argument( '--analyze', action = 'store_true', help = 'After updating, write the results files of analyze_flex_ddG.py from the warehouse' )
+    parser.add_argument( '--gam-params', help = 'JSON file of additional GAM parameter sets, as for analyze_flex_ddG.py' )
+    parser.add_argument( '--output-format', choices = output_formats, default = 'csv', help = 'Format to write results in (default: csv)' )
+    parser.add_argument( '--float32', action = 'store_true', help = 'Store scores as float32 in Parquet and Feather output' )
+    parser.add_argument( '--bootstrap-samples', type = int, default = bootstrap_samples, help = 'Resamplings used for the bootstrap columns of total_score, as for analyze_flex_ddG.py (default: %d, 0 to leave them out)' % bootstrap_samples )
+    instrumentation.add_arguments( parser )
+    args = parser.parse_args()
+    instrumentation.configure_from_args( args )
+    extra_gam_param_sets = load_gam_param_sets( args.gam_params ) if args.gam_params else None
+    for folder in args.folders:
+        if not os.path.isdir( folder ):
+            continue
+        warehouse_path = get_warehouse_path( folder )
+        warehouse = ScoreWarehouse( warehouse_path )
+        with instrumentation.stage( 'warehouse_update', output_folder = folder ):
+            loaded, unchanged, removed = warehouse.update( folder )
+        print( '%s: loaded %d, unchanged %d, removed %d ddG.db3 files' % (warehouse_path, loaded, unchanged, removed) )
+        if args.analyze:
+            analyze_warehouse(
+                warehouse, os.path.basename( os.path.normpath(folder) ), extra_gam_param_sets = extra_gam_param_sets,
+                output_format = args.output_format, use_float32 = args.float32, n_bootstrap_samples = args.bootstrap_samples,
+            )
+        warehouse.close()
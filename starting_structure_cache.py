@@ -0,0 +1,218 @@
+# Cache of pre-minimized starting structures, so that the initial constrained minimization of ddG-backrub.xml is run
+# once per input PDB, rather than once per replicate of every mutation. Each entry is keyed on a hash of the input
+# PDB's contents and of everything else that determines the minimization: its parameters, the Rosetta flags, the
+# ddG-preminimize.xml protocol and the rosetta_scripts binary. Replicates are then started from the cached pose
+# with ddG-backrub-preminimized.xml, which skips the initial minimization.
+#
+# An entry's manifest.json records its key inputs and the hash of the minimized PDB, which is checked before use.
+# verify_cached_structure reruns the minimization and compares the coordinates with the cached PDB, and
+# verify_preminimized_ddg checks that a replicate started from the cached PDB gives the same ddG as the full protocol.
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+
+from job_scheduler import MemoryAwareScheduler, start_rosetta_process, run_job, completion_marker_file_name
+
+preminimized_cache_folder = 'preminimized_cache'
+preminimize_script_path = 'ddG-preminimize.xml'
+preminimized_script_path = 'ddG-backrub-preminimized.xml'
+manifest_file_name = 'manifest.json'
+verify_coordinate_tolerance = 0.002 # Angstroms; PDB coordinates are written to 3 decimal places
+verify_ddg_tolerance = 0.5 # Largest ddG difference (REU) between the full and preminimized protocols. Both are run with the same
+                           # seed, but the cached PDB's rounded coordinates can still send the backrub trajectory a slightly different way.
+verify_ddg_seed = 1111
+full_script_path = 'ddG-backrub.xml'
+
+def hash_file( path ):
+    h = hashlib.sha256()
+    with open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( 1024 * 1024 ), b'' ):
+            h.update( chunk )
+    return h.hexdigest()
+
+def get_cache_key_inputs( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags ):
+    # Everything the minimized structure depends on. minimization_vars are the script_vars of ddG-preminimize.xml.
+    binary_stat = os.stat( os.path.realpath( rosetta_scripts_path ) )
+    return {
+        'input_pdb_sha256' : hash_file( input_pdb_path ),
+        'minimization_vars' : sorted( minimization_vars ),
+        'rosetta_flags' : list( rosetta_flags ),
+        'protocol_sha256' : hash_file( preminimize_script_path ),
+        'rosetta_scripts' : [ os.path.realpath( rosetta_scripts_path ), binary_stat.st_size, binary_stat.st_mtime_ns ],
+    }
+
+def get_cache_key( key_inputs ):
+    return hashlib.sha256( json.dumps( key_inputs, sort_keys = True ).encode() ).hexdigest()[:16]
+
+def get_cache_directory( key_inputs ):
+    return os.path.join( preminimized_cache_folder, get_cache_key( key_inputs ) )
+
+def get_cached_pdb_path( input_pdb_path, key_inputs ):
+    # The cached structure keeps the input PDB's file name, so that Rosetta names its jobs the same as without the cache
+    return os.path.join( get_cache_directory( key_inputs ), os.path.basename( input_pdb_path ) )
+
+def read_manifest( cache_directory ):
+    try:
+        with open( os.path.join( cache_directory, manifest_file_name ), 'r' ) as f:
+            return json.load( f )
+    except (IOError, OSError, ValueError):
+        return None
+
+def is_cached( input_pdb_path, key_inputs ):
+    manifest = read_manifest( get_cache_directory( key_inputs ) )
+    cached_pdb_path = get_cached_pdb_path( input_pdb_path, key_inputs )
+    return (
+        manifest != None and manifest['key_inputs'] == key_inputs and os.path.isfile( cached_pdb_path )
+        and manifest['preminimized_pdb_sha256'] == hash_file( cached_pdb_path )
+    )
+
+def get_preminimization_args( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags ):
+    return [
+        os.path.abspath(rosetta_scripts_path),
+        "-s %s" % os.path.abspath(input_pdb_path),
+        '-parser:protocol', os.path.abspath(preminimize_script_path),
+        '-parser:script_vars',
+    ] + list( minimization_vars ) + list( rosetta_flags )
+
+def start_preminimization( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags, output_directory = None ):
+    # Starts the minimization of one input PDB, and returns (process, finish_function) as used by MemoryAwareScheduler.
+    # By default the minimized structure is written into its cache directory, along with its manifest.
+    key_inputs = get_cache_key_inputs( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+    if output_directory == None:
+        output_directory = get_cache_directory( key_inputs )
+    if not os.path.isdir( output_directory ):
+        os.makedirs( output_directory )
+
+    args = get_preminimization_args( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+    print( 'Minimizing starting structure with args:' )
+    print( ' '.join(args) )
+    print()
+    process, finish_function = start_rosetta_process( args, output_directory, completion_marker_file_name )
+
+    def finish( returncode ):
+        finish_function( returncode )
+        input_name = os.path.splitext( os.path.basename(input_pdb_path) )[0]
+        rosetta_pdb_path = os.path.join( output_directory, '%s_0001.pdb' % input_name )
+        if returncode != 0 or not os.path.isfile( rosetta_pdb_path ):
+            print( 'ERROR: minimization of %s failed, see %s' % (input_pdb_path, os.path.join( output_directory, 'rosetta.out' )) )
+            return
+        preminimized_pdb_path = os.path.join( output_directory, os.path.basename( input_pdb_path ) )
+        shutil.move( rosetta_pdb_path, preminimized_pdb_path )
+        # The manifest is written last, as it marks the entry as usable
+        with open( os.path.join( output_directory, manifest_file_name ), 'w' ) as f:
+            json.dump( {
+                'input_pdb_path' : os.path.abspath( input_pdb_path ),
+                'key_inputs' : key_inputs,
+                'preminimized_pdb_sha256' : hash_file( preminimized_pdb_path ),
+            }, f, indent = 2 )
+
+    return (process, finish)
+
+def get_preminimization_jobs( rosetta_scripts_path, input_pdb_paths, minimization_vars, rosetta_flags ):
+    # Returns the (start_function, args) jobs needed to fill the cache for input_pdb_paths, one per distinct uncached key
+    jobs = []
+    keys = set()
+    for input_pdb_path in input_pdb_paths:
+        key_inputs = get_cache_key_inputs( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+        key = get_cache_key( key_inputs )
+        if key in keys or is_cached( input_pdb_path, key_inputs ):
+            continue
+        keys.add( key )
+        jobs.append( ( start_preminimization, (rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags) ) )
+    return jobs
+
+def get_preminimized_pdb( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags ):
+    key_inputs = get_cache_key_inputs( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+    if not is_cached( input_pdb_path, key_inputs ):
+        raise Exception( 'No valid pre-minimized structure of %s in %s' % (input_pdb_path, get_cache_directory( key_inputs )) )
+    return get_cached_pdb_path( input_pdb_path, key_inputs )
+
+def preminimize_inputs( rosetta_scripts_path, input_pdb_paths, minimization_vars, rosetta_flags, max_processes = None ):
+    # Fills the cache for input_pdb_paths (as for the launchers' --preminimize), and raises if any input PDB could not
+    # be minimized
+    MemoryAwareScheduler( max_processes = max_processes ).run(
+        get_preminimization_jobs( rosetta_scripts_path, input_pdb_paths, minimization_vars, rosetta_flags )
+    )
+    for input_pdb_path in input_pdb_paths:
+        get_preminimized_pdb( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+
+def read_pdb_coordinates( pdb_path ):
+    # (chain, residue number, insertion code, atom name) -> (x, y, z)
+    coordinates = {}
+    with open( pdb_path, 'r' ) as f:
+        for line in f:
+            if line.startswith( 'ATOM' ) or line.startswith( 'HETATM' ):
+                coordinates[ (line[21], line[22:26].strip(), line[26].strip(), line[12:16].strip()) ] = ( float(line[30:38]), float(line[38:46]), float(line[46:54]) )
+    return coordinates
+
+def verify_cached_structure( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags ):
+    # Reruns the minimization of input_pdb_path in a temporary directory, and returns the largest coordinate difference
+    # (in Angstroms) from the cached structure, or None if the two do not contain the same atoms
+    cached_pdb_path = get_preminimized_pdb( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+    verify_directory = tempfile.mkdtemp( prefix = 'verify_', dir = preminimized_cache_folder )
+    try:
+        process, finish = start_preminimization( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags, output_directory = verify_directory )
+        finish( process.wait() )
+        verify_pdb_path = os.path.join( verify_directory, os.path.basename( input_pdb_path ) )
+        if not os.path.isfile( verify_pdb_path ):
+            raise Exception( 'Verification minimization of %s failed, see %s' % (input_pdb_path, os.path.join( verify_directory, 'rosetta.out' )) )
+        cached_coordinates = read_pdb_coordinates( cached_pdb_path )
+        verify_coordinates = read_pdb_coordinates( verify_pdb_path )
+    except Exception:
+        print( 'Verification output kept in %s' % verify_directory )
+        raise
+    shutil.rmtree( verify_directory )
+    if set(cached_coordinates.keys()) != set(verify_coordinates.keys()):
+        return None
+    return max( [0.0] + [
+        max( [ abs(a - b) for a, b in zip( xyz, verify_coordinates[atom] ) ] ) for atom, xyz in cached_coordinates.items()
+    ] )
+
+def get_final_ddg( output_directory ):
+    # The mean ddG total score over the score functions of a single replicate, at its last backrub checkpoint
+    from analyze_flex_ddG import output_database_name, get_scores_from_db3_file, calc_ddg
+    ddg_scores, struct_scores = calc_ddg( get_scores_from_db3_file( os.path.join( output_directory, output_database_name ), 1, 'verify' ) )
+    return ddg_scores.loc[ ddg_scores['backrub_steps'] == ddg_scores['backrub_steps'].max(), 'total_score' ].mean()
+
+def verify_preminimized_ddg( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags, get_flex_ddg_args ):
+    # Runs one flex ddG replicate of a case with the full protocol from input_pdb_path, and one with the preminimized
+    # protocol from its cached structure, with the same random seed, and returns the difference of their ddGs.
+    # get_flex_ddg_args( input_pdb_path, script_path, output_directory ) returns the Rosetta args of a replicate of the
+    # case run in output_directory.
+    cached_pdb_path = get_preminimized_pdb( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+    verify_directory = tempfile.mkdtemp( prefix = 'verify_ddg_', dir = preminimized_cache_folder )
+    ddgs = []
+    for pdb_path, script_path in ( (input_pdb_path, full_script_path), (cached_pdb_path, preminimized_script_path) ):
+        output_directory = os.path.join( verify_directory, os.path.splitext( os.path.basename(script_path) )[0] )
+        os.makedirs( output_directory )
+        args = get_flex_ddg_args( pdb_path, script_path, output_directory ) + [ '-constant_seed', '-jran %d' % verify_ddg_seed ]
+        if run_job( start_rosetta_process, (args, output_directory, completion_marker_file_name) ) != 0:
+            print( 'Verification output kept in %s' % verify_directory )
+            raise Exception( 'Verification run of %s with %s failed, see %s' % (input_pdb_path, script_path, os.path.join( output_directory, 'rosetta.out' )) )
+        ddgs.append( get_final_ddg( output_directory ) )
+    shutil.rmtree( verify_directory )
+    return abs( ddgs[0] - ddgs[1] )
+
+def verify_preminimized( rosetta_scripts_path, input_pdb_paths, minimization_vars, rosetta_flags, ddg_case = None ):
+    # Checks the cached structure of each of input_pdb_paths with verify_cached_structure and, if ddg_case is given as
+    # (input_pdb_path, get_flex_ddg_args), the ddG of that case with verify_preminimized_ddg. Prints the result of
+    # each check, and exits with status 1 if any failed (as for the launchers' --verify-preminimized).
+    mismatched = 0
+    for input_pdb_path in input_pdb_paths:
+        max_difference = verify_cached_structure( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags )
+        if max_difference is None or max_difference > verify_coordinate_tolerance:
+            mismatched += 1
+        print( '%s: %s' % (input_pdb_path, 'atoms differ' if max_difference is None else 'largest coordinate difference %.4f A' % max_difference) )
+    if ddg_case != None:
+        input_pdb_path, get_flex_ddg_args = ddg_case
+        ddg_difference = verify_preminimized_ddg( rosetta_scripts_path, input_pdb_path, minimization_vars, rosetta_flags, get_flex_ddg_args )
+        if ddg_difference > verify_ddg_tolerance:
+            mismatched += 1
+        print( '%s: full and preminimized protocol ddG differ by %.3f REU (tolerance %.3f)' % (input_pdb_path, ddg_difference, verify_ddg_tolerance) )
+    sys.exit( 1 if mismatched > 0 else 0 )
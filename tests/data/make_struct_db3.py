@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Writes struct.db3, a fixture in the layout of the tables that the structreport ReportToDB mover writes, from a
+# fragment of inputs/1JTG/1JTG_AB.pdb, and struct.pdb, the heavy atoms of that fragment as written by score_jd2.
+#
+# Rosetta is needed to write these files for real. Without it, the atoms of each residue are numbered here in the
+# order of the atoms in Rosetta's residue type params files (database/chemical/residue_type_sets/fa_standard/
+# residue_types/l-caa), with hydrogens and virtual atoms after the heavy atoms, and the terminal patches applied.
+# Regenerate both files with Rosetta (score_jd2 -in:use_database -out:pdb) where it is available.
+#
+# The database holds 6 poses, the backrub, wt and mut states of 2 backrub checkpoints. Pose 1 has the coordinates of
+# the input PDB, and the others are rotated and translated copies. The mut poses have ALA at A28 instead of GLU.
+
+import os
+import sqlite3
+import collections
+
+import numpy as np
+
+fragment_residues = [ ('A', resi) for resi in (26, 27, 28, 29, 285, 286, 287, 288) ] + [ ('B', resi) for resi in (1, 2, 3, 4, 163, 164, 165) ]
+mutations = { ('A', 28) : 'ALA' } # Of the mut poses
+n_poses = 6
+
+rosetta_atom_names = {
+    'ALA' : 'N CA C O CB H HA 1HB 2HB 3HB',
+    'ASP' : 'N CA C O CB CG OD1 OD2 H HA 1HB 2HB',
+    'GLU' : 'N CA C O CB CG CD OE1 OE2 H HA 1HB 2HB 1HG 2HG',
+    'GLY' : 'N CA C O H 1HA 2HA',
+    'HIS' : 'N CA C O CB CG ND1 CD2 CE1 NE2 H HA 1HB 2HB HD2 HE1 HE2',
+    'ILE' : 'N CA C O CB CG1 CG2 CD1 H HA HB 1HG2 2HG2 3HG2 1HG1 2HG1 1HD1 2HD1 3HD1',
+    'LEU' : 'N CA C O CB CG CD1 CD2 H HA 1HB 2HB HG 1HD1 2HD1 3HD1 1HD2 2HD2 3HD2',
+    'LYS' : 'N CA C O CB CG CD CE NZ H HA 1HB 2HB 1HG 2HG 1HD 2HD 1HE 2HE 1HZ 2HZ 3HZ',
+    'MET' : 'N CA C O CB CG SD CE H HA 1HB 2HB 1HG 2HG 1HE 2HE 3HE',
+    'PRO' : 'N CA C O CB CG CD NV 1HD 2HD 1HG 2HG 1HB 2HB HA',
+    'THR' : 'N CA C O CB OG1 CG2 H HA HB HG1 1HG2 2HG2 3HG2',
+    'TRP' : 'N CA C O CB CG CD1 CD2 NE1 CE2 CE3 CZ2 CZ3 CH2 H HA 1HB 2HB HD1 HE1 HZ2 HH2 HZ3 HE3',
+    'VAL' : 'N CA C O CB CG1 CG2 H HA HB 1HG1 2HG1 3HG1 1HG2 2HG2 3HG2',
+}
+
+def get_atom_names( name3, res_type ):
+    # The N terminal patch replaces H with 1H, 2H and 3H, and the C terminal patch adds OXT after the heavy atoms
+    atom_names = rosetta_atom_names[name3].split()
+    patches = res_type.split(':')[1:]
+    if 'CtermProteinFull' in patches:
+        n_heavy_atoms = len( [ atom_name for atom_name in atom_names if not atom_name[0].isdigit() and atom_name[0] != 'H' and atom_name != 'NV' ] )
+        atom_names.insert( n_heavy_atoms, 'OXT' )
+    if 'NtermProteinFull' in patches:
+        atom_names = [ atom_name for atom_name in atom_names if atom_name != 'H' ] + ( ['1H', '2H'] if name3 == 'PRO' else ['1H', '2H', '3H'] )
+    return atom_names
+
+def read_fragment( pdb_path ):
+    # (chain, resi) -> (name3, {atom name : (x, y, z)}), and the fragment's ATOM lines
+    residues = collections.OrderedDict( [ (residue, None) for residue in fragment_residues ] )
+    lines = []
+    with open( pdb_path ) as f:
+        for line in f:
+            residue = ( line[21], int(line[22:26]) )
+            if line.startswith( 'ATOM' ) and residue in residues:
+                if residues[residue] == None:
+                    residues[residue] = ( line[17:20], {} )
+                residues[residue][1][ line[12:16].strip() ] = ( float(line[30:38]), float(line[38:46]), float(line[46:54]) )
+                lines.append( line )
+    return residues, lines
+
+def get_pose_transform( struct_id ):
+    angle = np.radians( 7.0 * (struct_id - 1) )
+    rotation = np.array( [ [1.0, 0.0, 0.0], [0.0, np.cos(angle), -np.sin(angle)], [0.0, np.sin(angle), np.cos(angle)] ] )
+    return rotation, np.array( [0.5, -0.3, 0.2] ) * (struct_id - 1)
+
+def write_struct_db3( db3_path, residues ):
+    conn = sqlite3.connect( db3_path )
+    conn.executescript( '''
+    CREATE TABLE structures (struct_id INTEGER PRIMARY KEY, batch_id INTEGER, tag TEXT, input_tag TEXT);
+    CREATE TABLE residues (struct_id INTEGER, resNum INTEGER, name3 TEXT, res_type TEXT, PRIMARY KEY (struct_id, resNum));
+    CREATE TABLE residue_pdb_identification (struct_id INTEGER, residue_number INTEGER, chain_id TEXT, insertion_code TEXT, pdb_residue_number INTEGER, PRIMARY KEY (struct_id, residue_number));
+    CREATE TABLE residue_atom_coords (struct_id INTEGER, seqpos INTEGER, atomno INTEGER, x REAL, y REAL, z REAL, PRIMARY KEY (struct_id, seqpos, atomno));
+    ''' )
+    keys = list( residues )
+    for struct_id in range( 1, n_poses + 1 ):
+        rotation, translation = get_pose_transform( struct_id )
+        conn.execute( 'INSERT INTO structures VALUES (?, 1, ?, ?)', (struct_id, '1JTG_AB_%04d' % struct_id, '1JTG_AB') )
+        for resNum, key in enumerate( keys, start = 1 ):
+            name3, coordinates = residues[key]
+            if struct_id % 3 == 0 and key in mutations:
+                name3 = mutations[key]
+            patches = []
+            if resNum == 1 or keys[resNum - 2][0] != key[0]:
+                patches.append( 'NtermProteinFull' )
+            if resNum == len(keys) or keys[resNum][0] != key[0]:
+                patches.append( 'CtermProteinFull' )
+            res_type = ':'.join( [name3] + patches )
+            conn.execute( 'INSERT INTO residues VALUES (?, ?, ?, ?)', (struct_id, resNum, name3, res_type) )
+            conn.execute( 'INSERT INTO residue_pdb_identification VALUES (?, ?, ?, ?, ?)', (struct_id, resNum, key[0], ' ', key[1]) )
+            for atomno, atom_name in enumerate( get_atom_names( name3, res_type ), start = 1 ):
+                # Hydrogens and virtual atoms are given the coordinates of CA, as only their presence matters here
+                xyz = np.array( coordinates.get( atom_name, coordinates['CA'] ) ).dot( rotation.T ) + translation
+                conn.execute( 'INSERT INTO residue_atom_coords VALUES (?, ?, ?, ?, ?, ?)', (struct_id, resNum, atomno) + tuple( xyz.tolist() ) )
+    conn.commit()
+    conn.close()
+
+if __name__ == '__main__':
+    data_folder = os.path.dirname( os.path.abspath(__file__) )
+    residues, lines = read_fragment( os.path.join( data_folder, '..', '..', 'inputs', '1JTG', '1JTG_AB.pdb' ) )
+    db3_path = os.path.join( data_folder, 'struct.db3' )
+    if os.path.isfile( db3_path ):
+        os.remove( db3_path )
+    write_struct_db3( db3_path, residues )
+    with open( os.path.join( data_folder, 'struct.pdb' ), 'w' ) as f:
+        last_chain = None
+        for line in lines:
+            if last_chain != None and line[21] != last_chain:
+                f.write( 'TER\n' )
+            last_chain = line[21]
+            f.write( line.rstrip( '\n' ) + '\n' )
+        f.write( 'TER\nEND\n' )
@@ -0,0 +1,154 @@
+# Checks that the cumulative sum ddG and dG aggregation gives the same results CSVs as the original per-nstruct loop,
+# and that analyzing an output folder with a process pool gives the same results as analyzing it serially
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyze_flex_ddG
+from analyze_flex_ddG import output_database_name, calc_ddg, calc_dgs, id_columns, imap_bounded, analyze_output_folder
+from benchmark_analysis import make_synthetic_output_tree
+
+missing_structs = [3, 10, 11, 20, 25] # Including the nstruct 10 and 20 checkpoints, and struct 25, so the total nstruct is 24
+
+def calc_ddg_per_nstruct( scores ):
+    # The original calc_ddg, with DataFrame.append replaced by pd.concat and the string state column left out of the sums
+    score_columns = [ column for column in scores.columns if column not in id_columns ]
+    total_structs = np.max( scores['struct_num'] )
+    nstructs_to_analyze = set([total_structs])
+    for x in range(10, total_structs):
+        if x % 10 == 0:
+            nstructs_to_analyze.add(x)
+    all_ddg_scores = []
+    for nstructs in sorted(nstructs_to_analyze):
+        ddg_scores = scores.loc[ ((scores['state'] == 'unbound_mut') | (scores['state'] == 'bound_wt')) & (scores['struct_num'] <= nstructs) ].copy()
+        ddg_scores.loc[:, score_columns] *= -1.0
+        ddg_scores = pd.concat( [ ddg_scores, scores.loc[ ((scores['state'] == 'unbound_wt') | (scores['state'] == 'bound_mut')) & (scores['struct_num'] <= nstructs) ].copy() ] )
+        ddg_scores = ddg_scores.groupby( ['case_name', 'backrub_steps', 'struct_num', 'score_function_name'] )[score_columns].sum().reset_index()
+        if nstructs == total_structs:
+            struct_scores = ddg_scores.copy()
+        ddg_scores = ddg_scores.groupby( ['case_name', 'backrub_steps', 'score_function_name'] )[score_columns].mean().round(decimals=5).reset_index()
+        ddg_scores[ 'scored_state' ] = 'ddG'
+        ddg_scores[ 'nstruct' ] = nstructs
+        all_ddg_scores.append(ddg_scores)
+    return (pd.concat(all_ddg_scores), struct_scores)
+
+def calc_dgs_per_nstruct( scores ):
+    score_columns = [ column for column in scores.columns if column not in id_columns ]
+    l = []
+    total_structs = np.max( scores['struct_num'] )
+    nstructs_to_analyze = set([total_structs])
+    for x in range(10, total_structs):
+        if x % 10 == 0:
+            nstructs_to_analyze.add(x)
+    for state in ['mut', 'wt']:
+        for nstructs in sorted(nstructs_to_analyze):
+            dg_scores = scores.loc[ (scores['state'].str.endswith(state)) & (scores['state'].str.startswith('unbound')) & (scores['struct_num'] <= nstructs) ].copy()
+            dg_scores.loc[:, score_columns] *= -1.0
+            dg_scores = pd.concat( [ dg_scores, scores.loc[ (scores['state'].str.endswith(state)) & (scores['state'].str.startswith('bound')) & (scores['struct_num'] <= nstructs) ].copy() ] )
+            dg_scores = dg_scores.groupby( ['case_name', 'backrub_steps', 'struct_num', 'score_function_name'] )[score_columns].sum().reset_index()
+            dg_scores = dg_scores.groupby( ['case_name', 'backrub_steps', 'score_function_name'] )[score_columns].mean().round(decimals=5).reset_index()
+            dg_scores[ 'scored_state' ] = state + '_dG'
+            dg_scores[ 'nstruct' ] = nstructs
+            l.append( dg_scores )
+    return l
+
+score_terms = ['fa_atr', 'fa_rep', 'fa_sol', 'hbond_sc', 'total_score']
+
+@pytest.fixture( scope = 'module' )
+def case_scores():
+    # One case of 25 structs with 3 backrub checkpoints each, laid out as get_scores_from_db3_file returns them, some
+    # of whose structs did not finish
+    rng = np.random.RandomState( 0 )
+    struct_scores = []
+    for struct_num in sorted( set( range( 1, 26 ) ) - set( missing_structs ) ):
+        scores = pd.DataFrame( [
+            dict( [ ('state', state), ('backrub_steps', backrub_steps), ('score_function_name', 'talaris2014') ] + [ (score_term, round( rng.normal( -50.0, 20.0 ), 3 )) for score_term in score_terms ] )
+            for state in ['bound_mut', 'bound_wt', 'unbound_mut', 'unbound_wt'] for backrub_steps in [5, 10, 15]
+        ] )
+        scores['struct_num'] = struct_num
+        scores['case_name'] = 'case00000'
+        struct_scores.append( scores )
+    return pd.concat( struct_scores )
+
+def test_ddg_csv_unchanged( case_scores ):
+    ddg_scores, struct_scores = calc_ddg( case_scores )
+    expected_ddg_scores, expected_struct_scores = calc_ddg_per_nstruct( case_scores )
+    assert sorted( ddg_scores['nstruct'].unique() ) == [10, 20, 24]
+    assert ddg_scores.to_csv() == expected_ddg_scores.to_csv()
+    assert struct_scores.to_csv() == expected_struct_scores.to_csv()
+
+def test_dg_csv_unchanged( case_scores ):
+    assert pd.concat( calc_dgs( case_scores ) ).to_csv() == pd.concat( calc_dgs_per_nstruct( case_scores ) ).to_csv()
+
+class FakeAsyncResult:
+    def __init__( self, pool, value ):
+        self.pool = pool
+        self.value = value
+
+    def get( self ):
+        self.pool.in_flight -= 1
+        return self.value
+
+class FakePool:
+    # Runs tasks as they are submitted, and counts those whose results have not been taken
+    def __init__( self ):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def apply_async( self, function, args ):
+        self.in_flight += 1
+        self.max_in_flight = max( self.max_in_flight, self.in_flight )
+        return FakeAsyncResult( self, function( *args ) )
+
+def test_imap_bounded_limits_tasks_in_flight():
+    pool = FakePool()
+    results = []
+    for result in imap_bounded( pool, lambda x: x * x, range( 20 ), 4 ):
+        results.append( result )
+        assert pool.in_flight <= 3
+    assert results == [ x * x for x in range( 20 ) ]
+    assert pool.max_in_flight == 4 and pool.in_flight == 0
+
+def read_results( basename ):
+    return [ pd.read_csv( os.path.join( analyze_flex_ddG.script_output_folder, basename + suffix ) ) for suffix in ('-results.csv', '-struct_scores_results.csv') ]
+
+def test_jobs_results_match_serial( tmp_path, monkeypatch ):
+    monkeypatch.chdir( tmp_path )
+    monkeypatch.setattr( analyze_flex_ddG, 'cases_in_flight_per_job', 1 )
+    make_synthetic_output_tree( 'output', 7, 4, 2, n_log_lines = 0 )
+    analyze_output_folder( 'output', jobs = 1, use_cache = False, n_bootstrap_samples = 0 )
+    serial_results = read_results( 'output' )
+    analyze_output_folder( 'output', jobs = 3, use_cache = False, n_bootstrap_samples = 0 )
+    for serial_df, jobs_df in zip( serial_results, read_results( 'output' ) ):
+        assert len(serial_df) > 0
+        assert serial_df.to_csv() == jobs_df.to_csv()
+
+def test_cached_structs_of_relaunched_runs_are_not_finished( tmp_path, monkeypatch ):
+    # A relaunch into an output directory removes its log and completion marker, but leaves the old ddG.db3 in place
+    # until Rosetta writes a new one, so the cached scores of that ddG.db3 must not be analyzed as a finished struct
+    monkeypatch.chdir( tmp_path )
+    make_synthetic_output_tree( 'output', 2, 4, 2, n_log_lines = 0 )
+    analyze_output_folder( 'output', use_cache = True, n_bootstrap_samples = 0 )
+    assert set( read_results( 'output' )[1]['struct_num'] ) == set( [1, 2, 3, 4] )
+
+    os.remove( os.path.join( 'output', 'case00001', '02', analyze_flex_ddG.rosetta_output_file_name ) )
+    analyze_output_folder( 'output', use_cache = True, n_bootstrap_samples = 0 )
+    struct_scores = read_results( 'output' )[1]
+    assert set( struct_scores.loc[ struct_scores['case_name'] == 'case00001' ]['struct_num'] ) == set( [1, 3, 4] )
+    assert set( struct_scores.loc[ struct_scores['case_name'] == 'case00000' ]['struct_num'] ) == set( [1, 2, 3, 4] )
+
+def test_completion_marker_requires_ddg_db3( tmp_path, monkeypatch ):
+    # A completion marker whose ddG.db3 was not copied back does not count as a finished struct, and does not stop the analysis
+    monkeypatch.chdir( tmp_path )
+    make_synthetic_output_tree( 'output', 1, 3, 2, n_log_lines = 0 )
+    struct_dirs = [ os.path.join( 'output', 'case00000', '%02d' % struct_num ) for struct_num in (1, 2, 3) ]
+    for struct_dir in struct_dirs:
+        os.remove( os.path.join( struct_dir, analyze_flex_ddG.rosetta_output_file_name ) )
+        open( os.path.join( struct_dir, analyze_flex_ddG.completion_marker_file_name ), 'w' ).close()
+    os.remove( os.path.join( struct_dirs[1], output_database_name ) )
+    assert [ analyze_flex_ddG.rosetta_output_succeeded( struct_dir ) for struct_dir in struct_dirs ] == [True, False, True]
+    analyze_output_folder( 'output', use_cache = False, n_bootstrap_samples = 0 )
+    assert set( read_results( 'output' )[1]['struct_num'] ) == set( [1, 3] )
@@ -0,0 +1,134 @@
+# Runs AsyncLauncher against a stand-in rosetta_scripts, which writes a ddG.db3 and the JobDistributor lines of a
+# successful run, and can be made to fail, hang or ignore SIGTERM
+
+import os
+import sys
+import gzip
+import json
+import time
+import stat
+
+import pytest
+
+import async_launcher
+import instrumentation
+from async_launcher import AsyncLauncher
+from job_scheduler import RunJournal
+
+fake_rosetta_scripts = '''#!%s
+import os, sys, time, signal
+options = dict( arg.split( '=', 1 ) for arg in sys.argv[1:] )
+if options.get( 'ignore_sigterm' ):
+    signal.signal( signal.SIGTERM, signal.SIG_IGN )
+with open( 'cwd.txt', 'w' ) as f:
+    f.write( os.getcwd() )
+open( 'ddG.db3', 'w' ).close()
+for i in range( 1000 ):
+    print( 'protocols.backrub.BackrubMover: Accepted move %%d' %% i )
+sys.stdout.flush()
+time.sleep( float( options.get( 'sleep', 0 ) ) )
+if options.get( 'exit', '0' ) != '0':
+    print( 'ERROR: fake failure' )
+    sys.exit( int( options['exit'] ) )
+print( 'protocols.jd2.JobDistributor: 1JTG_AB_0001 reported success in 1 seconds' )
+print( 'protocols.jd2.JobDistributor: no more batches to process...' )
+''' % sys.executable
+
+@pytest.fixture
+def fake_rosetta( tmp_path ):
+    path = str( tmp_path / 'rosetta_scripts' )
+    with open( path, 'w' ) as f:
+        f.write( fake_rosetta_scripts )
+    os.chmod( path, os.stat( path ).st_mode | stat.S_IEXEC )
+    return path
+
+@pytest.fixture
+def instrumentation_log( tmp_path, monkeypatch ):
+    log_path = str( tmp_path / 'instrumentation.jsonl' )
+    monkeypatch.setenv( instrumentation.log_path_environment_variable, log_path )
+    return log_path
+
+def make_get_job( tmp_path, fake_rosetta ):
+    def get_fake_job( name, *options ):
+        output_directory = str( tmp_path / 'output' / name )
+        if not os.path.isdir( output_directory ):
+            os.makedirs( output_directory )
+        return ( [fake_rosetta] + list(options), output_directory )
+    return get_fake_job
+
+def read_journal( journal_path ):
+    with open( journal_path ) as f:
+        return [ tuple( line.rstrip( '\n' ).split( '\t' )[1:] ) for line in f ]
+
+def read_lines( path ):
+    opener = gzip.open if path.endswith( '.gz' ) else open
+    with opener( path, 'rt' ) as f:
+        return f.read().splitlines()
+
+def run_launcher( tmp_path, fake_rosetta, jobs, **kwargs ):
+    journal_path = str( tmp_path / 'run_journal.tsv' )
+    launcher = AsyncLauncher( max_processes = 4, journal = RunJournal( journal_path ), **kwargs )
+    get_fake_job = make_get_job( tmp_path, fake_rosetta )
+    returncodes = launcher.run( [ (get_fake_job, job_args) for job_args in jobs ] )
+    return launcher, returncodes, read_journal( journal_path )
+
+def test_success_and_failure( tmp_path, fake_rosetta, instrumentation_log ):
+    launcher, returncodes, journal = run_launcher( tmp_path, fake_rosetta, [ ('ok',), ('fail', 'exit=3') ] )
+    assert returncodes == [0, 3]
+    ok_directory, fail_directory = str( tmp_path / 'output' / 'ok' ), str( tmp_path / 'output' / 'fail' )
+    assert ( 'finished', ok_directory, '0' ) in journal and ( 'failed', fail_directory, '3' ) in journal
+
+    assert os.path.isfile( os.path.join( ok_directory, 'rosetta.done' ) )
+    assert not os.path.isfile( os.path.join( fail_directory, 'rosetta.done' ) )
+    # Only the JobDistributor and error lines are kept uncompressed, and the full log is compressed
+    assert read_lines( os.path.join( ok_directory, 'rosetta.out' ) ) == [
+        'protocols.jd2.JobDistributor: 1JTG_AB_0001 reported success in 1 seconds',
+        'protocols.jd2.JobDistributor: no more batches to process...',
+    ]
+    assert len( read_lines( os.path.join( ok_directory, 'rosetta.out.gz' ) ) ) == 1002
+    assert read_lines( os.path.join( fail_directory, 'rosetta.out' ) ) == [ 'ERROR: fake failure' ]
+
+    # Every run's CPU time and peak memory are recorded
+    with open( instrumentation_log ) as f:
+        records = [ json.loads( line ) for line in f ]
+    assert sorted( [ record['returncode'] for record in records ] ) == [0, 3]
+    assert all( [ record['peak_rss_bytes'] > 0 and record['cpu_seconds'] != None for record in records ] )
+
+def test_timeout_kills_process( tmp_path, fake_rosetta, monkeypatch ):
+    monkeypatch.setattr( async_launcher, 'termination_grace_seconds', 0.5 )
+    start_time = time.time()
+    launcher, returncodes, journal = run_launcher( tmp_path, fake_rosetta, [ ('hung', 'sleep=60', 'ignore_sigterm=1'), ('ok',) ], timeout = 2 )
+    assert time.time() - start_time < 30
+    hung_directory = str( tmp_path / 'output' / 'hung' )
+    assert returncodes[1] == 0 and returncodes[0] == -9
+    assert launcher.timed_out == [ hung_directory ]
+    assert ( 'timeout', hung_directory, '-9' ) in journal
+    assert not os.path.isfile( os.path.join( hung_directory, 'rosetta.done' ) )
+
+def test_scratch( tmp_path, fake_rosetta ):
+    scratch_dir = str( tmp_path / 'scratch' )
+    launcher, returncodes, journal = run_launcher( tmp_path, fake_rosetta, [ ('ok',), ('fail', 'exit=2') ], scratch_dir = scratch_dir )
+    assert returncodes == [0, 2]
+    for name in ['ok', 'fail']:
+        output_directory = str( tmp_path / 'output' / name )
+        # Rosetta, and the log filter, ran in scratch, and everything was copied back
+        with open( os.path.join( output_directory, 'cwd.txt' ) ) as f:
+            assert os.path.dirname( f.read() ) == scratch_dir
+        assert sorted( os.listdir( output_directory ) ) == sorted( ['cwd.txt', 'ddG.db3', 'rosetta.out', 'rosetta.out.gz'] + ( ['rosetta.done'] if name == 'ok' else [] ) )
+    assert os.listdir( scratch_dir ) == []
+
+def test_job_function_error_only_fails_its_own_run( tmp_path, fake_rosetta ):
+    get_fake_job = make_get_job( tmp_path, fake_rosetta )
+    def get_missing_job( name ):
+        raise Exception( 'No valid pre-minimized structure of %s' % name )
+    journal_path = str( tmp_path / 'run_journal.tsv' )
+    launcher = AsyncLauncher(
+        max_processes = 2, journal = RunJournal( journal_path ),
+        get_output_directory = lambda name, *options: str( tmp_path / 'output' / name ),
+    )
+    returncodes = launcher.run( [ (get_fake_job, ('slow', 'sleep=1')), (get_missing_job, ('missing',)), (get_fake_job, ('ok',)) ] )
+    assert returncodes == [0, None, 0]
+    journal = read_journal( journal_path )
+    assert ( 'failed', str( tmp_path / 'output' / 'missing' ), '' ) in journal
+    assert ( 'finished', str( tmp_path / 'output' / 'slow' ), '0' ) in journal and ( 'finished', str( tmp_path / 'output' / 'ok' ), '0' ) in journal
+    assert os.path.isfile( str( tmp_path / 'output' / 'slow' / 'rosetta.done' ) )
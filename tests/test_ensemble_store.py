@@ -0,0 +1,107 @@
+# Ensemble store of tests/data/struct.db3 (see tests/data/make_struct_db3.py), and its analysis functions
+
+import os
+import shutil
+
+import numpy as np
+
+import ensemble_store
+from ensemble_store import EnsembleStore, build_store, rmsd_to_reference, contact_maps, residue_contact_frequencies
+
+data_folder = os.path.join( os.path.dirname( os.path.abspath(__file__) ), 'data' )
+
+def random_rotation( rng ):
+    q, r = np.linalg.qr( rng.normal( size = (3, 3) ) )
+    return q * np.sign( np.linalg.det( q ) )
+
+def test_rmsd_to_reference():
+    rng = np.random.default_rng( 1 )
+    reference = rng.normal( scale = 10.0, size = (50, 3) )
+    moved = np.array( [ reference.dot( random_rotation( rng ).T ) + rng.normal( scale = 20.0, size = 3 ) for i in range( 3 ) ] )
+    noisy = reference + rng.normal( scale = 0.5, size = reference.shape )
+    coordinates = np.concatenate( [ moved, noisy[np.newaxis] ] ).astype( np.float32 )
+    coordinates[1, 7] = np.nan # Atoms missing from any pose are left out of every RMSD
+    reference_with_missing = reference.copy()
+    reference_with_missing[3] = np.nan
+
+    rmsds = rmsd_to_reference( coordinates, reference_with_missing )
+    assert np.allclose( rmsds[:3], 0.0, atol = 1e-3 )
+    common = [ i for i in range( len(reference) ) if i not in (3, 7) ]
+    # The noisy copy is not moved, so its superimposed RMSD is at most its plain RMSD
+    plain_rmsd = np.sqrt( ( ( noisy[common] - reference[common] ) ** 2 ).sum( axis = 1 ).mean() )
+    assert 0.0 < rmsds[3] <= plain_rmsd + 1e-6
+    # On its own, the noisy copy also has atom 7
+    present = [ i for i in range( len(reference) ) if i != 3 ]
+    assert np.isclose(
+        rmsd_to_reference( coordinates[3:], reference_with_missing, superimpose = False )[0],
+        np.sqrt( ( ( noisy[present] - reference[present] ) ** 2 ).sum( axis = 1 ).mean() ), atol = 1e-4,
+    )
+    assert ( rmsd_to_reference( coordinates[:3], reference_with_missing, superimpose = False ) > 1.0 ).all()
+
+def brute_force_contacts( coordinates, row_atoms, column_atoms, contact_distance ):
+    distances = np.linalg.norm( coordinates[:, row_atoms, np.newaxis, :] - coordinates[:, np.newaxis, column_atoms, :], axis = 3 )
+    return distances <= contact_distance
+
+def test_contact_maps( monkeypatch ):
+    rng = np.random.default_rng( 2 )
+    coordinates = rng.uniform( 0.0, 12.0, size = (5, 40, 3) )
+    coordinates[2, 4] = np.nan
+    row_atoms, column_atoms = np.arange( 0, 15 ), np.arange( 15, 40 )
+    expected = brute_force_contacts( coordinates, row_atoms, column_atoms, 4.5 )
+    assert not expected[2, 4].any()
+    assert ( contact_maps( coordinates, row_atoms, column_atoms ) == expected ).all()
+    # Also when the poses are split over several chunks
+    monkeypatch.setattr( ensemble_store, 'contact_chunk_elements', 15 * 25 * 2 )
+    assert ( contact_maps( coordinates, row_atoms, column_atoms ) == expected ).all()
+
+def build_fixture_store( tmp_path ):
+    output_folder = tmp_path / 'output'
+    for struct_num in (1, 2):
+        struct_dir = output_folder / '1JTG' / ( '%02d' % struct_num )
+        struct_dir.mkdir( parents = True )
+        shutil.copy( os.path.join( data_folder, 'struct.db3' ), str( struct_dir / 'struct.db3' ) )
+    with open( str( output_folder / 'trajectory_stride.txt' ), 'w' ) as f:
+        f.write( '10\n' )
+    store_folder = str( tmp_path / 'store' )
+    assert build_store( str(output_folder), store_folder = store_folder ) == (1, 0)
+    assert build_store( str(output_folder), store_folder = store_folder ) == (0, 1)
+    return EnsembleStore( '1JTG', store_folder = store_folder )
+
+def test_build_case_store_round_trip( tmp_path ):
+    store = build_fixture_store( tmp_path )
+    assert store.coordinates.shape == (12, len(store.atoms), 3)
+    # Poses are labeled with the stride recorded in the output folder
+    assert [ tuple(pose) for pose in store.poses.tolist()[:6] ] == [
+        ('backrub', 1, 10), ('wt', 1, 10), ('mut', 1, 10), ('backrub', 1, 20), ('wt', 1, 20), ('mut', 1, 20),
+    ]
+    assert store.poses['struct_num'].tolist() == [1] * 6 + [2] * 6
+
+    # The first pose has the coordinates of the fragment of the input PDB that the fixture was made from
+    reference = store.read_reference_coordinates( os.path.join( data_folder, 'struct.pdb' ) )
+    assert np.isfinite( reference ).all()
+    assert np.allclose( store.get_coordinates( poses = [0] )[0], reference, atol = 1e-3 )
+    # The GLU side chain atoms of A28 are missing from the mut poses, which have ALA there
+    glu_atoms = store.select_atoms( residues = [ ('A', 28, '') ], atom_names = ['CG', 'CD', 'OE1', 'OE2'] )
+    assert len(glu_atoms) == 4
+    mut_poses = store.select_poses( states = ['mut'] )
+    assert np.isnan( store.get_coordinates( poses = mut_poses, atoms = glu_atoms ) ).all()
+    assert np.isfinite( store.get_coordinates( poses = store.select_poses( states = ['wt'] ), atoms = glu_atoms ) ).all()
+
+    # The other poses are rigid copies of the first
+    ca_atoms = store.select_atoms( atom_names = ['CA'] )
+    assert np.allclose( rmsd_to_reference( store.get_coordinates( atoms = ca_atoms ), reference[ca_atoms] ), 0.0, atol = 1e-3 )
+
+def test_residue_contact_frequencies( tmp_path ):
+    store = build_fixture_store( tmp_path )
+    poses = store.select_poses( backrub_steps = [20] )
+    row_atoms, column_atoms = store.select_atoms( chains = ['A'] ), store.select_atoms( chains = ['B'] )
+    frequencies, row_residues, column_residues = residue_contact_frequencies( store, poses, row_atoms, column_atoms, contact_distance = 6.0 )
+    assert row_residues[0] == ('A', 26, '') and column_residues[-1] == ('B', 165, '')
+
+    contacts = brute_force_contacts( store.get_coordinates( poses = poses ), row_atoms, column_atoms, 6.0 )
+    row_keys = [ (chain, resi, icode) for chain, resi, icode, name3, atom_name in store.atoms[row_atoms].tolist() ]
+    column_keys = [ (chain, resi, icode) for chain, resi, icode, name3, atom_name in store.atoms[column_atoms].tolist() ]
+    for i, row_residue in enumerate( row_residues ):
+        for j, column_residue in enumerate( column_residues ):
+            residue_contacts = contacts[:, [ row_key == row_residue for row_key in row_keys ]][:, :, [ column_key == column_residue for column_key in column_keys ]]
+            assert frequencies[i, j] == residue_contacts.any( axis = (1, 2) ).mean()
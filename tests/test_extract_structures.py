@@ -0,0 +1,124 @@
+# Native struct.db3 extraction, checked against tests/data/struct.db3 and the PDB of its first pose (see
+# tests/data/make_struct_db3.py)
+
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import extract_structures
+
+data_folder = os.path.join( os.path.dirname( os.path.abspath(__file__) ), 'data' )
+fixture_db3_path = os.path.join( data_folder, 'struct.db3' )
+fixture_pdb_path = os.path.join( data_folder, 'struct.pdb' )
+
+def read_atoms( lines ):
+    # (atom name, name3, chain, resi, x, y, z) of ATOM records, and None for TER records
+    atoms = []
+    for line in lines:
+        if line.startswith( 'ATOM' ):
+            atoms.append( ( line[12:16].strip(), line[17:20], line[21], int(line[22:26]), float(line[30:38]), float(line[38:46]), float(line[46:54]) ) )
+        elif line.startswith( 'TER' ):
+            atoms.append( None )
+    return atoms
+
+@pytest.fixture
+def struct_db( tmp_path ):
+    # A copy of the fixture, laid out as <output folder>/<case name>/<struct number>/struct.db3
+    struct_dir = tmp_path / 'output' / '1JTG' / '01'
+    struct_dir.mkdir( parents = True )
+    shutil.copy( fixture_db3_path, str( struct_dir / 'struct.db3' ) )
+    return str( struct_dir / 'struct.db3' )
+
+def test_iter_pdb_lines_matches_pdb():
+    conn = sqlite3.connect( fixture_db3_path )
+    try:
+        lines = ''.join( extract_structures.iter_pdb_lines( conn, 1 ) ).splitlines()
+    finally:
+        conn.close()
+    with open( fixture_pdb_path ) as f:
+        assert read_atoms( lines ) == read_atoms( f )
+
+def test_extract_structures_native( struct_db ):
+    assert extract_structures.extract_structures_native( struct_db, rename_function = extract_structures.flex_ddG_rename, verbose = False ) == 0
+    struct_dir = os.path.dirname( struct_db )
+    assert sorted( [ name for name in os.listdir( struct_dir ) if name.endswith( '.pdb' ) ] ) == [
+        'backrub_00005.pdb', 'backrub_00010.pdb', 'mut_00005.pdb', 'mut_00010.pdb', 'wt_00005.pdb', 'wt_00010.pdb',
+    ]
+    with open( os.path.join( struct_dir, 'mut_00005.pdb' ) ) as f:
+        mut_atoms = [ atom for atom in read_atoms( f ) if atom != None ]
+    # The mutant side chain is written, and the atoms of the wild type side chain are not
+    assert [ atom[0] for atom in mut_atoms if atom[2:4] == ('A', 28) ] == ['N', 'CA', 'C', 'O', 'CB']
+    assert set( [ atom[1] for atom in mut_atoms if atom[2:4] == ('A', 28) ] ) == set( ['ALA'] )
+
+def test_unknown_residue_types_raise( struct_db ):
+    conn = sqlite3.connect( struct_db )
+    conn.execute( "UPDATE residues SET res_type='SER:phosphorylated', name3='SER' WHERE struct_id=2 AND resNum=3" )
+    conn.execute( "UPDATE residues SET res_type='XYZ', name3='XYZ' WHERE struct_id=4 AND resNum=3" )
+    conn.commit()
+    for struct_id in (2, 4):
+        with pytest.raises( Exception, match = 'can not be read without Rosetta' ):
+            list( extract_structures.iter_pdb_lines( conn, struct_id ) )
+    conn.close()
+
+def test_missing_heavy_atoms_raise( struct_db ):
+    conn = sqlite3.connect( struct_db )
+    conn.execute( 'DELETE FROM residue_atom_coords WHERE struct_id=1 AND seqpos=8 AND atomno=15' )
+    conn.commit()
+    with pytest.raises( Exception, match = 'no coordinates for OXT' ):
+        list( extract_structures.iter_pdb_lines( conn, 1 ) )
+    conn.close()
+
+def test_structure_selection():
+    selection = extract_structures.StructureSelection( states = set(['mut']), struct_nums = set([1, 2]), final_checkpoint = True )
+    assert selection.matches_db( 'any_case', 2 ) and not selection.matches_db( 'any_case', 3 )
+    assert selection.matches_struct( 'any_case', 'mut', 20, 20 )
+    assert not selection.matches_struct( 'any_case', 'mut', 10, 20 )
+    assert not selection.matches_struct( 'any_case', 'wt', 20, 20 )
+
+    selection = extract_structures.StructureSelection( case_names = set(['a', 'b']), backrub_steps = set([10, 20]), case_checkpoints = set([ ('b', 10), ('c', 20) ]) )
+    # Cases must be both named and in case_checkpoints
+    assert selection.case_names == set(['b'])
+    assert selection.matches_db( 'b', 7 ) and not selection.matches_db( 'a', 7 ) and not selection.matches_db( 'c', 7 )
+    assert selection.matches_struct( 'b', 'wt', 10, 20 )
+    assert not selection.matches_struct( 'b', 'wt', 20, 20 )
+
+def write_results_csv( path ):
+    # ddG rows of 3 cases, 2 score functions, 2 nstruct and 2 backrub checkpoints. Case c has the lowest ddG at the first
+    # checkpoint and the highest at the final one, and the GAM score function ranks the cases the other way around.
+    final_ddgs = { 'a' : -2.0, 'b' : -1.0, 'c' : 1.0 }
+    with open( path, 'w' ) as f:
+        f.write( 'case_name,nstruct,score_function_name,scored_state,backrub_steps,total_score\n' )
+        for case_name, final_ddg in sorted( final_ddgs.items() ):
+            for score_function_name, sign in ( ('fa_talaris2014', 1.0), ('fa_talaris2014-gam', -1.0) ):
+                for nstruct in (1, 2):
+                    for backrub_steps in (10, 20):
+                        ddg = final_ddg if ( nstruct, backrub_steps ) == (2, 20) else ( -5.0 if case_name == 'c' else 0.0 )
+                        f.write( '%s,%d,%s,ddG,%d,%f\n' % (case_name, nstruct, score_function_name, backrub_steps, sign * ddg) )
+                        f.write( '%s,%d,%s,dG,%d,%f\n' % (case_name, nstruct, score_function_name, backrub_steps, -9.0) )
+
+def test_read_results_case_checkpoints( tmp_path ):
+    results_csv = str( tmp_path / 'results.csv' )
+    write_results_csv( results_csv )
+    all_checkpoints = set( [ (case_name, backrub_steps) for case_name in 'abc' for backrub_steps in (10, 20) ] )
+    assert extract_structures.read_results_case_checkpoints( results_csv ) == all_checkpoints
+    # The top cases are ranked by their final checkpoint in one score function, and keep all their checkpoints
+    assert extract_structures.read_results_case_checkpoints( results_csv, top = 2, score_function_name = 'fa_talaris2014' ) == set( [ ('a', 10), ('a', 20), ('b', 10), ('b', 20) ] )
+    assert extract_structures.read_results_case_checkpoints( results_csv, top = 1, score_function_name = 'fa_talaris2014-gam' ) == set( [ ('c', 10), ('c', 20) ] )
+    with pytest.raises( Exception, match = 'requires a score function name' ):
+        extract_structures.read_results_case_checkpoints( results_csv, top = 2 )
+
+def test_selection_uses_output_folder_stride( tmp_path, struct_db ):
+    # The split protocol records its backrub trials as the stride, so its 2 checkpoints are 10 and 20 steps
+    with open( str( tmp_path / 'output' / 'trajectory_stride.txt' ), 'w' ) as f:
+        f.write( '10\n' )
+    # struct.db3 files outside the <case name>/<struct number> layout are skipped rather than failing the extraction
+    other_dir = tmp_path / 'output' / '1JTG' / 'backrub'
+    other_dir.mkdir()
+    shutil.copy( fixture_db3_path, str( other_dir / 'struct.db3' ) )
+
+    selection = extract_structures.StructureSelection( states = set(['wt', 'mut']), final_checkpoint = True )
+    assert extract_structures.main( str( tmp_path / 'output' ), selection = selection ) == []
+    assert sorted( [ name for name in os.listdir( os.path.dirname(struct_db) ) if name.endswith( '.pdb' ) ] ) == ['mut_00020.pdb', 'wt_00020.pdb']
+    assert not any( [ name.endswith( '.pdb' ) for name in os.listdir( str(other_dir) ) ] )
@@ -0,0 +1,72 @@
+# Checks the option combinations that the launchers reject, and that run_cases writes a job manifest or, with
+# --resume, only starts the runs that have not already succeeded
+
+import os
+import sys
+import json
+import argparse
+
+import pytest
+
+import flex_ddg_launcher
+from analyze_flex_ddG import output_database_name
+from job_scheduler import start_rosetta_process, completion_marker_file_name
+
+launcher = 'run_example_1.py'
+
+def parse_args( argv ):
+    parser = argparse.ArgumentParser()
+    flex_ddg_launcher.add_arguments( parser )
+    return flex_ddg_launcher.parse_arguments( parser, argv )
+
+@pytest.mark.parametrize( 'argv, message', [
+    ( ['--adaptive', '--run-manifest', 'm.jsonl', '--task-index', '0'], '--adaptive needs all replicates' ),
+    ( ['--adaptive', '--async-launcher'], '--async-launcher can not be combined with --adaptive' ),
+    ( ['--job-timeout', '10'], '--job-timeout requires --async-launcher' ),
+    ( ['--task-index', '0'], '--task-index and --task-range require --run-manifest' ),
+] )
+def test_rejected_options( argv, message, capsys ):
+    with pytest.raises( SystemExit ):
+        parse_args( argv )
+    assert message in capsys.readouterr().err
+
+def make_runs( tmp_path, names ):
+    # Returns the cases, and a start function that runs a Python process writing ddG.db3 in place of Rosetta
+    started = []
+    def get_output_directory( name ):
+        return str( tmp_path / 'output' / name )
+    def start_run( name ):
+        started.append( name )
+        if not os.path.isdir( get_output_directory( name ) ):
+            os.makedirs( get_output_directory( name ) )
+        return start_rosetta_process( [sys.executable, '-c', 'open( %r, "w" ).close()' % output_database_name], get_output_directory( name ), completion_marker_file_name )
+    return [ (name,) for name in names ], get_output_directory, start_run, started
+
+def test_resume_only_starts_unfinished_runs( tmp_path ):
+    cases, get_output_directory, start_run, started = make_runs( tmp_path, ['done', 'incomplete', 'new'] )
+    for name in ['done', 'incomplete']:
+        os.makedirs( get_output_directory( name ) )
+        open( os.path.join( get_output_directory( name ), output_database_name ), 'w' ).close()
+    open( os.path.join( get_output_directory( 'done' ), completion_marker_file_name ), 'w' ).close()
+
+    journal_path = str( tmp_path / 'output' / 'run_journal.tsv' )
+    flex_ddg_launcher.run_cases( parse_args( ['--resume'] ), launcher, cases, get_output_directory, start_run, None, journal_path, max_processes = 1 )
+
+    assert started == ['incomplete', 'new']
+    for name in ['done', 'incomplete', 'new']:
+        assert os.path.isfile( os.path.join( get_output_directory( name ), completion_marker_file_name ) )
+    with open( journal_path ) as f:
+        events = [ line.split( '\t' )[1:3] for line in f ]
+    assert [ event for event, output_directory in events ] == ['skipped', 'cleaned', 'started', 'finished', 'started', 'finished']
+
+def test_write_manifest_starts_nothing( tmp_path ):
+    cases, get_output_directory, start_run, started = make_runs( tmp_path, ['a', 'b'] )
+    manifest_path = str( tmp_path / 'manifest.jsonl' )
+    journal_path = str( tmp_path / 'output' / 'run_journal.tsv' )
+    flex_ddg_launcher.run_cases( parse_args( ['--write-manifest', manifest_path, '--preminimize'] ), launcher, cases, get_output_directory, start_run, None, journal_path )
+
+    assert started == [] and not os.path.exists( journal_path )
+    with open( manifest_path ) as f:
+        header = json.loads( f.readline() )
+        assert [ tuple( json.loads( line ) ) for line in f ] == cases
+    assert header['launcher'] == launcher and header['options'] == { 'preminimize' : True, 'scratch' : None }
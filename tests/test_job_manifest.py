@@ -0,0 +1,76 @@
+# Launch options written to a job manifest are applied by the array tasks that run it, and the array task slices
+# cover the manifest's runs exactly once
+
+import argparse
+
+import pytest
+
+import job_manifest
+import flex_ddg_launcher
+from job_scheduler import get_scratch_dir
+
+launcher = 'run_example_1.py'
+
+def parse_args( argv ):
+    parser = argparse.ArgumentParser()
+    flex_ddg_launcher.add_arguments( parser )
+    return parser.parse_args( argv )
+
+def get_cases( n_runs ):
+    return [ ('1JTG', 'inputs/1JTG', 'inputs/1JTG/1JTG_AB.pdb', 'B', nstruct_i) for nstruct_i in range(1, n_runs + 1) ]
+
+def write_manifest( tmp_path, argv, n_runs = 3 ):
+    manifest_path = str( tmp_path / 'manifest.jsonl' )
+    args = parse_args( ['--write-manifest', manifest_path] + argv )
+    job_manifest.write_job_manifest( manifest_path, launcher, get_cases( n_runs ), options = job_manifest.get_launch_options( args ) )
+    return manifest_path
+
+def run_task_args( manifest_path, argv ):
+    args = parse_args( ['--run-manifest', manifest_path] + argv )
+    job_manifest.apply_launch_options( args )
+    return args
+
+def test_launch_options_round_trip( tmp_path, capsys, monkeypatch ):
+    manifest_path = write_manifest( tmp_path, ['--preminimize', '--scratch'] )
+    assert '--task-index \\$SLURM_ARRAY_TASK_ID --preminimize --scratch"' in capsys.readouterr().out
+    # A bare --scratch becomes the default scratch directory of the node running the task
+    args = run_task_args( manifest_path, ['--task-index', '1'] )
+    monkeypatch.setenv( 'TMPDIR', '/other/node/tmp' )
+    assert args.preminimize and get_scratch_dir( args.scratch ) == '/other/node/tmp'
+    assert job_manifest.get_manifest_cases( args, launcher ) == get_cases( 3 )[1:2]
+
+    # A given directory is kept, even if it is the default scratch directory of the node that wrote the manifest
+    manifest_path = write_manifest( tmp_path, ['--scratch', '/other/node/tmp'] )
+    monkeypatch.setenv( 'TMPDIR', '/task/node/tmp' )
+    args = run_task_args( manifest_path, ['--task-index', '1'] )
+    assert not args.preminimize and get_scratch_dir( args.scratch ) == '/other/node/tmp'
+    # Options given to the task itself take precedence
+    assert run_task_args( manifest_path, ['--task-index', '1', '--scratch', '/mine'] ).scratch == '/mine'
+
+    manifest_path = write_manifest( tmp_path, [] )
+    args = run_task_args( manifest_path, ['--task-index', '1'] )
+    assert not args.preminimize and args.scratch is None
+
+@pytest.mark.parametrize( 'n_runs', [1, 7, 12] )
+def test_slices_cover_manifest_once( tmp_path, n_runs ):
+    manifest_path = write_manifest( tmp_path, [], n_runs = n_runs )
+    for tasks_per_index in (1, 3, 5, 12):
+        n_indices = ( n_runs + tasks_per_index - 1 ) // tasks_per_index
+        runs = []
+        for task_index in range( n_indices ):
+            runs.extend( job_manifest.get_manifest_cases( run_task_args( manifest_path, ['--task-index', str(task_index), '--tasks-per-index', str(tasks_per_index)] ), launcher ) )
+        assert runs == get_cases( n_runs )
+        with pytest.raises( Exception, match = 'outside' ):
+            job_manifest.get_manifest_cases( run_task_args( manifest_path, ['--task-index', str(n_indices), '--tasks-per-index', str(tasks_per_index)] ), launcher )
+
+    for range_size in (1, 2, 5):
+        runs = []
+        for first in range( 0, n_runs, range_size ):
+            last = min( first + range_size, n_runs ) - 1
+            task_range = '%d-%d' % (first, last) if range_size > 1 else '%d' % first
+            runs.extend( job_manifest.get_manifest_cases( run_task_args( manifest_path, ['--task-range', task_range] ), launcher ) )
+        assert runs == get_cases( n_runs )
+
+    # A range past the last run is an error rather than being cut short
+    with pytest.raises( Exception, match = 'outside' ):
+        job_manifest.get_manifest_cases( run_task_args( manifest_path, ['--task-range', '0-%d' % n_runs] ), launcher )
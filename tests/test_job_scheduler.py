@@ -0,0 +1,103 @@
+# Checks that AdaptiveNstruct runs enough replicates of every case to estimate its standard error, and that a run
+# whose output can not be copied back from scratch fails on its own
+
+import os
+import sys
+import errno
+import collections
+
+import pandas as pd
+
+import job_scheduler
+from analyze_flex_ddG import completion_marker_file_name, output_database_name
+from job_scheduler import AdaptiveNstruct, MemoryAwareScheduler, RunJournal, start_rosetta_process
+
+class FakeAdaptiveNstruct( AdaptiveNstruct ):
+    # Takes each finished replicate's ddG from the ddg_values of its case, instead of reading its ddG.db3
+    ddg_values = [ 1.0, 3.0, 2.0, 5.0, 4.0, 1.5, 2.5, 3.5, 4.5, 0.5 ]
+
+    def add_finished_struct( self, case_directory, output_directory ):
+        ddg = self.ddg_values[ len(self.struct_ddgs[case_directory]) ]
+        self.struct_ddgs[case_directory].append( pd.DataFrame( { 'score_function_name' : ['talaris2014'], 'total_score' : [ddg] } ) )
+        self.update_standard_error( case_directory )
+
+def make_replicates( output_folder, case_names, nstruct, failing_replicates = () ):
+    # Returns the replicate args, and a start function that marks each replicate as finished unless it is in failing_replicates
+    def get_output_directory( case_name, nstruct_i ):
+        return os.path.join( output_folder, case_name, '%02d' % nstruct_i )
+
+    def start_replicate( case_name, nstruct_i ):
+        output_directory = get_output_directory( case_name, nstruct_i )
+        os.makedirs( output_directory )
+        returncode = 1 if (case_name, nstruct_i) in failing_replicates else 0
+        if returncode == 0:
+            open( os.path.join( output_directory, output_database_name ), 'w' ).close()
+            open( os.path.join( output_directory, completion_marker_file_name ), 'w' ).close()
+        return ( returncode, lambda returncode: None )
+
+    cases = [ (case_name, nstruct_i) for nstruct_i in range( 1, nstruct + 1 ) for case_name in case_names ]
+    return cases, start_replicate, get_output_directory
+
+def run_one_at_a_time( adaptive ):
+    # Runs the jobs of adaptive in order, each finishing before the next is asked for, as with a single process slot
+    pending = collections.deque( adaptive.initial_jobs() )
+    while True:
+        if len(pending) == 0:
+            job = adaptive.next_job()
+            if job is None:
+                break
+            pending.append( job )
+        start_function, args = pending.popleft()
+        returncode, finish = start_function( *args )
+        finish( returncode )
+
+def get_struct_counts( adaptive ):
+    return { os.path.basename( case_directory ) : len(struct_ddgs) for case_directory, struct_ddgs in adaptive.struct_ddgs.items() }
+
+def test_min_nstruct_of_one_still_estimates_standard_errors( tmp_path ):
+    cases, start_replicate, get_output_directory = make_replicates( str(tmp_path), ['case_a', 'case_b'], 10 )
+    adaptive = FakeAdaptiveNstruct( cases, start_replicate, get_output_directory, 1, 0.0 )
+    run_one_at_a_time( adaptive )
+    assert get_struct_counts( adaptive ) == { 'case_a' : 10, 'case_b' : 10 }
+    assert len(adaptive.standard_errors) == 2
+
+def test_failed_initial_replicates_are_replaced( tmp_path ):
+    cases, start_replicate, get_output_directory = make_replicates( str(tmp_path), ['case_a', 'case_b'], 10, failing_replicates = [ ('case_a', 2) ] )
+    adaptive = FakeAdaptiveNstruct( cases, start_replicate, get_output_directory, 3, 0.0 )
+    run_one_at_a_time( adaptive )
+    assert get_struct_counts( adaptive ) == { 'case_a' : 9, 'case_b' : 10 }
+    assert adaptive.failed[ os.path.join( str(tmp_path), 'case_a' ) ] == 1
+
+def test_converged_cases_stop_after_min_nstruct( tmp_path ):
+    cases, start_replicate, get_output_directory = make_replicates( str(tmp_path), ['case_a'], 10, failing_replicates = [ ('case_a', 1) ] )
+    adaptive = FakeAdaptiveNstruct( cases, start_replicate, get_output_directory, 3, 100.0 )
+    run_one_at_a_time( adaptive )
+    assert get_struct_counts( adaptive ) == { 'case_a' : 3 }
+
+def test_copy_back_failure_only_fails_its_own_run( tmp_path, monkeypatch ):
+    copy_back_from_scratch = job_scheduler.copy_back_from_scratch
+    def copy_back_unless_disk_full( scratch_directory, output_directory, log_file_name = None ):
+        if os.path.basename( output_directory ) == 'full':
+            raise OSError( errno.ENOSPC, 'No space left on device' )
+        copy_back_from_scratch( scratch_directory, output_directory, log_file_name )
+    monkeypatch.setattr( job_scheduler, 'copy_back_from_scratch', copy_back_unless_disk_full )
+
+    scratch_dir = str( tmp_path / 'scratch' )
+    def get_output_directory( name ):
+        return str( tmp_path / name )
+    def start_run( name ):
+        os.makedirs( get_output_directory( name ) )
+        return start_rosetta_process( [sys.executable, '-c', 'print("done")'], get_output_directory( name ), completion_marker_file_name, scratch_dir = scratch_dir )
+
+    journal = RunJournal( str( tmp_path / 'run_journal.tsv' ) )
+    start_run_journaled = journal.journaled( start_run, get_output_directory )
+    returncodes = MemoryAwareScheduler( max_processes = 1, poll_interval = 0.01 ).run( [ (start_run_journaled, (name,)) for name in ['full', 'ok'] ] )
+
+    assert returncodes == [None, 0]
+    assert not os.path.isfile( os.path.join( get_output_directory( 'full' ), completion_marker_file_name ) )
+    assert os.path.isfile( os.path.join( get_output_directory( 'ok' ), completion_marker_file_name ) )
+    with open( str( tmp_path / 'run_journal.tsv' ) ) as f:
+        events = [ line.split( '\t' )[1:3] for line in f ]
+    assert [ event for event in events if event[0] != 'started' ] == [ ['failed', get_output_directory( 'full' )], ['finished', get_output_directory( 'ok' )] ]
+    # The scratch directory of the failed copy is kept for inspection
+    assert len( os.listdir( scratch_dir ) ) == 1